@@ -47,27 +47,19 @@ def inport_value_hack(outport):
         return 2
 
 
-class BackendChannel(asynchat.async_chat):
+class BackendChannel(FramedChannel):
     """Sends messages to the server and receives responses.
     """
     def __init__(self, host, port, of_client):
         self.of_client = of_client
-        self.received_data = []
-        asynchat.async_chat.__init__(self)
+        FramedChannel.__init__(self, of_client.channel_lock)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connect((host, port))
-        self.ac_in_buffer_size = 4096 * 3
-        self.ac_out_buffer_size = 4096 * 3
-        self.set_terminator(TERM_CHAR)
         return
 
     def handle_connect(self):
         print "Connected to pyretic frontend."
-        
-    def collect_incoming_data(self, data):
-        """Read an incoming message from the client and put it into our outgoing queue."""
-        with self.of_client.channel_lock:
-            self.received_data.append(data)
+        self.send_hello()
 
     def dict2OF(self,d):
         def convert(h,val):
@@ -84,13 +76,16 @@ class BackendChannel(asynchat.async_chat):
                 return val
         return { h : convert(h,val) for (h, val) in d.items()}
 
-    def found_terminator(self):
-        """The end of a command or message has been seen."""
-        with self.of_client.channel_lock:
-            msg = deserialize(self.received_data)
-
-        # USE DESERIALIZED MSG
-        if msg[0] == 'inject_discovery_packet':
+    def handle_msg(self,msg):
+        if msg[0] == 'bulk':
+            # send each switch's flow-mods together once the batch is read
+            self.of_client.begin_batch()
+            try:
+                for op in msg[1]:
+                    self.handle_msg(op)
+            finally:
+                self.of_client.flush_batch()
+        elif msg[0] == 'inject_discovery_packet':
             switch = msg[1]
             port = msg[2]
             self.of_client.inject_discovery_packet(switch,port)
@@ -102,6 +97,11 @@ class BackendChannel(asynchat.async_chat):
             priority = int(msg[2])
             actions = map(self.dict2OF,msg[3])
             self.of_client.install_flow(pred,priority,actions)
+        elif msg[0] == 'modify':
+            pred = self.dict2OF(msg[1])
+            priority = int(msg[2])
+            actions = map(self.dict2OF,msg[3])
+            self.of_client.modify_flow(pred,priority,actions)
         elif msg[0] == 'delete':
             pred = self.dict2OF(msg[1])
             priority = int(msg[2])
@@ -127,6 +127,7 @@ class POXClient(revent.EventMixin):
         self.debug_packet_in = debug_packet_in
         self.packetno = 0
         self.channel_lock = threading.Lock()
+        self.batch = None
 
         if core.hasComponent("openflow"):
             self.listenTo(core.openflow)
@@ -235,10 +236,8 @@ class POXClient(revent.EventMixin):
 
 
     def send_to_pyretic(self,msg):
-        serialized_msg = serialize(msg)
         try:
-            with self.channel_lock:
-                self.backend_channel.push(serialized_msg)
+            self.backend_channel.push_msg(msg)
         except IndexError as e:
             print "ERROR PUSHING MESSAGE %s" % msg
             pass
@@ -309,6 +308,11 @@ class POXClient(revent.EventMixin):
         for actions in action_list:
             outport = actions['outport']
             del actions['outport']
+            if 'max_len' in actions:
+                # truncated copy to the controller
+                of_actions.append(of.ofp_action_output(port=outport,
+                                                       max_len=actions['max_len']))
+                continue
             if 'srcmac' in actions:
                 of_actions.append(of.ofp_action_dl_addr.set_src(actions['srcmac']))
             if 'dstmac' in actions:
@@ -354,12 +358,33 @@ class POXClient(revent.EventMixin):
                               match=match,
                               actions=of_actions)
         try:
-            self.switches[switch]['connection'].send(msg)
+            self.send_to_connection(switch,msg)
         except RuntimeError, e:
             print "WARNING:install_flow: %s to switch %d" % (str(e),switch)
         except KeyError, e:
             print "WARNING:install_flow: No connection to switch %d available" % switch
 
+    def modify_flow(self,pred,priority,action_list):
+        switch = pred['switch']
+        if 'inport' in pred:        
+            inport = pred['inport']
+        else:
+            inport = None
+        match = self.build_of_match(switch,inport,pred)
+        of_actions = self.build_of_actions(inport,action_list)
+        msg = of.ofp_flow_mod(command=of.OFPFC_MODIFY_STRICT,
+                              priority=priority,
+                              idle_timeout=of.OFP_FLOW_PERMANENT,
+                              hard_timeout=of.OFP_FLOW_PERMANENT,
+                              match=match,
+                              actions=of_actions)
+        try:
+            self.send_to_connection(switch,msg)
+        except RuntimeError, e:
+            print "WARNING:modify_flow: %s to switch %d" % (str(e),switch)
+        except KeyError, e:
+            print "WARNING:modify_flow: No connection to switch %d available" % switch
+
     def delete_flow(self,pred,priority):
         switch = pred['switch']
         if 'inport' in pred:        
@@ -371,15 +396,44 @@ class POXClient(revent.EventMixin):
                               priority=priority,
                               match=match)
         try:
-            self.switches[switch]['connection'].send(msg)
+            self.send_to_connection(switch,msg)
         except RuntimeError, e:
             print "WARNING:delete_flow: %s to switch %d" % (str(e),switch)
         except KeyError, e:
             print "WARNING:delete_flow: No connection to switch %d available" % switch
 
+    def begin_batch(self):
+        """
+        Start queueing flow-mods, barriers and clears per switch rather
+        than sending each as it is built.
+        """
+        self.batch = {}
+
+    def flush_batch(self):
+        """
+        Send each switch its queued messages in a single write and stop
+        queueing.
+        """
+        batch = self.batch
+        self.batch = None
+        for (switch, msgs) in batch.items():
+            try:
+                self.switches[switch]['connection'].send(
+                    ''.join(m.pack() for m in msgs))
+            except RuntimeError, e:
+                print "WARNING:flush_batch: %s to switch %d" % (str(e),switch)
+            except KeyError, e:
+                print "WARNING:flush_batch: No connection to switch %d available" % switch
+
+    def send_to_connection(self,switch,msg):
+        if self.batch is None:
+            self.switches[switch]['connection'].send(msg)
+        else:
+            self.batch.setdefault(switch,[]).append(msg)
+
     def barrier(self,switch):
         b = of.ofp_barrier_request()
-        self.switches[switch]['connection'].send(b) 
+        self.send_to_connection(switch,b)
 
     def flow_stats_request(self,switch):
         sr = of.ofp_stats_request()
@@ -396,7 +450,7 @@ class POXClient(revent.EventMixin):
                 self.clear(switch)
         else:
             d = of.ofp_flow_mod(command = of.OFPFC_DELETE)
-            self.switches[switch]['connection'].send(d) 
+            self.send_to_connection(switch,d)
 
     def _handle_ConnectionUp(self, event):
         assert event.dpid not in self.switches
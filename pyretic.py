@@ -79,6 +79,9 @@ def parseArgs():
     op.add_option( '--mode', '-m', type='choice',
                      choices=['interpreted','i','reactive0','r0','proactive0','p0','proactive1','p1'], 
                      help = '|'.join( ['interpreted/i','reactive0/r0','proactiveN/pN for N={0,1}'] )  )
+    op.add_option( '--batch-window', '-b', type='float', dest='batch_window',
+                   default = 0,
+                   help = 'milliseconds to gather packet-ins into one batch (0 disables batching)' )
     op.add_option( '--verbosity', '-v', type='choice',
                    choices=['low','normal','high','please-make-it-stop'],
                    default = 'low',
@@ -160,7 +163,8 @@ def main():
     logger.addHandler(handler)
     logger.setLevel(log_level)
     
-    runtime = Runtime(Backend(),main,kwargs,options.mode,options.verbosity)
+    runtime = Runtime(Backend(),main,kwargs,options.mode,options.verbosity,
+                      options.batch_window / 1000.0)
     if not options.frontend_only:
         try:
             output = subprocess.check_output('echo $PYTHONPATH',shell=True).strip()
@@ -28,6 +28,7 @@
 ################################################################################
 
 import threading
+from contextlib import contextmanager
 from pyretic.backend.comm import *
 
 class BackendServer(asyncore.dispatcher):
@@ -59,32 +60,17 @@ class BackendServer(asyncore.dispatcher):
         self.close()
 
 
-class BackendChannel(asynchat.async_chat):
+class BackendChannel(FramedChannel):
     """Handles echoing messages from a single backend.
     """
     def __init__(self, backend, sock):
         self.backend = backend
-        self.received_data = []
-        asynchat.async_chat.__init__(self, sock)
-        self.ac_in_buffer_size = 4096 * 3
-        self.ac_out_buffer_size = 4096 * 3
-        self.set_terminator(TERM_CHAR)
+        FramedChannel.__init__(self, backend.channel_lock, sock)
+        self.send_hello()
         return
 
-    def collect_incoming_data(self, data):
-        """Read an incoming message from the backend and put it into our outgoing queue."""
-        with self.backend.channel_lock:
-            self.received_data.append(data)
-
-    def found_terminator(self):
-        """The end of a command or message has been seen."""
-        with self.backend.channel_lock:
-            msg = deserialize(self.received_data)
-
-        # USE DESERIALIZED MSG
-        if msg is None or len(msg) == 0:
-            print "ERROR: empty message"
-        elif msg[0] == 'switch':
+    def handle_msg(self, msg):
+        if msg[0] == 'switch':
             if msg[1] == 'join':
                 if msg[3] == 'BEGIN':
                     self.backend.runtime.handle_switch_join(msg[2])
@@ -123,6 +109,7 @@ class Backend(object):
         self.backend_channel = None
         self.runtime = None
         self.channel_lock = threading.Lock()
+        self.bulk_state = threading.local()
 
         address = ('localhost', BACKEND_PORT) # USE KNOWN PORT
         self.backend_server = BackendServer(self,address)
@@ -132,28 +119,69 @@ class Backend(object):
         self.al.start()
         
     def send_packet(self,packet):
-        self.send_to_OF_client(['packet',packet])
+        packets = getattr(self.bulk_state, 'packets', None)
+        if packets is None:
+            self.send_to_OF_client(['packet',packet])
+        else:
+            packets.append(['packet',packet])
 
     def send_install(self,pred,priority,action_list):
-        self.send_to_OF_client(['install',pred,priority,action_list])
+        self.send_table_update(['install',pred,priority,action_list])
+
+    def send_modify(self,pred,priority,action_list):
+        self.send_table_update(['modify',pred,priority,action_list])
 
     def send_delete(self,pred,priority):
-        self.send_to_OF_client(['delete',pred,priority])
+        self.send_table_update(['delete',pred,priority])
         
     def send_clear(self,switch):
-        self.send_to_OF_client(['clear',switch])
+        self.send_table_update(['clear',switch])
 
     def send_flow_stats_request(self,switch):
         self.send_to_OF_client(['flow_stats_request',switch])
 
     def send_barrier(self,switch):
-        self.send_to_OF_client(['barrier',switch])
+        self.send_table_update(['barrier',switch])
 
     def inject_discovery_packet(self,dpid, port):
         self.send_to_OF_client(['inject_discovery_packet',dpid,port])
 
-    def send_to_OF_client(self,msg):
-        serialized_msg = serialize(msg)
-        with self.channel_lock:
-            if not self.backend_channel is None:
-                self.backend_channel.push(serialized_msg)
+    @contextmanager
+    def bulk(self):
+        """
+        Gather the table updates (installs, modifies, deletes, clears and
+        barriers) sent by the calling thread and ship them to the OF client
+        as 'bulk' messages on exit, rather than one message per update.
+        Packet-outs are held as well and written together after the
+        table updates.
+        """
+        if not getattr(self.bulk_state, 'ops', None) is None:
+            yield
+            return
+        self.bulk_state.ops = []
+        self.bulk_state.packets = []
+        try:
+            yield
+        finally:
+            ops = self.bulk_state.ops
+            packets = self.bulk_state.packets
+            self.bulk_state.ops = None
+            self.bulk_state.packets = None
+            for i in range(0, len(ops), BULK_MAX_OPS):
+                self.send_to_OF_client(['bulk',ops[i:i+BULK_MAX_OPS]],
+                                       compact=True)
+            channel = self.backend_channel
+            if packets and not channel is None:
+                channel.push_msgs(packets)
+
+    def send_table_update(self,msg):
+        ops = getattr(self.bulk_state, 'ops', None)
+        if ops is None:
+            self.send_to_OF_client(msg)
+        else:
+            ops.append(msg)
+
+    def send_to_OF_client(self,msg,compact=False):
+        channel = self.backend_channel
+        if not channel is None:
+            channel.push_msg(msg,compact)
@@ -32,12 +32,25 @@ import asyncore
 import socket
 
 import json
+import base64
+import struct
 
 BACKEND_PORT=41414
 TERM_CHAR='\n'
+# offer length-prefixed binary frames to the peer (see FramedChannel)
+BINARY_FRAMING=True
+# maximum number of operations carried by a single 'bulk' message
+BULK_MAX_OPS=1000
 
-def serialize(msg):
-    jsonable_msg = to_jsonable_format(msg)
+BYTE_FIELDS = ['srcmac','dstmac','srcip','dstip','raw']
+
+def serialize(msg,compact=False):
+    """
+    Serialize a message for the wire.  With compact set, address and raw
+    fields are carried as base64 strings rather than lists of byte values;
+    deserialize accepts either form.
+    """
+    jsonable_msg = to_jsonable_format(msg,compact)
     jsoned_msg = json.dumps(jsonable_msg)
     serialized_msg = jsoned_msg + TERM_CHAR
     return serialized_msg
@@ -83,8 +96,11 @@ def dict_to_ascii(d):
 
 def bytelist2ascii(packet_dict):
     def convert(h,val):
-        if h in ['srcmac','dstmac','srcip','dstip','raw']:
-            return ''.join([chr(d) for d in val])
+        if h in BYTE_FIELDS:
+            if isinstance(val, list):
+                return ''.join([chr(d) for d in val])
+            else:
+                return base64.b64decode(val)
         else:
             return val
     return { h : convert(h,val) for (h, val) in packet_dict.items()}
@@ -92,19 +108,157 @@ def bytelist2ascii(packet_dict):
 
 def ascii2bytelist(packet_dict):
     def convert(h,val):
-        if h in ['srcmac','dstmac','srcip','dstip','raw']:
+        if h in BYTE_FIELDS:
             return [ord(c) for c in val]
         else:
             return val
     return { h : convert(h,val) for (h, val) in packet_dict.items()}
 
 
-def to_jsonable_format(item):
+def ascii2b64(packet_dict):
+    def convert(h,val):
+        if h in BYTE_FIELDS:
+            return base64.b64encode(val)
+        else:
+            return val
+    return { h : convert(h,val) for (h, val) in packet_dict.items()}
+
+
+def to_jsonable_format(item,compact=False):
     if isinstance(item, dict):
         ascii_item = dict_to_ascii(item)
-        bytelist_item = ascii2bytelist(ascii_item)
-        return bytelist_item
+        if compact:
+            return ascii2b64(ascii_item)
+        else:
+            return ascii2bytelist(ascii_item)
     elif isinstance(item, list):
-        return map(to_jsonable_format,item)
+        return [to_jsonable_format(i,compact) for i in item]
     else:
         return item
+
+
+################################################################################
+# Binary framing
+################################################################################
+
+# frame header: kind, payload length
+FRAME_HEADER = struct.Struct('!BI')
+FRAME_JSON = 0
+FRAME_PACKET = 1
+# packet frame header: switch, inport, outport (-1 when absent); raw follows
+PACKET_HEADER = struct.Struct('!Qii')
+
+def pack_frame(msg):
+    """
+    Encode a message as a binary frame.  Packets carry their raw bytes
+    verbatim after a fixed header; everything else is compact JSON.
+    """
+    if msg[0] == 'packet':
+        packet = msg[1]
+        payload = PACKET_HEADER.pack(packet['switch'],
+                                     packet.get('inport', -1),
+                                     packet.get('outport', -1)) + packet['raw']
+        kind = FRAME_PACKET
+    else:
+        payload = serialize(msg,True).rstrip(TERM_CHAR)
+        kind = FRAME_JSON
+    return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+def unpack_frame(kind, payload):
+    if kind == FRAME_PACKET:
+        (switch, inport, outport) = PACKET_HEADER.unpack_from(payload)
+        packet = { 'switch' : switch,
+                   'raw' : payload[PACKET_HEADER.size:] }
+        if inport != -1:
+            packet['inport'] = inport
+        if outport != -1:
+            packet['outport'] = outport
+        return ['packet', packet]
+    elif kind == FRAME_JSON:
+        return deserialize([payload])
+    else:
+        return None
+
+
+class FramedChannel(asynchat.async_chat):
+    """
+    A channel carrying newline-terminated JSON messages, which can switch
+    to length-prefixed binary frames (see pack_frame) independently in each
+    direction.  Each end announces itself with a 'hello' message; an end
+    that sees the peer offer binary framing sends 'binary_framing' and
+    frames everything it sends afterwards, and the peer switches its
+    reader when that message arrives.  Subclasses implement handle_msg.
+
+    :param lock: guards the receive buffer and the send framing
+    :type lock: threading.Lock
+    """
+    def __init__(self, lock, sock=None):
+        self.lock = lock
+        self.received_data = []
+        self.binary_in = False
+        self.binary_out = False
+        self.frame_kind = None
+        asynchat.async_chat.__init__(self, sock)
+        self.ac_in_buffer_size = 4096 * 3
+        self.ac_out_buffer_size = 4096 * 3
+        self.set_terminator(TERM_CHAR)
+
+    def send_hello(self):
+        self.push_msg(['hello', {'binary_framing' : BINARY_FRAMING}])
+
+    def push_msg(self, msg, compact=False):
+        with self.lock:
+            if self.binary_out:
+                self.push(pack_frame(msg))
+            else:
+                self.push(serialize(msg,compact))
+
+    def push_msgs(self, msgs, compact=False):
+        """Send several messages in a single write."""
+        with self.lock:
+            if self.binary_out:
+                self.push(''.join(pack_frame(msg) for msg in msgs))
+            else:
+                self.push(''.join(serialize(msg,compact) for msg in msgs))
+
+    def collect_incoming_data(self, data):
+        with self.lock:
+            self.received_data.append(data)
+
+    def found_terminator(self):
+        """The end of a command, message, frame header or frame has been seen."""
+        with self.lock:
+            if not self.binary_in:
+                msg = deserialize(self.received_data)
+            else:
+                data = ''.join(self.received_data)
+                del self.received_data[:]
+                if self.frame_kind is None:
+                    (kind, length) = FRAME_HEADER.unpack(data)
+                    if length > 0:
+                        self.frame_kind = kind
+                        self.set_terminator(length)
+                        return
+                    data = ''
+                else:
+                    kind = self.frame_kind
+                    self.frame_kind = None
+                self.set_terminator(FRAME_HEADER.size)
+                msg = unpack_frame(kind, data)
+
+        if msg is None or len(msg) == 0:
+            print "ERROR: empty message"
+        elif msg[0] == 'hello':
+            if BINARY_FRAMING and msg[1].get('binary_framing'):
+                with self.lock:
+                    self.push(serialize(['binary_framing']))
+                    self.binary_out = True
+        elif msg[0] == 'binary_framing':
+            with self.lock:
+                self.binary_in = True
+                self.set_terminator(FRAME_HEADER.size)
+        else:
+            self.handle_msg(msg)
+
+    def handle_msg(self, msg):
+        raise NotImplementedError
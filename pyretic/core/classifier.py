@@ -172,7 +172,7 @@ class Classifier(object):
     ### SEQUENTIAL COMPOSITION
 
     def __rshift__(c1, c2):
-        from pyretic.core.language import match, modify, drop, identity, Controller, CountBucket, DerivedPolicy
+        from pyretic.core.language import match, modify, drop, identity, Controller, CountBucket, MirrorBucket, DerivedPolicy
         # given a test b and an action p, return a test
         # b' such that p >> b == b' >> p.
         def _commute_test(act, pkts):
@@ -180,7 +180,7 @@ class Classifier(object):
                 act = act.policy
             if act == identity:
                 return pkts
-            elif act == Controller or isinstance(act, CountBucket):
+            elif act == Controller or isinstance(act, (CountBucket, MirrorBucket)):
                 return identity
             elif isinstance(act, modify):
                 new_match_dict = {}
@@ -208,7 +208,7 @@ class Classifier(object):
             while isinstance(a1, DerivedPolicy):
                 a1 = a1.policy
             # TODO: be uniform about returning copied or modified objects.
-            if a1 == Controller or isinstance(a1, CountBucket):
+            if a1 == Controller or isinstance(a1, (CountBucket, MirrorBucket)):
                 return {a1}
             elif a1 == identity:
                 return copy.copy(as2)
@@ -217,7 +217,7 @@ class Classifier(object):
                 for a2 in as2:
                     while isinstance(a2, DerivedPolicy):
                         a2 = a2.policy
-                    if a2 == Controller or isinstance(a2, CountBucket): 
+                    if a2 == Controller or isinstance(a2, (CountBucket, MirrorBucket)):
                         new_actions.add(a2)
                     elif a2 == identity:
                         new_actions.add(a1)
@@ -306,3 +306,151 @@ class Classifier(object):
                           False):
                 opt_c.rules.append(r)
         return opt_c
+
+
+###############################################################################
+# Compiled Classifiers
+# a tuple-space lookup structure for evaluating classifiers on single packets.
+
+_ABSENT = object()        # key value for a header the packet does not carry
+_UNPARSEABLE = object()   # key value for an IP header that can't be converted
+
+_IP_FIELDS = ['srcip', 'dstip']
+
+
+class CompiledClassifier(object):
+    """
+    A Classifier compiled for fast per-packet lookup.  Rules are grouped by
+    their field mask (the set of exactly-matched fields plus the prefix length
+    of any IP fields) into hash tables keyed on the matched values.  A lookup
+    probes one table per distinct mask, in order of the best priority each
+    table holds, and stops as soon as no remaining table can beat the best
+    rule found so far.
+
+    Rules whose match is not a Match (or identity) are kept aside and tested
+    with their own eval, in priority order.
+    """
+
+    def __init__(self, classifier):
+        self.rules = list(classifier.rules)
+        # mask -> [best index in table, {key : index of first rule w/ key}]
+        tables = {}
+        self.opaque = []
+        for index, rule in enumerate(self.rules):
+            mask_key = self._mask_and_key(rule.match)
+            if mask_key is None:
+                self.opaque.append(index)
+                continue
+            mask, key = mask_key
+            try:
+                table = tables[mask]
+            except KeyError:
+                table = tables[mask] = [index, {}]
+            try:
+                table[1].setdefault(key, index)
+            except TypeError:    # unhashable pattern
+                self.opaque.append(index)
+        self.opaque.sort()
+        self.tables = sorted([(best, mask, entries)
+                              for mask, (best, entries) in tables.items()],
+                             key=lambda t: t[0])
+
+    def __len__(self):
+        return len(self.rules)
+
+    @staticmethod
+    def _mask_and_key(m):
+        """
+        Returns the (mask, key) pair under which a rule match is stored, or
+        None if the match can't be represented in a table.
+        """
+        from pyretic.core.language import Match, identity
+        if m is identity:
+            return ((), ())
+        if not isinstance(m, Match):
+            return None
+        mask = []
+        key = []
+        for field in sorted(m.map.keys()):
+            pattern = m.map[field]
+            if field in _IP_FIELDS:
+                try:
+                    plen = pattern.prefixlen
+                    net = int(pattern.network) >> (32 - plen) if plen else 0
+                except AttributeError:
+                    return None
+                mask.append((field, plen))
+                key.append(net)
+            else:
+                mask.append((field, None))
+                key.append(_ABSENT if pattern is None else pattern)
+        return (tuple(mask), tuple(key))
+
+    @staticmethod
+    def _ip_value(pkt, field):
+        from pyretic.core.util import string_to_IP
+        from pyretic.core.network import IPAddr
+        try:
+            v = pkt[field]
+        except KeyError:
+            return _ABSENT
+        try:
+            if isinstance(v, IPAddr):
+                return v.value
+            return int(string_to_IP(v))
+        except Exception:
+            return _UNPARSEABLE
+
+    def lookup(self, pkt):
+        """
+        Return the highest priority rule matching pkt, or None.
+        """
+        header = pkt.header
+        ips = {}
+        best = len(self.rules)
+        for table_best, mask, entries in self.tables:
+            if table_best >= best:
+                break
+            key = []
+            for field, plen in mask:
+                if plen is None:
+                    key.append(header.get(field, _ABSENT))
+                    continue
+                try:
+                    v = ips[field]
+                except KeyError:
+                    v = ips[field] = self._ip_value(pkt, field)
+                if v is _ABSENT or v is _UNPARSEABLE:
+                    key = None
+                    break
+                key.append(v >> (32 - plen) if plen else 0)
+            if key is None:
+                continue
+            try:
+                index = entries[tuple(key)]
+            except (KeyError, TypeError):
+                continue
+            if index < best:
+                best = index
+        for index in self.opaque:
+            if index >= best:
+                break
+            if self.rules[index].match.eval(pkt):
+                best = index
+                break
+        if best == len(self.rules):
+            return None
+        return self.rules[best]
+
+    def eval(self, in_pkt):
+        """
+        Same semantics as Classifier.eval: apply the actions of the highest
+        priority matching rule.
+        """
+        rule = self.lookup(in_pkt)
+        if rule is None:
+            raise TypeError('Classifier is not total.')
+        rv = set()
+        for act in rule.actions:
+            rv |= act.eval(in_pkt)
+        return rv
@@ -32,15 +32,17 @@
 # This module is designed for import *.
 import functools
 import itertools
+import random
 import struct
 import time
+import weakref
 from ipaddr import IPv4Network
 from bitarray import bitarray
 import copy
 
 from pyretic.core import util
 from pyretic.core.network import *
-from pyretic.core.classifier import Rule, Classifier
+from pyretic.core.classifier import Rule, Classifier, CompiledClassifier
 from pyretic.core.util import frozendict, singleton
 
 from multiprocessing import Condition
@@ -85,6 +87,8 @@ class Policy(object):
     - evaluating on a single packet.
     - compilation to a switch Classifier
     """
+    _has_queries = None
+
     def eval(self, pkt):
         """
         evaluate this policy on a single packet
@@ -95,8 +99,28 @@ class Policy(object):
         """
         raise NotImplementedError
 
+    def track_eval(self, pkt):
+        """
+        evaluate this policy on a single packet, also collecting the
+        queries whose buckets the packet reaches
+
+        :param pkt: the packet on which to be evaluated
+        :type pkt: Packet
+        :rtype: (set Packet, set Query)
+        """
+        return (self.eval(pkt), set())
+
+    def has_queries(self):
+        """
+        whether any query appears in this policy
+
+        :rtype: bool
+        """
+        return False
+
     def invalidate_classifier(self):
         self._classifier = None
+        self._has_queries = None
 
     def compile(self):
         """
@@ -316,28 +340,83 @@ class Controller(Singleton):
         return "Controller"
     
 
+# live Matches by the key of the map they were built from, and by their
+# canonical key, so that building the same Match again returns it
+_match_cache = weakref.WeakValueDictionary()
+
 class Match(Filter):
     """
     Match on all specified fields.
     Matched packets are kept, non-matched packets are dropped.
 
+    Matches are immutable and hash-consed: building a Match whose map is
+    equal to that of a live Match returns that Match.  Each carries a
+    canonical key, the frozenset of its (field, pattern) pairs, used for
+    hashing and equality, and compiles its classifier on first use.
+
     :param *args: field matches in argument format
     :param **kwargs: field matches in keyword-argument format
     """
-    def __init__(self, map_dict):
+    def __new__(cls, map_dict):
 
         def _get_processed_map(map_dict):
+            map_dict = dict(map_dict)
             for field in ['srcip', 'dstip']:
                 try:
                     val = map_dict[field]
-                    map_dict.update({field: util.string_to_network(val)})
                 except KeyError:
-                    pass
+                    continue
+                if isinstance(val, IPAddr):
+                    map_dict[field] = IPv4Network(int(val))
+                else:
+                    map_dict[field] = util.string_to_network(val)
             return map_dict
 
-        self.map = util.frozendict(_get_processed_map(map_dict))
-        self._classifier = self.generate_classifier()
-        super(Match,self).__init__()
+        try:
+            raw_key = frozenset(map_dict.items())
+            return _match_cache[raw_key]
+        except TypeError:
+            raw_key = None
+        except KeyError:
+            pass
+        processed = _get_processed_map(map_dict)
+        key = frozenset(processed.items())
+        try:
+            self = _match_cache[key]
+        except KeyError:
+            self = super(Match,cls).__new__(cls)
+            self.map = util.frozendict(processed)
+            self.key = key
+            self._hash = hash(key)
+            self._classifier = None
+            super(Match,self).__init__()
+            _match_cache[key] = self
+        if not raw_key is None:
+            _match_cache[raw_key] = self
+        return self
+
+    def __init__(self, map_dict):
+        # ALL THE WORK IS DONE IN __new__, WHICH MAY RETURN AN EXISTING MATCH
+        pass
+
+    def __reduce__(self):
+        return (Match, (dict(self.map),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def compile(self):
+        """
+        Produce a Classifier for this policy
+
+        :rtype: Classifier
+        """
+        if NO_CACHE or self._classifier is None:
+            self._classifier = self.generate_classifier()
+        return self._classifier
 
     def eval(self, pkt):
         """
@@ -355,7 +434,9 @@ class Match(Filter):
                     if pattern is None or pattern != v:
                         return set()
                 else:
-                    v = util.string_to_IP(v)
+                    # IPAddr VALUES ARE TESTED AGAINST THE NETWORK DIRECTLY
+                    if not isinstance(v, IPAddr):
+                        v = util.string_to_IP(v)
                     if pattern is None or not v in pattern:
                         return set()
             except Exception, e:
@@ -369,14 +450,12 @@ class Match(Filter):
         return Classifier([r1, r2])
 
     def __eq__(self, other):
-        return ( (isinstance(other, Match) and self.map == other.map)
+        if self is other:
+            return True
+        return ( (isinstance(other, Match) and self.key == other.key)
             or (other == identity and len(self.map) == 0) )
 
     def intersect(self, pol):
-        #### NETASSAY WORKAROUND ####
-        from pyretic.modules.netassay.netassaymatch import NetAssayMatch
-        #### END NETASSAY WORKAROUND ####
-        
         def _intersect_ip(ipfx, opfx):
             most_specific = None
             if ipfx in opfx:
@@ -391,12 +470,19 @@ class Match(Filter):
             return self
         elif pol == drop:
             return drop
-        #### NETASSAY WORKAROUND ####
-        elif isinstance(pol,NetAssayMatch):
-            return pol.intersect(self)
-        #### END NETASSAY WORKAROUND ####
         elif not isinstance(pol,Match):
+            #### NETASSAY WORKAROUND ####
+            # ONLY IMPORTED OFF THE COMMON Match-Match PATH
+            from pyretic.modules.netassay.netassaymatch import NetAssayMatch
+            if isinstance(pol,NetAssayMatch):
+                return pol.intersect(self)
+            #### END NETASSAY WORKAROUND ####
             raise TypeError(str(pol.__class__.__name__) + ":" +str(pol))
+        # ONE MAP CONTAINING THE OTHER IS THE MORE SPECIFIC MATCH
+        if pol.key <= self.key:
+            return self
+        if self.key <= pol.key:
+            return pol
         fs1 = set(self.map.keys())
         fs2 = set(pol.map.keys())
         shared = fs1 & fs2
@@ -432,7 +518,7 @@ class Match(Filter):
 
     ### hash : unit -> int
     def __hash__(self):
-        return hash(self.map)
+        return self._hash
 
     def covers(self,other):
         # Return identity if self matches every packet that other matches (and maybe more).
@@ -443,6 +529,8 @@ class Match(Filter):
             return True
         elif other == drop:
             return True
+        if self.key <= other.key:
+            return True
         if set(self.map.keys()) - set(other.map.keys()):
             return False
         for (f,v) in self.map.items():
@@ -529,6 +617,19 @@ class Query(Filter):
         with self.bucket_lock:
             self.bucket.add(pkt)
         return set()
+
+    def track_eval(self, pkt):
+        return (self.eval(pkt), {self})
+
+    def has_queries(self):
+        return True
+
+    def dispatch(self):
+        """
+        Hand off work left by apply to run without the runtime's locks.
+        Called by the runtime after it has released them.
+        """
+        pass
         
     ### register_callback : (Packet -> X) -> unit
     def register_callback(self, fn):
@@ -541,21 +642,75 @@ class Query(Filter):
 class FwdBucket(Query):
     """
     Class for registering callbacks on individual packets sent to
-    the controller.
+    the controller.  Callbacks normally run when the runtime applies the
+    bucket, while it holds the policy lock.  With workers > 0, packets are
+    instead handed to a util.BoundedWorkQueue by dispatch, after the
+    runtime has released its locks, and callbacks run on the queue's
+    worker threads; callbacks registered with sync=True still run during
+    apply.
+
+    :param workers: number of delivery threads, 0 to deliver synchronously
+    :type workers: int
+    :param queue_size: the most packets awaiting delivery
+    :type queue_size: int
+    :param overflow: drop-oldest, block or sample (see util.BoundedWorkQueue)
+    :type overflow: string
     """
-    def __init__(self):
+    def __init__(self, workers=0, queue_size=1024, overflow='drop-oldest'):
         self._classifier = self.generate_classifier()
+        self.sync_callbacks = []
+        self.undelivered = []
+        if workers > 0:
+            self.delivery = util.BoundedWorkQueue(self.deliver, workers,
+                                                  queue_size, overflow)
+        else:
+            self.delivery = None
         super(FwdBucket,self).__init__()
 
     def generate_classifier(self):
         return Classifier([Rule(identity,{Controller})])
 
+    def register_callback(self, fn, sync=False):
+        if sync:
+            self.sync_callbacks.append(fn)
+        else:
+            self.callbacks.append(fn)
+
     def apply(self):
         with self.bucket_lock:
             for pkt in self.bucket:
-                for callback in self.callbacks:
+                for callback in self.sync_callbacks:
                     callback(pkt)
+                if self.delivery is None:
+                    self.deliver(pkt)
+                else:
+                    self.undelivered.append(pkt)
             self.bucket.clear()
+
+    def dispatch(self):
+        # putting may wait for room, and the callbacks draining the queue
+        # may need the locks held during apply
+        if self.delivery is None:
+            return
+        with self.bucket_lock:
+            pkts = self.undelivered
+            self.undelivered = []
+        for pkt in pkts:
+            self.delivery.put(pkt)
+
+    def deliver(self, pkt):
+        for callback in self.callbacks:
+            callback(pkt)
+
+    def delivery_stats(self):
+        """
+        Queue depth and latency of asynchronous delivery, if enabled.
+
+        :rtype: dict or None
+        """
+        if self.delivery is None:
+            return None
+        return self.delivery.stats()
     
     def __repr__(self):
         return "FwdBucket"
@@ -566,6 +721,40 @@ class FwdBucket(Query):
         return isinstance(other, FwdBucket)
 
 
+class MirrorBucket(FwdBucket):
+    """
+    A FwdBucket that receives copies of packets.  Switch rules reaching a
+    MirrorBucket keep forwarding packets as the rest of the policy directs
+    and also send a copy to the controller, instead of sending the packet
+    to the controller to be forwarded by the runtime.
+
+    Copies may be truncated by the switch to max_len bytes.  OpenFlow 1.0
+    switches can't sample, so sample thins the copies at the controller,
+    before they reach the bucket.
+
+    :param max_len: bytes of each packet to copy, None for the whole packet
+    :type max_len: int
+    :param sample: fraction of copies put in the bucket
+    :type sample: float
+    """
+    def __init__(self, max_len=None, sample=1.0, workers=0, queue_size=1024,
+                 overflow='drop-oldest'):
+        self.max_len = max_len
+        self.sample = sample
+        super(MirrorBucket,self).__init__(workers,queue_size,overflow)
+
+    def generate_classifier(self):
+        return Classifier([Rule(identity,{self})])
+
+    def eval(self, pkt):
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return set()
+        return super(MirrorBucket,self).eval(pkt)
+
+    def __repr__(self):
+        return "MirrorBucket"
+
+
 class CountBucket(Query):
     """
     Class for registering callbacks on counts of packets sent to
@@ -679,20 +868,10 @@ class CountBucket(Query):
 
     def handle_flow_stats_reply(self,switch,flow_stats):
         """
-        Given a flow_stats_reply from switch s, collect only those
-        counts which are relevant to this bucket.
-
-        Very simple processing for now: just collect all packet and
-        byte counts from rules that have a match that is in the set of
-        matches this bucket is interested in.
+        Given the flow stats from switch s of the rules whose traffic
+        this bucket counts (the runtime picks them out of the switch's
+        flow stats reply), collect their packet and byte counts.
         """
-        def stat_in_bucket(flow_stat, s):
-            table_match = Match(dict(f['match']).intersect(match(switch=s)))
-            network_match = Match(dict(f['match']))
-            if table_match in self.matches or network_match in self.matches:
-                return True
-            return False
-
         with self.in_update_cv:
             while self.in_update:
                 self.in_update_cv.wait()
@@ -700,10 +879,8 @@ class CountBucket(Query):
             self.byte_count = self.byte_count_persistent
             if switch in self.outstanding_switches:
                 for f in flow_stats:
-                    if 'match' in f:
-                        if stat_in_bucket(f, switch):
-                            self.packet_count += f['packet_count']
-                            self.byte_count   += f['byte_count']
+                    self.packet_count += f['packet_count']
+                    self.byte_count   += f['byte_count']
                 self.outstanding_switches.remove(switch)
         # If have all necessary data, call user-land registered callbacks
         if not self.outstanding_switches:
@@ -744,6 +921,11 @@ class CombinatorPolicy(Policy):
             self._classifier = self.generate_classifier()
         return self._classifier
 
+    def has_queries(self):
+        if self._has_queries is None:
+            self._has_queries = any(p.has_queries() for p in self.policies)
+        return self._has_queries
+
     def __repr__(self):
         return "%s:\n%s" % (self.name(),util.repr_plus(self.policies))
 
@@ -772,6 +954,13 @@ class negate(CombinatorPolicy,Filter):
         else:
             return {pkt}
 
+    def track_eval(self, pkt):
+        (inner_output, queries) = self.policies[0].track_eval(pkt)
+        if inner_output:
+            return (set(), queries)
+        else:
+            return ({pkt}, queries)
+
     def generate_classifier(self):
         inner_classifier = self.policies[0].compile()
         return ~inner_classifier
@@ -818,6 +1007,17 @@ class parallel(CombinatorPolicy):
             output |= policy.eval(pkt)
         return output
 
+    def track_eval(self, pkt):
+        if not self.has_queries():
+            return (self.eval(pkt), set())
+        output = set()
+        queries = set()
+        for policy in self.policies:
+            (sub_output, sub_queries) = policy.track_eval(pkt)
+            output |= sub_output
+            queries |= sub_queries
+        return (output, queries)
+
     def generate_classifier(self):
         """
         Adapted from the SDX modification for caching found:
@@ -890,6 +1090,17 @@ class disjoint(CombinatorPolicy):
         
         #print output
         return output
+
+    def track_eval(self, pkt):
+        if not self.has_queries():
+            return (self.eval(pkt), set())
+        output = set()
+        queries = set()
+        for policy in self.policies:
+            (sub_output, sub_queries) = policy.track_eval(pkt)
+            output |= sub_output
+            queries |= sub_queries
+        return (output, queries)
     
 #    def compile(self, do_mp=False):
     def generate_classifier(self, do_mp=False):
@@ -1159,6 +1370,27 @@ class sequential(CombinatorPolicy):
             prev_output = output
         return output
 
+    def track_eval(self, pkt):
+        if not self.has_queries():
+            return (self.eval(pkt), set())
+        prev_output = {pkt}
+        output = prev_output
+        queries = set()
+        for policy in self.policies:
+            if not prev_output:
+                return (set(), queries)
+            if policy == identity:
+                continue
+            if policy == drop:
+                return (set(), queries)
+            output = set()
+            for p in prev_output:
+                (sub_output, sub_queries) = policy.track_eval(p)
+                output |= sub_output
+                queries |= sub_queries
+            prev_output = output
+        return (output, queries)
+
     def generate_classifier(self):
         """
         Adapted from the SDX modification for caching found:
@@ -1249,6 +1481,19 @@ class DerivedPolicy(Policy):
         """
         return self.policy.eval(pkt)
 
+    def track_eval(self, pkt):
+        if not self.has_queries():
+            return (self.eval(pkt), set())
+        if self.__class__.eval.im_func is DerivedPolicy.eval.im_func:
+            return self.policy.track_eval(pkt)
+        # subclasses with their own eval (e.g., breakpoint)
+        return (self.eval(pkt), self.policy.track_eval(pkt)[1])
+
+    def has_queries(self):
+        if self._has_queries is None:
+            self._has_queries = self.policy.has_queries()
+        return self._has_queries
+
     def compile(self):
         """
         Produce a Classifier for this policy
@@ -1314,6 +1559,16 @@ class if_(DerivedPolicy):
         else:
             return self.f_branch.eval(pkt)
 
+    def track_eval(self, pkt):
+        if not self.has_queries():
+            return (self.eval(pkt), set())
+        (pred_output, queries) = self.pred.track_eval(pkt)
+        if pred_output:
+            (output, branch_queries) = self.t_branch.track_eval(pkt)
+        else:
+            (output, branch_queries) = self.f_branch.track_eval(pkt)
+        return (output, queries | branch_queries)
+
     def __repr__(self):
         return "if\n%s\nthen\n%s\nelse\n%s" % (util.repr_plus([self.pred]),
                                                util.repr_plus([self.t_branch]),
@@ -1390,6 +1645,10 @@ class DynamicPolicy(DerivedPolicy):
         self._policy = policy
         self.changed()
 
+    def has_queries(self):
+        # self.policy may be replaced at any time, so don't cache
+        return self.policy.has_queries()
+
     def __repr__(self):
         return "[DynamicPolicy]\n%s" % repr(self.policy)
 
@@ -1404,29 +1663,47 @@ class DynamicFilter(DynamicPolicy,Filter):
 
 class flood(DynamicPolicy):
     """
-    Policy that floods packets on a minimum spanning tree, recalculated
-    every time the network is updated (set_network).
+    Policy that floods packets on a minimum spanning tree, updated from the
+    changes to the network each time it is set (set_network).  Only the
+    per-switch sub-policies whose flooding ports changed are replaced, so
+    the others keep their compiled classifiers.
     """
     def __init__(self):
-        self.mst = None
+        self.mst = SpanningForest()
+        self.fingerprint = Topology().fingerprint()
+        self.switch_policies = {}
         super(flood,self).__init__()
 
     def set_network(self, network):
+        if network is None:
+            return
+        topology = network.topology
+        fingerprint = topology.fingerprint()
+        delta = TopologyDelta(self.fingerprint, fingerprint)
+        self.fingerprint = fingerprint
+        if not delta:
+            return
+        touched = self.mst.update(delta) | delta.switches_added
+        touched |= set(s for (s,p) in delta.ports_added | delta.ports_removed)
+        touched -= delta.switches_removed
         changed = False
-        if not network is None:
-            updated_mst = Topology.minimum_spanning_tree(network.topology)
-            if not self.mst is None:
-                if self.mst != updated_mst:
-                    self.mst = updated_mst
-                    changed = True
-            else:
-                self.mst = updated_mst
+        for switch in delta.switches_removed:
+            if self.switch_policies.pop(switch, None):
                 changed = True
+        for switch in touched:
+            ports = (frozenset(topology.node[switch].get('ports', {})) -
+                     self.mst.non_tree_ports(switch))
+            try:
+                if self.switch_policies[switch][0] == ports:
+                    continue
+            except KeyError:
+                pass
+            self.switch_policies[switch] = (ports,
+                Match(dict(switch=switch)) >> parallel(map(xfwd,sorted(ports))))
+            changed = True
         if changed:
-            self.policy = parallel([
-                    Match(dict(switch=switch)) >>
-                        parallel(map(xfwd,attrs['ports'].keys()))
-                    for switch,attrs in self.mst.nodes(data=True)])
+            self.policy = parallel([self.switch_policies[switch][1]
+                                    for switch in sorted(self.switch_policies)])
 
     def __repr__(self):
         try:
@@ -1435,43 +1712,78 @@ class flood(DynamicPolicy):
             return "flood"
 
 
-class ingress_network(DynamicFilter):
+class _edge_network(DynamicFilter):
     """
-    Returns True if a packet is located at a (switch,inport) pair entering
-    the network, False otherwise.
+    Abstract class for filters on the locations where packets enter or
+    leave the network: ports that may be up and have no link.  The set of
+    locations is updated from the changes to the network, and only the
+    per-switch sub-policies whose locations changed are replaced.
     """
+    field = None
+
     def __init__(self):
-        self.egresses = None
-        super(ingress_network,self).__init__()
+        self.egresses = set()
+        self.fingerprint = Topology().fingerprint()
+        self.switch_policies = {}
+        super(_edge_network,self).__init__()
 
     def set_network(self, network):
-        updated_egresses = network.topology.egress_locations()
-        if not self.egresses == updated_egresses:
-            self.egresses = updated_egresses
-            self.policy = parallel([Match(dict(switch=l.switch,
-                                       inport=l.port_no))
-                                 for l in self.egresses])
+        fingerprint = network.topology.fingerprint()
+        delta = TopologyDelta(self.fingerprint, fingerprint)
+        self.fingerprint = fingerprint
+        if not delta:
+            return
+        (_, ports, _) = fingerprint
+        touched = set()
+        for (switch, port_no) in delta.ports_removed:
+            loc = Location(switch, port_no)
+            if loc in self.egresses:
+                self.egresses.discard(loc)
+                touched.add(switch)
+        for (switch, port_no) in delta.ports_added | delta.ports_changed:
+            (config, status, linked_to) = ports[(switch, port_no)]
+            loc = Location(switch, port_no)
+            if (config or status) and linked_to is None:
+                if not loc in self.egresses:
+                    self.egresses.add(loc)
+                    touched.add(switch)
+            elif loc in self.egresses:
+                self.egresses.discard(loc)
+                touched.add(switch)
+        if not touched:
+            return
+        by_switch = dict((switch, set()) for switch in touched)
+        for l in self.egresses:
+            if l.switch in by_switch:
+                by_switch[l.switch].add(l.port_no)
+        for (switch, port_nos) in by_switch.items():
+            if port_nos:
+                self.switch_policies[switch] = parallel(
+                    [Match({'switch' : switch, self.field : port_no})
+                     for port_no in sorted(port_nos)])
+            else:
+                self.switch_policies.pop(switch, None)
+        self.policy = parallel([self.switch_policies[switch]
+                                for switch in sorted(self.switch_policies)])
+
+
+class ingress_network(_edge_network):
+    """
+    Returns True if a packet is located at a (switch,inport) pair entering
+    the network, False otherwise.
+    """
+    field = 'inport'
 
     def __repr__(self):
         return "ingress_network"
 
 
-class egress_network(DynamicFilter):
+class egress_network(_edge_network):
     """
     Returns True if a packet is located at a (switch,outport) pair leaving
     the network, False otherwise.
     """
-    def __init__(self):
-        self.egresses = None
-        super(egress_network,self).__init__()
-
-    def set_network(self, network):
-        updated_egresses = network.topology.egress_locations()
-        if not self.egresses == updated_egresses:
-            self.egresses = updated_egresses
-            self.policy = parallel([Match(dict(switch=l.switch,
-                                       outport=l.port_no))
-                                 for l in self.egresses])
+    field = 'outport'
 
     def __repr__(self):
         return "egress_network"
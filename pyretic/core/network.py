@@ -30,7 +30,9 @@
 
 import socket
 import struct
+import itertools
 from bitarray import bitarray
+from ipaddr import IPv4Address
 import networkx as nx
 
 from pyretic.core import util
@@ -49,7 +51,24 @@ UDP_PROTO= 17
 # Fixed width stuff
 ################################################################################
 
+# parsed addresses kept for reuse; the table is emptied when full
+ADDRESS_INTERN_SIZE = 65536
+_interned = {}
+
+def _intern(key, address):
+    if len(_interned) >= ADDRESS_INTERN_SIZE:
+        _interned.clear()
+    _interned[key] = address
+    return address
+
+
 class IPPrefix(object):
+    """
+    An IPv4 prefix, held as the int network address and mask, so testing
+    an address against it is a single mask and compare.
+    """
+    __slots__ = ['pattern', 'masklen', 'mask', 'network']
+
     def __init__(self, pattern):
         self.masklen = 32
         parts = pattern.split("/")
@@ -58,91 +77,147 @@ class IPPrefix(object):
             self.masklen = int(parts[1])
         else:
             raise TypeError
-        self.prefix = self.pattern.to_bits()[:self.masklen]
+        self.mask = (0xffffffff << (32 - self.masklen)) & 0xffffffff
+        self.network = self.pattern.value & self.mask
 
     def __eq__(self, other):
         """Match by checking prefix equality"""
         if isinstance(other,IPAddr):
-            return self.prefix == other.to_bits()[:self.masklen]
+            return other.value & self.mask == self.network
         else:
             return False
 
     def __ne__(self, other):
         return not (self == other)
 
+    def __contains__(self, other):
+        return self == IPAddr(other)
+
     def __hash__(self):
         return hash((self.pattern,self.masklen))
 
     def __repr__(self):
         return "%s/%d" % (repr(self.pattern),self.masklen)
 
+
 class IPAddr(object):
-    def __init__(self, ip):
+    """
+    An IPv4 address, held as a single int.  Addresses are immutable and
+    interned, so parsing the same string or bytes again returns the same
+    object.  They can be tested for membership in ipaddr networks, and
+    built from ints and ipaddr addresses as well as strings and bytes.
+    """
+    __slots__ = ['value', '_repr']
+    _version = 4
+
+    def __new__(cls, ip):
+        if type(ip) is cls:
+            return ip
+        if isinstance(ip, (IPAddr, IPv4Address)):
+            ip = int(ip)
+        key = (cls, ip)
+        try:
+            return _interned[key]
+        except KeyError:
+            pass
 
-        # already a IP object
-        if isinstance(ip, IPAddr):
-            self.bits = ip.bits
+        if isinstance(ip, (int, long)):
+            value = ip
 
         # otherwise will be in byte or string encoding
         else:
             assert isinstance(ip, basestring)
-            
-            b = bitarray()
 
             # byte encoding
             if len(ip) == 4:
-                b.frombytes(ip)
+                value = struct.unpack("!I", ip)[0]
 
             # string encoding
             else:
-                b.frombytes(socket.inet_aton(ip))
+                value = struct.unpack("!I", socket.inet_aton(ip))[0]
+
+        self = object.__new__(cls)
+        self.value = value
+        self._repr = None
+        return _intern(key, self)
+
+    @property
+    def _ip(self):
+        # WHAT ipaddr NETWORKS LOOK AT TO TEST MEMBERSHIP
+        return self.value
 
-            self.bits = b
+    def __int__(self):
+        return self.value
 
     def to_bits(self):
-        return self.bits
+        b = bitarray()
+        b.frombytes(self.to_bytes())
+        return b
 
     def to01(self):
-        return self.bits.to01()
+        return self.to_bits().to01()
 
     def to_bytes(self):
-        return self.bits.tobytes()
+        return struct.pack("!I", self.value)
 
     def fromRaw(self):
         return self.to_bytes()
 
     def __repr__(self):
-        return socket.inet_ntoa(self.to_bytes())
+        if self._repr is None:
+            self._repr = socket.inet_ntoa(self.to_bytes())
+        return self._repr
 
     def __hash__(self):
-        return hash(self.to_bytes())    
+        return hash(self.value)
 
     def __eq__(self,other):
-        return repr(self) == repr(other)
+        return isinstance(other, IPAddr) and self.value == other.value
 
     def __ne__(self, other):
         return not (self == other)
 
+    def __reduce__(self):
+        return (self.__class__, (self.value,))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
 class IP(IPAddr):
-    pass
+    __slots__ = []
 
             
 class EthAddr(object):
-    def __init__(self, mac):
-
-        # already a MAC object
+    """
+    A MAC address, held as a single int and interned like IPAddr.
+    """
+    __slots__ = ['value', '_repr']
+
+    def __new__(cls, mac):
+        if type(mac) is cls:
+            return mac
         if isinstance(mac, EthAddr):
-            self.bits = mac.bits
+            mac = mac.value
+        key = (cls, mac)
+        try:
+            return _interned[key]
+        except KeyError:
+            pass
+
+        if isinstance(mac, (int, long)):
+            value = mac
 
         # otherwise will be in byte or string encoding
         else:
             assert isinstance(mac, basestring)
-            
-            b = bitarray()
 
             # byte encoding
             if len(mac) == 6:
-                b.frombytes(mac)
+                (high, low) = struct.unpack("!HI", mac)
+                value = (high << 32) | low
 
             # string encoding
             else:
@@ -158,35 +233,55 @@ class EthAddr(object):
                 if not m:
                     raise ValueError
                 else:
-                    b.frombytes(struct.pack("!BBBBBB", *(int(s, 16) for s in m.groups())))
+                    value = 0
+                    for part in m.groups():
+                        value = (value << 8) | int(part, 16)
+
+        self = object.__new__(cls)
+        self.value = value
+        self._repr = None
+        return _intern(key, self)
+
+    def __int__(self):
+        return self.value
 
-            self.bits = b
-        
     def to_bits(self):
-        return self.bits
+        b = bitarray()
+        b.frombytes(self.to_bytes())
+        return b
 
     def to01(self):
-        return self.bits.to01()
+        return self.to_bits().to01()
 
     def to_bytes(self):
-        return self.bits.tobytes()
+        return struct.pack("!HI", self.value >> 32, self.value & 0xffffffff)
 
     def __repr__(self):
-        parts = struct.unpack("!BBBBBB", self.to_bytes())
-        mac = ":".join(hex(part)[2:].zfill(2) for part in parts)
-        return mac
+        if self._repr is None:
+            parts = struct.unpack("!BBBBBB", self.to_bytes())
+            self._repr = ":".join(hex(part)[2:].zfill(2) for part in parts)
+        return self._repr
 
     def __hash__(self):
-        return hash(self.to_bytes())
+        return hash(self.value)
 
     def __eq__(self,other):
-        return repr(self) == repr(other)
+        return isinstance(other, EthAddr) and self.value == other.value
 
     def __ne__(self, other):
         return not (self == other)
 
+    def __reduce__(self):
+        return (self.__class__, (self.value,))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
 class MAC(EthAddr):
-    pass
+    __slots__ = []
 
 ################################################################################
 # Tools
@@ -236,24 +331,393 @@ class Location(object):
         return "%s[%s]" % (self.switch,self.port_no)
 
 
+class TopologyDelta(object):
+    """
+    The changes that turn one topology into another.  Ports are
+    (switch, port_no) pairs and links frozensets of two such pairs; a port
+    is changed when its config, status or link changed.
+    """
+    def __init__(self, old, new):
+        (old_switches, old_ports, old_links) = old
+        (new_switches, new_ports, new_links) = new
+        self.switches_added = new_switches - old_switches
+        self.switches_removed = old_switches - new_switches
+        self.ports_added = set(new_ports) - set(old_ports)
+        self.ports_removed = set(old_ports) - set(new_ports)
+        self.ports_changed = set(p for p in new_ports
+                                 if p in old_ports and new_ports[p] != old_ports[p])
+        self.links_added = new_links - old_links
+        self.links_removed = old_links - new_links
+
+    def __nonzero__(self):
+        return bool(self.switches_added or self.switches_removed or
+                    self.ports_added or self.ports_removed or
+                    self.ports_changed or
+                    self.links_added or self.links_removed)
+
+    def __repr__(self):
+        return ("switches +%s -%s, ports +%s -%s ~%s, links +%s -%s" %
+                (sorted(self.switches_added), sorted(self.switches_removed),
+                 sorted(self.ports_added), sorted(self.ports_removed),
+                 sorted(self.ports_changed),
+                 [sorted(l) for l in self.links_added],
+                 [sorted(l) for l in self.links_removed]))
+
+
+class SpanningForest(object):
+    """
+    A spanning forest over the switches of a topology, kept up to date one
+    TopologyDelta at a time.  Links are frozensets of two (switch, port_no)
+    pairs, as in Topology.fingerprint.  An added link only ever joins two
+    trees, and a removed tree link is replaced by searching the smaller of
+    the two pieces it leaves for a link back to the other, so an update
+    costs the size of the trees it touches, not of the network.  Links are
+    unweighted, so every spanning forest is a minimum one.
+    """
+    def __init__(self):
+        self.links = {}          # switch -> links at that switch
+        self.tree_links = set()
+        self.component = {}      # switch -> id of its tree
+        self.members = {}        # id of tree -> switches in it
+        self._ids = itertools.count()
+
+    @staticmethod
+    def ends(link):
+        ends = sorted(s for (s, p) in link)
+        return (ends[0], ends[-1])
+
+    def other_end(self, link, switch):
+        (a, b) = self.ends(link)
+        if a == switch:
+            return b
+        return a
+
+    def non_tree_ports(self, switch):
+        """The ports of switch on links that are not in the forest."""
+        return set(p for link in self.links.get(switch, ())
+                   if not link in self.tree_links
+                   for (s, p) in link if s == switch)
+
+    def update(self, delta):
+        """
+        Apply delta to the forest.
+
+        :param delta: the changes to the topology since the last update
+        :type delta: TopologyDelta
+        :return: the remaining switches whose links changed
+        :rtype: set
+        """
+        touched = set()
+        for switch in delta.switches_added:
+            self.add_switch(switch)
+        for link in delta.links_removed:
+            touched |= self.remove_link(link)
+        for switch in delta.switches_removed:
+            touched |= self.remove_switch(switch)
+        for link in delta.links_added:
+            touched |= self.add_link(link)
+        return touched - delta.switches_removed
+
+    def add_switch(self, switch):
+        if switch in self.component:
+            return
+        tree = next(self._ids)
+        self.component[switch] = tree
+        self.members[tree] = set([switch])
+        self.links[switch] = set()
+
+    def remove_switch(self, switch):
+        if not switch in self.component:
+            return set()
+        touched = set()
+        for link in list(self.links[switch]):
+            touched |= self.remove_link(link)
+        tree = self.component.pop(switch)
+        self.members[tree].discard(switch)
+        if not self.members[tree]:
+            del self.members[tree]
+        del self.links[switch]
+        return touched
+
+    def add_link(self, link):
+        (a, b) = self.ends(link)
+        self.add_switch(a)
+        self.add_switch(b)
+        self.links[a].add(link)
+        self.links[b].add(link)
+        if self.component[a] != self.component[b]:
+            self._join(link)
+        return set([a, b])
+
+    def remove_link(self, link):
+        (a, b) = self.ends(link)
+        for switch in (a, b):
+            if switch in self.links:
+                self.links[switch].discard(link)
+        touched = set([a, b])
+        if not link in self.tree_links:
+            return touched
+        self.tree_links.discard(link)
+        # SPLIT THE TREE, GIVING b's SIDE A NEW ID
+        side = self._reach(b)
+        tree = self.component[a]
+        new_tree = next(self._ids)
+        self.members[tree] -= side
+        self.members[new_tree] = side
+        for switch in side:
+            self.component[switch] = new_tree
+        # LOOK FOR A REPLACEMENT FROM THE SMALLER SIDE
+        if len(side) <= len(self.members[tree]):
+            (search, target) = (side, tree)
+        else:
+            (search, target) = (self.members[tree], new_tree)
+        for switch in search:
+            for candidate in self.links[switch]:
+                if self.component[self.other_end(candidate, switch)] == target:
+                    self._join(candidate)
+                    touched |= set(self.ends(candidate))
+                    return touched
+        return touched
+
+    def _reach(self, switch):
+        """The switches connected to switch by tree links."""
+        reached = set([switch])
+        frontier = [switch]
+        while frontier:
+            s = frontier.pop()
+            for link in self.links[s]:
+                if link in self.tree_links:
+                    t = self.other_end(link, s)
+                    if not t in reached:
+                        reached.add(t)
+                        frontier.append(t)
+        return reached
+
+    def _join(self, link):
+        """Add link to the forest, merging the smaller tree into the larger."""
+        (a, b) = self.ends(link)
+        (big, small) = (self.component[a], self.component[b])
+        if len(self.members[big]) < len(self.members[small]):
+            (big, small) = (small, big)
+        for switch in self.members[small]:
+            self.component[switch] = big
+        self.members[big] |= self.members.pop(small)
+        self.tree_links.add(link)
+
+    def __repr__(self):
+        return "\n".join("%s[%s] --- %s[%s]" % (a + b) for (a, b) in
+                         sorted(tuple(sorted(l)) for l in self.tree_links))
+
+
+class ShortestPathTrees(object):
+    """
+    Breadth-first shortest path trees from the switches of a topology,
+    built on first use and kept across topology changes.  A change only
+    discards the trees it can alter: those using a removed link, and
+    those an added link would shorten or extend.
+    """
+    def __init__(self):
+        self.fingerprint = Topology().fingerprint()
+        self.trees = {}   # source -> (dist, parent, links)
+
+    def update(self, topology):
+        fingerprint = topology.fingerprint()
+        delta = TopologyDelta(self.fingerprint, fingerprint)
+        self.fingerprint = fingerprint
+        if not (delta.links_added or delta.links_removed or
+                delta.switches_removed):
+            return
+        for (source, tree) in self.trees.items():
+            if self._affected(tree, delta):
+                del self.trees[source]
+
+    @staticmethod
+    def _affected(tree, delta):
+        (dist, parent, links) = tree
+        if links & delta.links_removed:
+            return True
+        if delta.switches_removed & set(dist):
+            return True
+        for link in delta.links_added:
+            reached = [dist[s] for (s, p) in link if s in dist]
+            # A LINK OUT OF THE TREE EXTENDS IT, A LINK SKIPPING A LEVEL SHORTENS IT
+            if len(reached) == 1:
+                return True
+            if reached and max(reached) - min(reached) > 1:
+                return True
+        return False
+
+    def _build(self, topology, source):
+        dist = {source : 0}
+        parent = {}    # switch -> location it is reached from
+        links = set()
+        frontier = [source]
+        while frontier:
+            next_frontier = []
+            for s in frontier:
+                for (t, port_nos) in topology[s].items():
+                    if t in dist:
+                        continue
+                    dist[t] = dist[s] + 1
+                    parent[t] = Location(s, port_nos[s])
+                    links.add(frozenset([(s, port_nos[s]), (t, port_nos[t])]))
+                    next_frontier.append(t)
+            frontier = next_frontier
+        return (dist, parent, links)
+
+    def path(self, topology, s1, s2):
+        """
+        The locations a packet leaves through on a shortest path from s1
+        to s2, as in Topology.all_pairs_shortest_path.  Raises KeyError if
+        s2 cannot be reached.
+        """
+        try:
+            (dist, parent, links) = self.trees[s1]
+        except KeyError:
+            (dist, parent, links) = self.trees[s1] = self._build(topology, s1)
+        if not s2 in dist:
+            raise KeyError(s2)
+        hops = []
+        while s2 != s1:
+            loc = parent[s2]
+            hops.append(loc)
+            s2 = loc.switch
+        hops.reverse()
+        return hops
+
+
+# every state of every topology gets a distinct version
+_topology_versions = itertools.count(1)
+
 class Topology(nx.Graph):
+    """
+    A network graph of switches (nodes, with their ports) and links (edges,
+    labeled with the port at each end).  Each change to a topology gives it
+    a new version, and copies keep the version of what they copied, so
+    topologies with the same version are equal.  Otherwise equality
+    compares canonical fingerprints, computed in linear time and cached
+    until the next change.  Ports must be changed through the Topology
+    methods so that changes are seen.
+    """
+    def __init__(self, *args, **kwargs):
+        self.version = next(_topology_versions)
+        self._fingerprint = None
+        super(Topology,self).__init__(*args, **kwargs)
+
+    def touch(self):
+        """Record a change to the topology."""
+        self.version = next(_topology_versions)
+
+    def fingerprint(self):
+        """
+        A canonical form of the topology: the set of switches, a dict from
+        (switch, port_no) to the port's (config, status, linked_to), and the
+        set of links.
+        """
+        cached = self._fingerprint
+        if not cached is None and cached[0] == self.version:
+            return cached[1]
+        version = self.version
+        switches = frozenset(self.nodes())
+        ports = {}
+        for (switch, data) in self.nodes(data=True):
+            for (port_no, port) in data.get('ports', {}).items():
+                if port.linked_to is None:
+                    linked_to = None
+                else:
+                    linked_to = (port.linked_to.switch, port.linked_to.port_no)
+                ports[(switch, port_no)] = (port.config, port.status, linked_to)
+        links = frozenset(frozenset(port_nos.items())
+                          for (s1, s2, port_nos) in self.edges(data=True))
+        fingerprint = (switches, ports, links)
+        self._fingerprint = (version, fingerprint)
+        return fingerprint
+
+    def delta_from(self, old):
+        """
+        The changes that turn old into this topology.
+
+        :param old: an earlier state of the topology
+        :type old: Topology
+        :rtype: TopologyDelta
+        """
+        return TopologyDelta(old.fingerprint(), self.fingerprint())
+
     def __eq__(self,other):
-        def exact_node_match(n1,n2):
-            return n1 == n2
-        def exact_edge_match(e1,e2):
-            return e1 == e2
-        return nx.is_isomorphic(self,other,node_match=exact_node_match,edge_match=exact_edge_match)
+        if not isinstance(other, Topology):
+            return False
+        if self.version == other.version:
+            return True
+        return self.fingerprint() == other.fingerprint()
+
+    def __ne__(self,other):
+        return not self == other
+
+    __hash__ = nx.Graph.__hash__
+
+    def copy(self):
+        copied = super(Topology,self).copy()
+        copied.version = self.version
+        return copied
+
+    ### nx.Graph mutators used on topologies, recording changes
+    def add_node(self, *args, **kwargs):
+        super(Topology,self).add_node(*args, **kwargs)
+        self.touch()
+
+    def add_nodes_from(self, *args, **kwargs):
+        super(Topology,self).add_nodes_from(*args, **kwargs)
+        self.touch()
+
+    def remove_node(self, *args, **kwargs):
+        super(Topology,self).remove_node(*args, **kwargs)
+        self.touch()
+
+    def remove_nodes_from(self, *args, **kwargs):
+        super(Topology,self).remove_nodes_from(*args, **kwargs)
+        self.touch()
+
+    def add_edge(self, *args, **kwargs):
+        super(Topology,self).add_edge(*args, **kwargs)
+        self.touch()
+
+    def add_edges_from(self, *args, **kwargs):
+        super(Topology,self).add_edges_from(*args, **kwargs)
+        self.touch()
+
+    def remove_edge(self, *args, **kwargs):
+        super(Topology,self).remove_edge(*args, **kwargs)
+        self.touch()
+
+    def remove_edges_from(self, *args, **kwargs):
+        super(Topology,self).remove_edges_from(*args, **kwargs)
+        self.touch()
 
     def add_switch(self,switch):
         self.add_node(switch, name=switch, ports={})  
 
     def add_port(self,switch,port_no,config,status):
         self.node[switch]["ports"][port_no] = Port(port_no,config,status)
+        self.touch()
+
+    def update_port(self,switch,port_no,config,status):
+        port = self.node[switch]["ports"][port_no]
+        port.config = config
+        port.status = status
+        self.touch()
+
+    def remove_port(self,switch,port_no):
+        del self.node[switch]["ports"][port_no]
+        self.touch()
+
+    def set_linked_to(self,loc,linked_to):
+        self.node[loc.switch]['ports'][loc.port_no].linked_to = linked_to
+        self.touch()
 
     def add_link(self,loc1,loc2):
         self.add_edge(loc1.switch, loc2.switch, {loc1.switch: loc1.port_no, loc2.switch: loc2.port_no})
-        self.node[loc1.switch]['ports'][loc1.port_no].linked_to = loc2
-        self.node[loc2.switch]['ports'][loc2.port_no].linked_to = loc1
+        self.set_linked_to(loc1,loc2)
+        self.set_linked_to(loc2,loc1)
 
     def is_connected(self):
         return nx.is_connected(self)
@@ -311,6 +775,7 @@ class Topology(nx.Graph):
             except: 
                 # no edge to copy
                 pass
+        self.touch()
 
     ### TAKES A TRANSFORMED TOPOLOGY AND UPDATES ITS ATTRIBUTES
     def reconcile_attributes(self,initial_topo,new_egress=False):
@@ -335,6 +800,7 @@ class Topology(nx.Graph):
                             self.node[loc.switch]['ports'] = new_port_nos
                     except KeyError:
                         pass                # node removed
+        self.touch()
 
     def filter_nodes(self, switches=[]):
         remove = [ s for s in self.nodes() if not s in switches] 
@@ -7,7 +7,7 @@ from ryu.lib        import addrconv
 from pyretic.core import util
 from pyretic.core.network import IPAddr, EthAddr
 
-__all__ = ['of_field', 'of_fields', 'get_packet_processor', 'Packet']
+__all__ = ['of_field', 'of_fields', 'get_packet_processor', 'Packet', 'LazyHeader']
 _field_list = dict()
 
 IPV4 = 0x0800
@@ -490,6 +490,101 @@ class ArpSrcMac(object): pass
 class ArpDstMac(object): pass
 
 
+################################################################################
+# Lazy headers
+################################################################################
+_ETHTYPE = struct.Struct('!H')
+_IPV4 = struct.Struct('!BBH')
+_PORTS = struct.Struct('!HH')
+# smallest header each parser accepts
+_IPV4_LEN = 20
+_L4_LEN = { TCP_PROTO : 20, UDP_PROTO : 8 }
+
+def transport_ports(frame):
+    """
+    Read the TCP/UDP ports straight out of an Ethernet frame, agreeing with
+    what the full decode would produce.  Only untagged or singly tagged
+    IPv4 frames are handled; anything else returns None.
+
+    :param frame: the raw frame
+    :type frame: memoryview
+    :rtype: (int, int) or None
+    """
+    offset = 14
+    if len(frame) < offset:
+        return None
+    (ethtype,) = _ETHTYPE.unpack_from(frame, 12)
+    if ethtype == VLAN:
+        offset += 4
+        if len(frame) < offset:
+            return None
+        (ethtype,) = _ETHTYPE.unpack_from(frame, offset - 2)
+    if ethtype != IPV4 or len(frame) - offset < _IPV4_LEN:
+        return None
+    (version_ihl, tos, total_length) = _IPV4.unpack_from(frame, offset)
+    proto = ord(frame[offset + 9])
+    if not proto in _L4_LEN:
+        return None
+    start = offset + (version_ihl & 0xf) * 4
+    end = offset + min(total_length, len(frame) - offset)
+    if end - start < _L4_LEN[proto]:
+        return None
+    return _PORTS.unpack_from(frame, start)
+
+
+class LazyHeader(util.frozendict):
+    """
+    The headers of a packet received from the network, decoded only when
+    needed.  Fields supplied up front (e.g., switch, inport and raw) are
+    available immediately and srcport/dstport are read directly from the
+    raw frame; any other access runs the full decode.  Equality and hashing
+    are those of the fully decoded frozendict.
+
+    :param known: fields known without decoding; must include 'raw'
+    :type known: dict
+    :param decode: returns the complete header dictionary
+    :type decode: function
+    """
+    __slots__ = ['_known', '_decode', '_decoded']
+
+    TRANSPORT_FIELDS = ('srcport', 'dstport')
+
+    def __init__(self, known, decode):
+        self._known = dict(known)
+        self._decode = decode
+        self._decoded = None
+        ports = transport_ports(memoryview(self._known['raw']))
+        if not ports is None:
+            self._known.update(zip(self.TRANSPORT_FIELDS, ports))
+
+    @property
+    def _dict(self):
+        if self._decoded is None:
+            self._decoded = self._decode()
+            self._decode = None
+        return self._decoded
+
+    def update(self, new_dict=None, **kwargs):
+        return util.frozendict(self._dict).update(new_dict, **kwargs)
+
+    def remove(self, ks):
+        return util.frozendict(self._dict).remove(ks)
+
+    def get(self, key, default=None):
+        if key in self._known:
+            return self._known[key]
+        return self._dict.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._known or key in self._dict
+
+    def __getitem__(self, item):
+        try:
+            return self._known[item]
+        except KeyError:
+            return self._dict[item]
+
+
 ################################################################################
 # Packet 
 ################################################################################
@@ -497,7 +592,10 @@ class Packet(object):
     __slots__ = ["header"]
     
     def __init__(self, state={}):
-        self.header = util.frozendict(state)
+        if isinstance(state, LazyHeader):
+            self.header = state
+        else:
+            self.header = util.frozendict(state)
 
     def available_fields(self):
         return self.header.keys()
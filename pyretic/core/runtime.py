@@ -33,12 +33,27 @@ from pyretic.core.language import *
 from pyretic.core.language_tools import *
 from pyretic.core.network import *
 from pyretic.core.packet import *
+from pyretic.core.tracing import tracer
 
-from multiprocessing import Process, Manager, RLock, Lock, Value, Queue, Condition
-import logging, sys, time
+from multiprocessing import RLock, Lock, Value, Queue, Condition
+import logging, sys, time, bisect, threading
+from collections import OrderedDict, deque
+from ipaddr import IPv4Network
 from datetime import datetime
 
 TABLE_MISS_PRIORITY = 0
+PRIORITY_MAX = 60000
+# spacing between freshly allocated rule priorities
+PRIORITY_GAP = 16
+
+# evaluate packet-ins against the compiled policy in interpreted/reactive0 modes
+use_compiled_eval = True
+
+# distinct flow stat matches kept decoded between polls
+FLOW_MATCH_CACHE_SIZE = 65536
+
+# packets whose extended (virtual header) values are kept computed
+EXTENDED_VALUES_CACHE_SIZE = 4096
 
 class Runtime(object):
     """
@@ -55,8 +70,12 @@ class Runtime(object):
     :type mode: string
     :param verbosity: one of low, normal, high, please-make-it-stop
     :type verbosity: string
+    :param batch_window: seconds to gather packet-ins into one batch, 0 to
+        handle each packet-in as it arrives
+    :type batch_window: float
     """
-    def __init__(self, backend, main, kwargs, mode='interpreted', verbosity='normal'):
+    def __init__(self, backend, main, kwargs, mode='interpreted', verbosity='normal',
+                 batch_window=0):
         self.verbosity = self.verbosity_numeric(verbosity)
         self.log = logging.getLogger('%s.Runtime' % __name__)
         self.network = ConcreteNetwork(self)
@@ -68,9 +87,8 @@ class Runtime(object):
         self.policy_lock = RLock()
         self.network_lock = Lock()
         self.switch_lock = Lock()
-        self.vlan_to_extended_values_db = {}
-        self.extended_values_to_vlan_db = {}
-        self.extended_values_lock = RLock()
+        self.vlan_tags = VlanTagAllocator()
+        self.tag_generation = 0
         self.dynamic_sub_pols = set()
         self.in_network_update = False
         self.in_bucket_apply = False
@@ -78,11 +96,21 @@ class Runtime(object):
         self.bucket_triggered_policy_update = False
         self.global_outstanding_queries_lock = Lock()
         self.global_outstanding_queries = {}
-        self.manager = Manager()
         self.old_rules_lock = Lock()
-        self.old_rules = self.manager.list()
+        self.old_rules = []
+        self.installer = InstallWorker()
         self.update_rules_lock = Lock()
         self.update_buckets_lock = Lock()
+        self.bucket_index = {}
+        self.flow_match_cache = {}
+        self.compiled_eval = None
+        self.compiled_eval_failed = False
+        self.mirror_eval = None
+        if batch_window > 0:
+            self.packet_in_batcher = PacketInBatcher(self.handle_packet_in_batch,
+                                                     batch_window)
+        else:
+            self.packet_in_batcher = None
         self.update_dynamic_sub_pols()
 
     def verbosity_numeric(self,verbosity_option):
@@ -104,26 +132,32 @@ class Runtime(object):
         :param concrete_packet: the packet to be interpreted.
         :type limit: payload of an OpenFlow packet_in message.
         """
-        with self.policy_lock:
-            pyretic_pkt = self.concrete2pyretic(concrete_pkt)
+        if not self.packet_in_batcher is None:
+            self.packet_in_batcher.put(concrete_pkt)
+            return
 
-            # find the queries, if any in the policy, that will be evaluated
-            queries,pkts = queries_in_eval((set(),{pyretic_pkt}),self.policy)
+        queries = set()
+        try:
+            with self.policy_lock:
+                pyretic_pkt = self.concrete2pyretic(concrete_pkt)
 
-            # evaluate the policy
-            output = self.policy.eval(pyretic_pkt)
+                # the switch has already forwarded mirrored packets
+                if self.mirrored_copy(pyretic_pkt):
+                    queries = self.policy.track_eval(pyretic_pkt)[1]
+                    self.apply_queries(queries)
+                    return
 
-            # apply the queries whose buckets have received new packets
-            self.in_bucket_apply = True
-            for q in queries:
-                q.apply()
-            self.in_bucket_apply = False
-            
-            # if the query changed the policy, update the controller and switch state
-            if self.bucket_triggered_policy_update:
-                self.update_dynamic_sub_pols()
-                self.update_switch_classifiers()
-                self.bucket_triggered_policy_update = False
+                # try the compiled classifier first; packets whose rule sends
+                # them to the controller may reach queries and take the full
+                # path
+                output = self.classifier_eval(pyretic_pkt)
+                if output is None:
+                    # evaluate the policy, finding the queries that are reached
+                    output,queries = self.policy.track_eval(pyretic_pkt)
+
+                self.apply_queries(queries)
+        finally:
+            self.dispatch_queries(queries)
                     
         # send output of evaluation into the network
         concrete_output = map(self.pyretic2concrete,output)
@@ -134,6 +168,161 @@ class Runtime(object):
         if self.mode == 'reactive0' and not queries:
             self.reactive0_install(pyretic_pkt,output)
 
+    def handle_packet_in_batch(self, concrete_pkts):
+        """
+        The packet interpreter for a batch of packet-ins.  Packets are
+        grouped by the compiled classifier rule they hit and each group is
+        evaluated together; the others are interpreted one at a time.  The
+        queries reached by any packet in the batch are applied once, after
+        the whole batch has been evaluated, and the resulting packet-outs
+        are sent together.
+
+        :param concrete_pkts: the packets to be interpreted.
+        :type concrete_pkts: list of OpenFlow packet_in payloads
+        """
+        results = []
+        with self.policy_lock:
+            queries = set()
+            by_rule = {}
+            for pyretic_pkt in map(self.concrete2pyretic, concrete_pkts):
+                if self.mirrored_copy(pyretic_pkt):
+                    queries |= self.policy.track_eval(pyretic_pkt)[1]
+                    continue
+                rule = self.compiled_rule(pyretic_pkt)
+                if rule is None:
+                    output,pkt_queries = self.policy.track_eval(pyretic_pkt)
+                    queries |= pkt_queries
+                    results.append((pyretic_pkt, output, pkt_queries))
+                else:
+                    by_rule.setdefault(id(rule), (rule, []))[1].append(pyretic_pkt)
+            for (rule, pkts) in by_rule.values():
+                for (pyretic_pkt, output) in zip(pkts, self.rule_eval(rule, pkts)):
+                    results.append((pyretic_pkt, output, set()))
+
+            self.apply_queries(queries)
+        self.dispatch_queries(queries)
+
+        with self.backend.bulk():
+            for (pyretic_pkt, output, pkt_queries) in results:
+                map(self.send_packet, map(self.pyretic2concrete, output))
+                if self.mode == 'reactive0' and not pkt_queries:
+                    self.reactive0_install(pyretic_pkt, output)
+
+    def apply_queries(self, queries):
+        """
+        Apply the queries whose buckets have received new packets, then
+        update the controller and switch state if they changed the policy.
+        """
+        self.in_bucket_apply = True
+        for q in queries:
+            q.apply()
+        self.in_bucket_apply = False
+
+        if self.bucket_triggered_policy_update:
+            self.update_dynamic_sub_pols()
+            self.update_switch_classifiers()
+            self.bucket_triggered_policy_update = False
+
+    def dispatch_queries(self, queries):
+        """
+        Let the applied queries hand off their deferred work; called
+        without the policy lock held.
+        """
+        for q in queries:
+            q.dispatch()
+
+    def classifier_eval(self, pkt):
+        """
+        Evaluates pkt against the compiled classifier of self.policy.
+        Only used in interpreted and reactive0 modes.  Returns None when the
+        packet must instead be interpreted against the policy itself: the
+        policy couldn't be compiled, or the matching rule sends packets to
+        the controller (queries, virtual headers).
+
+        :param pkt: the packet to be evaluated
+        :type pkt: Packet
+        :rtype: set Packet or None
+        """
+        rule = self.compiled_rule(pkt)
+        if rule is None:
+            return None
+        return self.rule_eval(rule, [pkt])[0]
+
+    def compiled_rule(self, pkt):
+        """
+        The rule of the compiled classifier of self.policy that decides
+        pkt, or None if pkt must be interpreted against the policy (see
+        classifier_eval).
+
+        :param pkt: the packet to be evaluated
+        :type pkt: Packet
+        :rtype: Rule or None
+        """
+        if not use_compiled_eval:
+            return None
+        if not self.mode in ['interpreted', 'reactive0']:
+            return None
+        if self.compiled_eval is None:
+            if self.compiled_eval_failed:
+                return None
+            try:
+                self.compiled_eval = CompiledClassifier(self.policy.compile())
+            except Exception:
+                self.log.debug('policy not compilable, interpreting packets')
+                self.compiled_eval_failed = True
+                return None
+        rule = self.compiled_eval.lookup(pkt)
+        if rule is None:
+            return None
+        for act in rule.actions:
+            if not (act == identity or isinstance(act, modify)):
+                return None
+        return rule
+
+    def rule_eval(self, rule, pkts):
+        """
+        Applies the actions of a compiled rule to each of pkts.
+
+        :param rule: a rule returned by compiled_rule
+        :type rule: Rule
+        :param pkts: packets decided by rule
+        :type pkts: list Packet
+        :rtype: list of set Packet
+        """
+        outputs = [set() for pkt in pkts]
+        for act in rule.actions:
+            for (pkt, output) in zip(pkts, outputs):
+                if act == identity:
+                    output.add(pkt)
+                else:
+                    output |= act.eval(pkt)
+        return outputs
+
+    def mirrored_copy(self, pkt):
+        """
+        Whether pkt was copied to the controller by an installed rule that
+        also forwards it in the data plane (see MirrorBucket), so that only
+        the queries it reaches remain to be applied.
+
+        :param pkt: the packet to be evaluated
+        :type pkt: Packet
+        :rtype: bool
+        """
+        mirrors = self.mirror_eval
+        if mirrors is None:
+            return False
+        rule = mirrors.lookup(pkt)
+        if rule is None or Controller in rule.actions:
+            return False
+        for act in rule.actions:
+            if isinstance(act, MirrorBucket):
+                return True
+        return False
+
+    def invalidate_classifier_eval(self):
+        self.compiled_eval = None
+        self.compiled_eval_failed = False
+
 
 #############
 # DYNAMICS  
@@ -149,6 +338,10 @@ class Runtime(object):
             # tag stale classifiers as invalid
             map(lambda p: p.invalidate_classifier(), 
                 on_recompile_path(set(),id(sub_pol),self.policy))
+            self.invalidate_classifier_eval()
+
+            # vlan tags the old policy's packets were sent with may be reused
+            self.release_extended_values()
 
             # if change was driven by a network update, flag
             if self.in_network_update:
@@ -174,6 +367,8 @@ class Runtime(object):
             # if the topology hasn't changed, ignore
             if self.network.topology == self.prev_network.topology:
                 return
+            self.log.debug('topology changed: %s' %
+                           self.network.topology.delta_from(self.prev_network.topology))
 
             # otherwise copy the network object
             self.in_network_update = True
@@ -183,6 +378,7 @@ class Runtime(object):
             with self.policy_lock:
                 for policy in self.dynamic_sub_pols:
                     policy.set_network(self.network)
+                self.invalidate_classifier_eval()
 
                 # FIXME(joshreich) :-)
                 # This is a temporary fix. We need to specialize the check below
@@ -207,16 +403,15 @@ class Runtime(object):
 
         elif self.mode == 'proactive0' or self.mode == 'proactive1':
             classifier = self.policy.compile()
-            self.log.debug(
-                '|%s|\n\t%s\n\t%s\n\t%s\n' % (str(datetime.now()),
-                                              "generate classifier",
-                                              "policy="+repr(self.policy),
-                                              "classifier="+repr(classifier)))
+            tracer.record('compile', value=len(classifier))
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug(
+                    '|%s|\n\t%s\n\t%s\n\t%s\n' % (str(datetime.now()),
+                                                  "generate classifier",
+                                                  "policy="+repr(self.policy),
+                                                  "classifier="+repr(classifier)))
             self.install_classifier(classifier)
 
-            logging.getLogger("netassay.evaluation").critical("CLASSIFIER LEN = " + str(len(classifier)))
-            logging.getLogger("netassay.evaluation").critical("FINISHED UPDATE")
-
 
     def update_dynamic_sub_pols(self):
         """
@@ -420,7 +615,7 @@ class Runtime(object):
                     # DEAL W/ BUG IN OVS ACCEPTING ARP RULES THAT AREN'T ACTUALLY EXECUTED
                     arp_bug = False
                     for action in rule.actions:
-                        if action == Controller or isinstance(action, CountBucket):
+                        if action == Controller or isinstance(action, (CountBucket, MirrorBucket)):
                             pass
                         elif len(action.map) > 1:
                             arp_bug = True
@@ -507,6 +702,7 @@ class Runtime(object):
                 start_update(bucket_list)
                 map(hook_buckets_to_rule, classifier.rules)
                 hook_buckets_to_pull_stats(bucket_list)
+                self.bucket_index = index_buckets(classifier.rules)
                 finish_update(bucket_list)
         
         def remove_buckets(classifier):
@@ -559,36 +755,7 @@ class Runtime(object):
             :returns: the output classifier
             :rtype: Classifier
             """
-            def concretize_rule_actions(rule):
-                def concretize_match(pred):
-                    if pred == false:
-                        return None
-                    elif pred == true:
-                        return {}
-                    elif isinstance(pred, Match):
-                        concrete_match = { k:v for (k,v) in pred.map.items() }
-                        net_to_str = util.network_to_string
-                        for field in ['srcip', 'dstip']:
-                            try:
-                                val = net_to_str(concrete_match[field])
-                                concrete_match.update({field: val})
-                            except KeyError:
-                                pass
-                        return concrete_match
-                def concretize_action(a):
-                    if a == Controller:
-                        return {'outport' : OFPP_CONTROLLER}
-                    elif isinstance(a,modify):
-                        return { k:v for (k,v) in a.map.items() }
-                    else: # default
-                        return a
-                m = concretize_match(rule.match)
-                acts = [concretize_action(a) for a in rule.actions]
-                if m is None:
-                    return None
-                else:
-                    return Rule(m,acts)
-            crs = [concretize_rule_actions(r) for r in classifier.rules]
+            crs = [concretize_rule(r) for r in classifier.rules]
             crs = filter(lambda cr: not cr is None,crs)
             return Classifier(crs)
 
@@ -597,15 +764,6 @@ class Runtime(object):
                 for a in r.actions:
                     if not 'outport' in a:
                         raise TypeError('Invalid rule: concrete actions must have an outport',str(r))  
-            def check_OF_rule_has_compilable_action_list(r):
-                if len(r.actions)<2:
-                    pass
-                else:
-                    moded_fields = set(r.actions[0].keys())
-                    for a in r.actions:
-                        fields = set(a.keys())
-                        if fields - moded_fields:
-                            raise TypeError('Non-compilable rule',str(r))  
             for r in classifier.rules:
                 check_OF_rule_has_outport(r)
                 check_OF_rule_has_compilable_action_list(r)
@@ -660,27 +818,6 @@ class Runtime(object):
 
             return Classifier(specialized_rules)
 
-        def prioritize(classifier):
-            """
-            Add priorities to classifier rules based on their ordering.
-            
-            :param classifier: the input classifer
-            :type classifier: Classifier
-            :returns: the output classifier
-            :rtype: Classifier
-            """
-            priority = {}
-            tuple_rules = list()
-            for rule in classifier.rules:
-                s = rule.match['switch']
-                try:
-                    priority[s] -= 1
-                except KeyError:
-                    priority[s] = 60000
-                tuple_rules.append((rule.match,priority[s],rule.actions))
-            return tuple_rules
-
-
         def optimize(classifier):
             """ Optimize the classifier by removing extra rules """
 
@@ -722,24 +859,31 @@ class Runtime(object):
 
         ### INCREMENTAL UPDATE LOGIC
 
-        def find_same_rule(target, rule_list):
-            if rule_list is None:
-                return None
-            for rule in rule_list:
-                if target[0] == rule[0] and target[1] == rule[1]:
-                    return rule
-            return None
+        def rule_key(rule):
+            """
+            Index key for a concrete (match, priority, actions) rule tuple:
+            the switch, a canonical (order-independent) form of the match,
+            and the priority.
+            """
+            (match, priority, actions) = rule
+            return (match['switch'], frozenset(match.items()), priority)
+
+        def index_rules(rules):
+            return { rule_key(rule) : rule for rule in rules }
 
         def install_diff_rules(classifier):
             """
             Calculate and install the difference between the input classifier
-            and the current switch tables.
+            and the current switch tables.  Rules are compared by
+            (switch, match, priority); those present only in the new
+            classifier are added, those present only in the old are deleted,
+            and those whose actions changed are modified in place.
             
             :param classifier: the input classifer
             :type classifier: Classifier
             """
             with self.old_rules_lock:
-                old_rules = self.old_rules
+                old_index = index_rules(self.old_rules)
                 switch_attrs_tuples = self.network.topology.nodes(data=True)
                 switch_to_attrs = { k : v for (k,v) in switch_attrs_tuples }
                 switches = switch_to_attrs.keys()
@@ -747,52 +891,56 @@ class Runtime(object):
                 classifier = optimize(classifier)
                 classifier = concretize(classifier)
                 classifier = OF_inportize(classifier)
-                new_rules = prioritize(classifier)
+                new_rules = prioritize(classifier, old_index.values())
+                new_index = index_rules(new_rules)
 
                 # calculate diff
                 to_add = list()
-                to_delete = list()
                 to_modify = list()
-                for old in old_rules:
-                    new = find_same_rule(old, new_rules)
-                    if new is None:
-                        to_delete.append(old)
-                    else:
-                        if old[2] != new[2]:
-                            to_modify.append(new)
-    
-                for new in new_rules:
-                    old = find_same_rule(new, old_rules)
+                to_delete = list()
+                for (key, new) in new_index.items():
+                    old = old_index.get(key)
                     if old is None:
                         to_add.append(new)
-    
+                    elif old[2] != new[2]:
+                        to_modify.append(new)
+                for (key, old) in old_index.items():
+                    if not key in new_index and key[0] in switches:
+                        to_delete.append(old)
+
                 # install diff
-                if not to_add is None:
-                    for rule in to_add:
-                        self.install_rule(rule)
-                for rule in to_delete:
-                    if rule[0]['switch'] in switches:
-                        self.delete_rule((rule[0], rule[1]))
+                for rule in to_add:
+                    self.install_rule(rule)
                 for rule in to_modify:
+                    self.modify_rule(rule)
+                for rule in to_delete:
                     self.delete_rule((rule[0], rule[1]))
-                    self.install_rule(rule)
-    
-                # update old_rule
-                del old_rules[0:len(old_rules)]
-                for rule in new_rules:
-                    old_rules.append(rule)
+
+                # update old_rules
+                self.old_rules = new_rules
 
                 for s in switches:
                     self.send_barrier(s)
 
-        ### PROCESS THAT DOES INSTALL
+        ### WORKER THAT DOES INSTALL
 
-        def f(classifier):
-            with self.switch_lock:
+        def mirrored(classifier):
+            for rule in classifier.rules:
+                for act in rule.actions:
+                    if isinstance(act, MirrorBucket):
+                        return True
+            return False
+
+        def f(classifier, mirrors):
+            with self.switch_lock, self.backend.bulk():
                 if self.mode == 'proactive0':
                     nuclear_install(classifier)
                 elif self.mode == 'proactive1':
                     install_diff_rules(classifier)
+            if mirrors is None:
+                self.mirror_eval = None
+            else:
+                self.mirror_eval = CompiledClassifier(mirrors)
 
         # Process classifier to an openflow-compatible format before
         # sending out rule installs
@@ -804,10 +952,10 @@ class Runtime(object):
         # classifier = vlan_specialize(classifier)
         bookkeep_buckets(classifier)
         classifier = remove_buckets(classifier)
+        # what the switches will do, to tell mirrored copies apart
+        mirrors = classifier if mirrored(classifier) else None
 
-        p = Process(target=f,args=(classifier,))
-        p.daemon = True
-        p.start()
+        self.installer.submit('classifier', f, classifier, mirrors)
 
 
 ###################
@@ -854,27 +1002,41 @@ class Runtime(object):
 ####################################
 
     def concrete2pyretic(self,raw_pkt):
-        packet = get_packet_processor().unpack(raw_pkt['raw'])
-        packet['raw'] = raw_pkt['raw']
-        packet['switch'] = raw_pkt['switch']
-        packet['inport'] = raw_pkt['inport']
+        """
+        Wrap a packet-in as a pyretic packet.  The location and raw
+        fields are available immediately; the remaining headers are
+        decoded from the raw frame on first use.
+        """
+        def decode():
+            packet = get_packet_processor().unpack(raw_pkt['raw'])
+            packet['raw'] = raw_pkt['raw']
+            packet['switch'] = raw_pkt['switch']
+            packet['inport'] = raw_pkt['inport']
+
+            def convert(h,val):
+                if h in ['srcmac','dstmac']:
+                    return MAC(val)
+                elif h in ['srcip','dstip']:
+                    return IP(val)
+                else:
+                    return val
+            try:
+                vlan_id = packet['vlan_id']
+                vlan_pcp = packet['vlan_pcp']
+                header = dict(self.decode_extended_values(vlan_id, vlan_pcp).items())
+            except KeyError:
+                header = {}
+            for (h,v) in packet.items():
+                if h in ['vlan_id','vlan_pcp']:
+                    continue
+                elif v is None:
+                    header.pop(h, None)
+                else:
+                    header[h] = convert(h,v)
+            return header
 
-        def convert(h,val):
-            if h in ['srcmac','dstmac']:
-                return MAC(val)
-            elif h in ['srcip','dstip']:
-                return IP(val)
-            else:
-                return val
-        try:
-            vlan_id = packet['vlan_id']
-            vlan_pcp = packet['vlan_pcp']
-            extended_values = self.decode_extended_values(vlan_id, vlan_pcp)
-        except KeyError:
-            extended_values = util.frozendict()       
-        pyretic_packet = Packet(extended_values)
-        d = { h : convert(h,v) for (h,v) in packet.items() if not h in ['vlan_id','vlan_pcp'] }
-        return pyretic_packet.modifymany(d)
+        known = { h : raw_pkt[h] for h in ['switch','inport','raw'] }
+        return Packet(LazyHeader(known, decode))
     def pyretic2concrete(self,packet):
         concrete_packet = {}
         headers         = {}
@@ -920,6 +1082,13 @@ class Runtime(object):
                 (str(priority) + " " + repr(concrete_pred) + " "+ repr(action_list))))
         self.backend.send_install(concrete_pred,priority,action_list)
 
+    def modify_rule(self,(concrete_pred,priority,action_list)):
+        self.log.debug(
+            '|%s|\n\t%s\n\t%s\n' % (str(datetime.now()),
+                "modifying openflow rule:",
+                (str(priority) + " " + repr(concrete_pred) + " "+ repr(action_list))))
+        self.backend.send_modify(concrete_pred,priority,action_list)
+
     def delete_rule(self,(concrete_pred,priority)):
         self.backend.send_delete(concrete_pred,priority)
 
@@ -931,15 +1100,15 @@ class Runtime(object):
 
     def clear_all(self):
         def f():
+            self.mirror_eval = None
             switches = self.network.topology.nodes()
-            for s in switches:
-                self.send_barrier(s)
-                self.send_clear(s)
-                self.send_barrier(s)
-                self.install_rule(({'switch' : s},TABLE_MISS_PRIORITY,[{'outport' : OFPP_CONTROLLER}]))
-        p = Process(target=f)
-        p.daemon = True
-        p.start()
+            with self.backend.bulk():
+                for s in switches:
+                    self.send_barrier(s)
+                    self.send_clear(s)
+                    self.send_barrier(s)
+                    self.install_rule(({'switch' : s},TABLE_MISS_PRIORITY,[{'outport' : OFPP_CONTROLLER}]))
+        self.installer.submit('clear', f)
 
     def request_flow_stats(self,switch):
         self.backend.send_flow_stats_request(switch)
@@ -971,6 +1140,13 @@ class Runtime(object):
         self.network.handle_link_update(s1, p_no1, s2, p_no2)
 
     def handle_flow_stats_reply(self, switch, flow_stats):
+        """
+        Decode the flow stats from switch and hand each bucket waiting on
+        switch the stats of the rules that count traffic for it, found
+        through the index built by bookkeep_buckets.  A rule's match is
+        looked up as reported and then without the inport, which the
+        runtime adds when specializing rules for their outports.
+        """
         def convert(f,val):
             if f == 'match':
                 import ast
@@ -987,26 +1163,61 @@ class Runtime(object):
                 return IP(val)
             else:
                 return val
-        flow_stats = [ { f : convert(f,v) 
-                         for (f,v) in flow_stat.items() }
-                       for flow_stat in flow_stats       ]
-        flow_stats = sorted(flow_stats, key=lambda d: -d['priority'])
-        def flow_stat_str(flow_stat):
-            output = str(flow_stat['priority']) + ':\t' 
-            output += str(flow_stat['match']) + '\n\t->'
-            output += str(flow_stat['actions']) + '\n\t'
-            output += 'packet_count=' + str(flow_stat['packet_count']) 
-            output += '\tbyte_count=' + str(flow_stat['byte_count'])
-            return output
-        self.log.debug(
-            '|%s|\n\t%s\n' % (str(datetime.now()),
-                '\n'.join(['flow table for switch='+repr(switch)] + 
-                    [flow_stat_str(f) for f in flow_stats])))
+        def decode_match(val):
+            # switch tables change little between polls
+            try:
+                return self.flow_match_cache[val]
+            except KeyError:
+                pass
+            if len(self.flow_match_cache) >= FLOW_MATCH_CACHE_SIZE:
+                self.flow_match_cache.clear()
+            match = convert('match', val)
+            key = flow_match_key(match)
+            if 'inport' in match:
+                keys = (key, flow_match_key(match, ['switch', 'inport']))
+            else:
+                keys = (key,)
+            decoded = self.flow_match_cache[val] = (match, keys)
+            return decoded
+        def decode(flow_stat):
+            stat = dict(flow_stat)
+            if 'match' in stat:
+                (stat['match'], stat['keys']) = decode_match(stat['match'])
+            return stat
+        flow_stats = map(decode, flow_stats)
+
+        if self.log.isEnabledFor(logging.DEBUG):
+            def flow_stat_str(flow_stat):
+                output = str(flow_stat['priority']) + ':\t' 
+                output += str(flow_stat['match']) + '\n\t->'
+                output += str(convert('actions', flow_stat['actions'])) + '\n\t'
+                output += 'packet_count=' + str(flow_stat['packet_count']) 
+                output += '\tbyte_count=' + str(flow_stat['byte_count'])
+                return output
+            self.log.debug(
+                '|%s|\n\t%s\n' % (str(datetime.now()),
+                    '\n'.join(['flow table for switch='+repr(switch)] + 
+                        [flow_stat_str(f) for f in
+                         sorted(flow_stats, key=lambda d: -d['priority'])])))
+
         with self.global_outstanding_queries_lock:
-            if switch in self.global_outstanding_queries:
-                for bucket in self.global_outstanding_queries[switch]:
-                    bucket.handle_flow_stats_reply(switch, flow_stats)
-                del self.global_outstanding_queries[switch]
+            buckets = self.global_outstanding_queries.pop(switch, [])
+        if not buckets:
+            return
+        index = self.bucket_index
+        bucket_stats = { id(b) : [] for b in buckets }
+        for stat in flow_stats:
+            for key in stat.get('keys', ()):
+                entry = (switch, key)
+                if not entry in index:
+                    entry = (None, key)
+                if entry in index:
+                    for b in index[entry]:
+                        if id(b) in bucket_stats:
+                            bucket_stats[id(b)].append(stat)
+                    break
+        for bucket in buckets:
+            bucket.handle_flow_stats_reply(switch, bucket_stats[id(bucket)])
             
 
 ##########################
@@ -1014,24 +1225,254 @@ class Runtime(object):
 ##########################
 
     def encode_extended_values(self, extended_values):
-        with self.extended_values_lock:
-            vlan = self.extended_values_to_vlan_db.get(extended_values)
-            if vlan is not None:
-                return vlan
-            r = 1+len(self.extended_values_to_vlan_db) #VLAN ZERO IS RESERVED
-            pcp = r & 0b111000000000000
-            vid = r & 0b000111111111111
-            self.extended_values_to_vlan_db[extended_values] = (vid, pcp)
-            self.vlan_to_extended_values_db[(vid, pcp)] = extended_values
-            return (vid, pcp)
-        
+        """
+        The (vlan_id, vlan_pcp) tag carrying extended_values, held for the
+        current policy.
+        """
+        return self.vlan_tags.acquire(extended_values, self.tag_generation)
+
     def decode_extended_values(self, vid, pcp):
-        with self.extended_values_lock:
-            extended_values = self.vlan_to_extended_values_db.get((vid, pcp))
-            assert extended_values is not None, "use of vlan that pyretic didn't allocate! not allowed."
-            return extended_values
+        """
+        The extended values a tag carries.  Raises KeyError for tags
+        pyretic did not allocate, or has since reused.
+        """
+        extended_values = self.vlan_tags.decode(vid, pcp)
+        if extended_values is None:
+            self.log.debug('packet tagged with unallocated vlan %s, pcp %s' %
+                           (vid, pcp))
+            raise KeyError((vid, pcp))
+        return extended_values
+
+    def release_extended_values(self):
+        """
+        Release the tags held for the packets of the current policy, which
+        is being replaced; tags the new policy also uses are taken again.
+        """
+        generation = self.tag_generation
+        self.tag_generation += 1
+        self.vlan_tags.release(generation)
+
+def prioritize(classifier, old_rules=None):
+    """
+    Add priorities to classifier rules based on their ordering.
+    Priorities are handed out with gaps between them.  A rule whose
+    match is already installed keeps its old priority wherever that
+    is consistent with the new ordering, and other rules are placed
+    in the gaps around it; a switch's priorities are only reallocated
+    when a gap runs out.
+    
+    :param classifier: the input classifer
+    :type classifier: Classifier
+    :param old_rules: the currently installed rules
+    :type old_rules: list of (match, priority, actions) tuples
+    :returns: the prioritized rules
+    :rtype: list of (match, priority, actions) tuples
+    """
+    def spread(hi, lo, count):
+        """
+        count decreasing priorities strictly between hi and lo,
+        or None if they don't fit.
+        """
+        step = min(PRIORITY_GAP, (hi - lo) // (count + 1))
+        if step < 1:
+            return None
+        return [hi - step * (i + 1) for i in range(count)]
 
-@util.cached
+    def anchors(claimed):
+        """
+        Indices of the longest run of rules whose old priorities
+        are still strictly decreasing in classifier order.
+        """
+        tails, tail_prios, parent = [], [], {}
+        for (i, p) in enumerate(claimed):
+            if p is None:
+                continue
+            k = bisect.bisect_left(tail_prios, -p)
+            parent[i] = tails[k-1] if k > 0 else None
+            if k == len(tails):
+                tails.append(i)
+                tail_prios.append(-p)
+            else:
+                tails[k] = i
+                tail_prios[k] = -p
+        keep = set()
+        i = tails[-1] if tails else None
+        while not i is None:
+            keep.add(i)
+            i = parent[i]
+        return keep
+
+    def allocate(rules):
+        claimed = [old_priority.pop(frozenset(rule.match.items()), None)
+                   for rule in rules]
+        keep = anchors(claimed)
+        priorities = [None] * len(rules)
+        hi = PRIORITY_MAX + 1
+        pending = []
+        for i in range(len(rules) + 1):
+            if i < len(rules) and not i in keep:
+                pending.append(i)
+                continue
+            lo = claimed[i] if i < len(rules) else TABLE_MISS_PRIORITY
+            filled = spread(hi, lo, len(pending))
+            if filled is None:
+                # out of room: reallocate the whole switch
+                return (spread(PRIORITY_MAX + 1, TABLE_MISS_PRIORITY,
+                               len(rules)) or
+                        [PRIORITY_MAX - j for j in range(len(rules))])
+            for (j, p) in zip(pending, filled):
+                priorities[j] = p
+            if i < len(rules):
+                priorities[i] = lo
+            hi = lo
+            pending = []
+        return priorities
+
+    old_priority = {}
+    for (match, priority, actions) in old_rules or []:
+        if TABLE_MISS_PRIORITY < priority <= PRIORITY_MAX:
+            old_priority[frozenset(match.items())] = priority
+
+    switch_rules = {}
+    for rule in classifier.rules:
+        switch_rules.setdefault(rule.match['switch'], []).append(rule)
+
+    tuple_rules = list()
+    for rules in switch_rules.values():
+        for (rule, priority) in zip(rules, allocate(rules)):
+            tuple_rules.append((rule.match,priority,rule.actions))
+    return tuple_rules
+
+class MirrorOutput(dict):
+    """
+    The concrete action sending a mirrored copy of a packet to the
+    controller, told apart from ordinary controller outputs.
+    """
+    pass
+
+def concretize_rule(rule):
+    """
+    Convert a classifier rule's match and actions into dictionaries.
+    MirrorBucket actions become a single copy to the controller, sent
+    before any action modifies the packet, unless the rule already sends
+    packets to the controller.
+
+    :param rule: the rule to convert
+    :type rule: Rule
+    :returns: the concrete rule, or None if it matches nothing
+    :rtype: Rule or None
+    """
+    def concretize_match(pred):
+        if pred == false:
+            return None
+        elif pred == true:
+            return {}
+        elif isinstance(pred, Match):
+            concrete_match = { k:v for (k,v) in pred.map.items() }
+            net_to_str = util.network_to_string
+            for field in ['srcip', 'dstip']:
+                try:
+                    val = net_to_str(concrete_match[field])
+                    concrete_match.update({field: val})
+                except KeyError:
+                    pass
+            return concrete_match
+    def concretize_action(a):
+        if a == Controller:
+            return {'outport' : OFPP_CONTROLLER}
+        elif isinstance(a,modify):
+            return { k:v for (k,v) in a.map.items() }
+        else: # default
+            return a
+    def concretize_mirrors(mirrors):
+        lens = [b.max_len for b in mirrors]
+        if None in lens:
+            return MirrorOutput(outport=OFPP_CONTROLLER)
+        return MirrorOutput(outport=OFPP_CONTROLLER, max_len=max(lens))
+    m = concretize_match(rule.match)
+    if m is None:
+        return None
+    mirrors = [a for a in rule.actions if isinstance(a, MirrorBucket)]
+    acts = [concretize_action(a) for a in rule.actions
+            if not isinstance(a, MirrorBucket)]
+    # the controller already gets the whole packet from a Controller action
+    if mirrors and not Controller in rule.actions:
+        acts.insert(0, concretize_mirrors(mirrors))
+    return Rule(m,acts)
+
+def check_OF_rule_has_compilable_action_list(r):
+    """
+    Raise TypeError if the concrete rule's actions modify different
+    fields, which a single OpenFlow action list can't express.  A mirrored
+    copy goes first and modifies nothing, so it is left out.
+    """
+    actions = list(r.actions)
+    if actions and isinstance(actions[0], MirrorOutput):
+        actions = actions[1:]
+    if len(actions)<2:
+        return
+    moded_fields = set(actions[0].keys())
+    for a in actions:
+        fields = set(a.keys())
+        if fields - moded_fields:
+            raise TypeError('Non-compilable rule',str(r))  
+
+def index_buckets(rules):
+    """
+    Map each rule's switch and match key to the buckets counting its
+    traffic.  Rules that do not match on the switch are indexed under a
+    switch of None and apply to every switch.  The rule with the highest
+    priority wins when several have the same match on a switch.
+
+    :param rules: classifier rules, highest priority first
+    :type rules: list Rule
+    :rtype: dict from (switch, frozenset) to list CountBucket
+    """
+    index = {}
+    for rule in rules:
+        if rule.match == identity:
+            fields = {}
+        elif isinstance(rule.match, Match):
+            fields = rule.match.map
+        else:
+            continue
+        key = flow_match_key(fields)
+        if (None, key) in index:
+            continue
+        entry = (fields.get('switch'), key)
+        if entry in index:
+            continue
+        index[entry] = [act for act in rule.actions
+                        if isinstance(act, CountBucket)]
+    return index
+
+def flow_match_key(match, ignore=['switch']):
+    """
+    A canonical key for the match of a flow table entry, comparable
+    between pyretic matches and the matches switches report in flow
+    stats.  Switches report IP addresses without their prefix length, so
+    IP fields are keyed on the network address alone.
+
+    :param match: header fields to values
+    :type match: dict
+    :param ignore: fields left out of the key
+    :type ignore: list string
+    :rtype: frozenset
+    """
+    key = []
+    for (field, val) in match.items():
+        if field in ignore:
+            continue
+        if isinstance(val, IPv4Network):
+            val = str(val.network)
+        elif field in ['srcip', 'dstip']:
+            val = str(val)
+        elif field in ['srcmac', 'dstmac']:
+            val = str(val)
+        key.append((field, val))
+    return frozenset(key)
+
+@util.lru_cached(EXTENDED_VALUES_CACHE_SIZE)
 def extended_values_from(packet):
     extended_values = {}
     for k, v in packet.header.items():
@@ -1040,11 +1481,396 @@ def extended_values_from(packet):
     return util.frozendict(extended_values)
 
 
+class TagSpaceExhausted(RuntimeError):
+    pass
+
+
+class VlanTagAllocator(object):
+    """
+    Assigns the (vlan_id, vlan_pcp) tags that carry extended (virtual
+    header) values on the wire.  Each tag is reference counted by the
+    holders using it; once no holder does, it becomes reclaimable.  A
+    reclaimable tag still decodes to its old values until the never-used
+    tags run out and it is reused, oldest released first, so packets
+    already in flight decode for as long as possible.  VLAN ids 0 and
+    0xFFF are reserved by 802.1Q and never handed out.
+    """
+    VIDS = 4094
+    PCPS = 8
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.size = self.VIDS * self.PCPS
+        self.fresh = 0                  # tags below this have been used
+        self.to_tag = {}                # extended values -> tag
+        self.to_values = {}             # tag -> extended values
+        self.holders = {}               # tag -> holders using it
+        self.held = {}                  # holder -> tags it uses
+        self.reclaimable = OrderedDict()
+        self.allocations = 0
+        self.reclaims = 0
+
+    def acquire(self, extended_values, holder):
+        """
+        The tag for extended_values, allocating one if needed, and
+        counted as used by holder.
+
+        :rtype: (int, int)
+        """
+        with self.lock:
+            tag = self.to_tag.get(extended_values)
+            if tag is None:
+                tag = self._allocate(extended_values)
+            self.reclaimable.pop(tag, None)
+            self.holders.setdefault(tag, set()).add(holder)
+            self.held.setdefault(holder, set()).add(tag)
+            return (1 + tag % self.VIDS, tag // self.VIDS)
+
+    def _allocate(self, extended_values):
+        if self.fresh < self.size:
+            tag = self.fresh
+            self.fresh += 1
+        elif self.reclaimable:
+            (tag, _) = self.reclaimable.popitem(last=False)
+            del self.to_tag[self.to_values.pop(tag)]
+            self.reclaims += 1
+        else:
+            raise TagSpaceExhausted('all %d vlan tags in use' % self.size)
+        self.to_tag[extended_values] = tag
+        self.to_values[tag] = extended_values
+        self.allocations += 1
+        return tag
+
+    def release(self, holder):
+        """Stop counting the tags holder used as used by it."""
+        with self.lock:
+            for tag in self.held.pop(holder, ()):
+                holders = self.holders[tag]
+                holders.discard(holder)
+                if not holders:
+                    del self.holders[tag]
+                    self.reclaimable[tag] = None
+
+    def decode(self, vid, pcp):
+        """The extended values tagged (vid, pcp), or None."""
+        if not 1 <= vid <= self.VIDS or not 0 <= pcp < self.PCPS:
+            return None
+        with self.lock:
+            return self.to_values.get((vid - 1) + pcp * self.VIDS)
+
+    def stats(self):
+        with self.lock:
+            in_use = len(self.holders)
+            return {'size' : self.size,
+                    'in_use' : in_use,
+                    'reclaimable' : len(self.reclaimable),
+                    'never_used' : self.size - self.fresh,
+                    'utilization' : in_use / float(self.size),
+                    'allocations' : self.allocations,
+                    'reclaims' : self.reclaims}
+
+
 ################################################################################
 # Concrete Network
 ################################################################################
 
-import threading 
+class PacketInBatcher(object):
+    """
+    Gathers packet-ins arriving within window seconds of the first one,
+    up to max_size of them, and hands them to handle_batch together from
+    a dedicated thread.  At most max_pending packet-ins wait to be
+    batched; what happens to one arriving when that many are waiting
+    depends on overflow, as for util.BoundedWorkQueue:
+
+    - 'drop-oldest': the oldest waiting packet-in is discarded
+    - 'block': the caller waits for room
+
+    :param handle_batch: called with each list of packet-ins
+    :type handle_batch: function
+    :param window: seconds to wait for more packet-ins
+    :type window: float
+    :param max_size: largest batch
+    :type max_size: int
+    :param max_pending: the most packet-ins waiting to be batched
+    :type max_pending: int
+    :param overflow: one of OVERFLOW_POLICIES
+    :type overflow: string
+    :param start: whether to start the batching thread
+    :type start: bool
+    """
+    OVERFLOW_POLICIES = ['drop-oldest', 'block']
+
+    def __init__(self, handle_batch, window, max_size=256, max_pending=4096,
+                 overflow='drop-oldest', start=True):
+        if not overflow in self.OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy %s' % overflow)
+        self.handle_batch = handle_batch
+        self.window = window
+        self.max_size = max_size
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.log = logging.getLogger('%s.PacketInBatcher' % __name__)
+        self.cond = threading.Condition()
+        self.pending = deque()
+        self.received = 0
+        self.dropped = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        if start:
+            self.thread.start()
+
+    def put(self, concrete_pkt):
+        with self.cond:
+            self.received += 1
+            if len(self.pending) >= self.max_pending:
+                if self.overflow == 'block':
+                    while len(self.pending) >= self.max_pending:
+                        self.cond.wait()
+                else:
+                    self.pending.popleft()
+                    self.dropped += 1
+            self.pending.append(concrete_pkt)
+            self.cond.notify_all()
+
+    def next_batch(self):
+        """
+        Wait for a packet-in, then for the window to pass or the batch to
+        fill up, and take the batch.
+
+        :rtype: list of packet-ins
+        """
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            deadline = time.time() + self.window
+            while len(self.pending) < self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            size = min(self.max_size, len(self.pending))
+            batch = [self.pending.popleft() for i in xrange(size)]
+            self.batches += 1
+            self.cond.notify_all()
+            return batch
+
+    def stats(self):
+        """
+        Packet-ins received, waiting and dropped, and batches taken.
+
+        :rtype: dict
+        """
+        with self.cond:
+            return { 'received' : self.received,
+                     'pending' : len(self.pending),
+                     'dropped' : self.dropped,
+                     'batches' : self.batches }
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                self.handle_batch(batch)
+            except Exception:
+                self.log.exception('failed to handle batch of %d packet-ins' %
+                                   len(batch))
+
+
+class InstallWorker(object):
+    """
+    A long-lived thread that performs switch table updates for the runtime,
+    one at a time and in the order they were submitted.  Each update gets
+    a version number; a pending update that has not started yet is dropped
+    when a newer update of the same kind is submitted, so a burst of policy
+    changes installs only the last classifier.
+    """
+    def __init__(self):
+        self.log = logging.getLogger('%s.InstallWorker' % __name__)
+        self.cond = threading.Condition()
+        self.pending = []
+        self.version = 0
+        self.installed_version = 0
+        self.installs = 0
+        self.coalesced = 0
+        self.last_latency = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, kind, f, *args):
+        """
+        Queue an update, replacing any pending update of the same kind.
+
+        :param kind: the kind of update, e.g., 'classifier'
+        :type kind: string
+        :param f: the function performing the update
+        :type f: function
+        :returns: the version assigned to this update
+        :rtype: int
+        """
+        with self.cond:
+            self.version += 1
+            superseded = [u for u in self.pending if u[1] == kind]
+            for u in superseded:
+                self.pending.remove(u)
+            self.coalesced += len(superseded)
+            self.pending.append((self.version, kind, time.time(), f, args))
+            self.cond.notify_all()
+            return self.version
+
+    def wait(self, version, timeout=None):
+        """
+        Block until the update with the given version (or a newer one) has
+        been installed.  Returns whether it was.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self.installed_version < version:
+                remaining = None if deadline is None else deadline - time.time()
+                if not remaining is None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                (version, kind, submitted, f, args) = self.pending.pop(0)
+            started = time.time()
+            try:
+                f(*args)
+            except Exception:
+                self.log.exception('%s update %d failed' % (kind, version))
+            finished = time.time()
+            with self.cond:
+                self.installed_version = version
+                self.installs += 1
+                self.last_latency = finished - submitted
+                self.cond.notify_all()
+            tracer.record('flow_mods_sent', value=kind)
+            self.log.debug('%s update %d: queued %.3fs, installed in %.3fs',
+                           kind, version, started - submitted,
+                           finished - started)
+
+
+
+class TopologyUpdateWorker(object):
+    """
+    A long-lived thread that turns bursts of topology events into single
+    network updates.  An update runs once no event has arrived for the
+    debounce window, or once the oldest event it covers is max_latency old,
+    whichever comes first, so a switch joining with many ports, or a round
+    of LLDP, produces one update rather than one per event.
+
+    :param f: applies an update, returning whether anything changed
+    :type f: function
+    :param debounce: seconds without events before updating
+    :type debounce: float
+    :param max_latency: the most seconds an event waits for its update
+    :type max_latency: float
+    :param clock: returns the current time in seconds
+    :type clock: function
+    :param start: whether to start the update thread
+    :type start: bool
+    """
+    def __init__(self, f, debounce=0.25, max_latency=2.0, clock=time.time,
+                 start=True):
+        self.log = logging.getLogger('%s.TopologyUpdateWorker' % __name__)
+        self.f = f
+        self.debounce = debounce
+        self.max_latency = max_latency
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.first_event = None
+        self.last_event = None
+        self.events = 0
+        self.updates = 0
+        self.unchanged = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        if start:
+            self.thread.start()
+
+    def event(self):
+        """Record a topology event, (re)starting the debounce window."""
+        with self.cond:
+            now = self.clock()
+            self.events += 1
+            if self.first_event is None:
+                self.first_event = now
+            self.last_event = now
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {'events' : self.events,
+                    'updates' : self.updates,
+                    'unchanged' : self.unchanged}
+
+    def due(self):
+        """
+        When the pending update should run, or None if no event is pending.
+        Called with self.cond held.
+        """
+        if self.first_event is None:
+            return None
+        return min(self.last_event + self.debounce,
+                   self.first_event + self.max_latency)
+
+    def poll(self):
+        """
+        Run the pending update if it is due.  Returns whether it ran.
+        """
+        with self.cond:
+            due = self.due()
+            if due is None or self.clock() < due:
+                return False
+        return self.flush()
+
+    def flush(self):
+        """
+        Run the pending update now, covering every event recorded so far.
+        Returns whether there was one to run.
+        """
+        with self.cond:
+            if self.first_event is None:
+                return False
+            waited = self.clock() - self.first_event
+            self.first_event = None
+            self.last_event = None
+        try:
+            changed = self.f()
+        except Exception:
+            self.log.exception('topology update failed')
+            return True
+        with self.cond:
+            if changed:
+                self.updates += 1
+            else:
+                self.unchanged += 1
+            events = self.events
+            updates = self.updates
+        self.log.debug('topology update after %.3fs: %d events, %d updates' %
+                       (waited, events, updates))
+        return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    due = self.due()
+                    if due is None:
+                        self.cond.wait()
+                        continue
+                    remaining = due - self.clock()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            self.flush()
+
 
 class ConcreteNetwork(Network):
     def __init__(self,runtime=None):
@@ -1052,8 +1878,10 @@ class ConcreteNetwork(Network):
         self.next_topo = self.topology.copy()
         self.runtime = runtime
         self.wait_period = 0.25
-        self.update_no_lock = threading.Lock()
-        self.update_no = 0
+        self.max_update_latency = 2.0
+        self.update_worker = TopologyUpdateWorker(self.apply_update,
+                                                  self.wait_period,
+                                                  self.max_update_latency)
         self.log = logging.getLogger('%s.ConcreteNetwork' % __name__)
         self.debug_log = logging.getLogger('%s.DEBUG_TOPO_DISCOVERY' % __name__)
         self.debug_log.setLevel(logging.DEBUG)
@@ -1066,23 +1894,19 @@ class ConcreteNetwork(Network):
     # Topology Detection
     #
 
-    def queue_update(self,this_update_no):
-        def f(this_update_no):
-            time.sleep(self.wait_period)
-            with self.update_no_lock:
-                if this_update_no != self.update_no:
-                    return
-
-            self.topology = self.next_topo.copy()
-            self.runtime.handle_network_change()
+    def queue_update(self):
+        self.update_worker.event()
 
-        p = threading.Thread(target=f,args=(this_update_no,))
-        p.start()
-
-    def get_update_no(self):
-        with self.update_no_lock:
-            self.update_no += 1
-            return self.update_no
+    def apply_update(self):
+        """
+        Make the topology built up from events the current one.  Returns
+        whether it differed from the current topology.
+        """
+        if self.next_topo == self.topology:
+            return False
+        self.topology = self.next_topo.copy()
+        self.runtime.handle_network_change()
+        return True
            
     def inject_discovery_packet(self, dpid, port_no):
         self.runtime.inject_discovery_packet(dpid, port_no)
@@ -1104,11 +1928,11 @@ class ConcreteNetwork(Network):
                 pass  # ALREADY REMOVED
             # UNLINK LINKED_TO PORT
             try:      
-                self.next_topo.node[port.linked_to.switch]["ports"][port.linked_to.port_no].linked_to = None
+                self.next_topo.set_linked_to(port.linked_to, None)
             except KeyError:
                 pass  # LINKED TO PORT ALREADY DELETED
             # UNLINK SELF
-            self.next_topo.node[location.switch]["ports"][location.port_no].linked_to = None
+            self.next_topo.set_linked_to(location, None)
         
     def handle_switch_part(self, switch):
         self.log.info("OpenFlow switch %s disconnected" % switch)
@@ -1118,24 +1942,23 @@ class ConcreteNetwork(Network):
             self.remove_associated_link(Location(switch,port_no))
         self.next_topo.remove_node(switch)
         self.debug_log.debug(str(self.next_topo))
-        self.queue_update(self.get_update_no())
+        self.queue_update()
         
     def handle_port_join(self, switch, port_no, config, status):
         self.debug_log.debug("handle_port_joins %s:%s:%s:%s" % (switch, port_no, config, status))
-        this_update_no = self.get_update_no()
         self.next_topo.add_port(switch,port_no,config,status)
         if config or status:
             self.inject_discovery_packet(switch,port_no)
             self.debug_log.debug(str(self.next_topo))
-            self.queue_update(this_update_no)
+            self.queue_update()
             
     def handle_port_part(self, switch, port_no):
         self.debug_log.debug("handle_port_parts")
         try:
             self.remove_associated_link(Location(switch,port_no))
-            del self.next_topo.node[switch]["ports"][port_no]
+            self.next_topo.remove_port(switch, port_no)
             self.debug_log.debug(str(self.next_topo))
-            self.queue_update(self.get_update_no())
+            self.queue_update()
         except KeyError:
             pass  # THE SWITCH HAS ALREADY BEEN REMOVED BY handle_switch_parts
         
@@ -1151,8 +1974,7 @@ class ConcreteNetwork(Network):
             return
 
         # UPDATE VALUES
-        self.next_topo.node[switch]["ports"][port_no].config = config
-        self.next_topo.node[switch]["ports"][port_no].status = status
+        self.next_topo.update_port(switch, port_no, config, status)
 
         # DETERMINE IF/WHAT CHANGED
         if (prev_config and not config):
@@ -1164,18 +1986,17 @@ class ConcreteNetwork(Network):
             self.port_up(switch, port_no)
 
     def port_up(self, switch, port_no):
-        this_update_no = self.get_update_no()
         self.debug_log.debug("port_up %s:%s" % (switch,port_no))
         self.inject_discovery_packet(switch,port_no)
         self.debug_log.debug(str(self.next_topo))
-        self.queue_update(this_update_no)
+        self.queue_update()
 
     def port_down(self, switch, port_no, double_check=False):
         self.debug_log.debug("port_down %s:%s:double_check=%s" % (switch,port_no,double_check))
         try:
             self.remove_associated_link(Location(switch,port_no))
             self.debug_log.debug(str(self.next_topo))
-            self.queue_update(self.get_update_no())
+            self.queue_update()
             if double_check: self.inject_discovery_packet(switch,port_no)
         except KeyError:  
             pass  # THE SWITCH HAS ALREADY BEEN REMOVED BY handle_switch_parts
@@ -1214,10 +2035,8 @@ class ConcreteNetwork(Network):
         
         # ADD LINK IF PORTS ARE UP
         if p1.possibly_up() and p2.possibly_up():
-            self.next_topo.node[s1]["ports"][p_no1].linked_to = Location(s2,p_no2)
-            self.next_topo.node[s2]["ports"][p_no2].linked_to = Location(s1,p_no1)   
-            self.next_topo.add_edge(s1, s2, {s1: p_no1, s2: p_no2})
+            self.next_topo.add_link(Location(s1,p_no1), Location(s2,p_no2))
             
         # IF REACHED, WE'VE REMOVED AN EDGE, OR ADDED ONE, OR BOTH
         self.debug_log.debug(self.next_topo)
-        self.queue_update(self.get_update_no())
+        self.queue_update()
@@ -0,0 +1,172 @@
+################################################################################
+# Evaluation tracing                                                           #
+################################################################################
+"""
+Records timestamped events in a preallocated ring buffer, for evaluating
+how long rule changes take to reach the switches.  Events are recorded
+against the serial number of the rule change they belong to; stages that
+are not tied to one rule change (compiling, sending flow mods) are
+recorded without a serial and attributed to every rule change waiting on
+them when spans are built.
+
+Tracing is off by default, and recording then costs one attribute check:
+
+    from pyretic.core.tracing import tracer
+    tracer.enable()
+    ...
+    tracer.export_csv('spans.csv')
+"""
+
+import csv
+import itertools
+import json
+import sys
+import threading
+import time
+
+# stages of a rule change, in order
+STAGES = ['add', 'remove', 'install', 'uninstall', 'update_rules',
+          'compile', 'flow_mods_sent']
+
+# stages recorded once for all the rule changes waiting on them
+SHARED_STAGES = ['compile', 'flow_mods_sent']
+
+
+def _monotonic_clock():
+    try:
+        return time.monotonic
+    except AttributeError:
+        pass
+    # CLOCK_MONOTONIC is 1 on Linux only
+    if not sys.platform.startswith('linux'):
+        return time.time
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or
+                            ctypes.util.find_library('c'))
+        clock_gettime = librt.clock_gettime
+        CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            t = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                return time.time()
+            return t.tv_sec + t.tv_nsec * 1e-9
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            return time.time
+        return monotonic
+    except Exception:
+        return time.time
+
+monotonic = _monotonic_clock()
+
+
+class Tracer(object):
+    """
+    A ring buffer of (time, serial, event, value) records.  Once full, the
+    oldest records are overwritten.
+
+    :param capacity: the number of records kept
+    :type capacity: int
+    """
+    def __init__(self, capacity=65536):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self.times = [0.0] * capacity
+        self.serials = [None] * capacity
+        self.events = [None] * capacity
+        self.values = [None] * capacity
+        self.recorded = 0
+
+    def enable(self, capacity=None):
+        with self.lock:
+            if not capacity is None and capacity != self.capacity:
+                self._allocate(capacity)
+            self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self.lock:
+            self._allocate(self.capacity)
+
+    def record(self, event, serial=None, value=None):
+        """
+        Record event for the rule change with the given serial, or for
+        all waiting rule changes if serial is None.
+        """
+        if not self.enabled:
+            return
+        now = monotonic()
+        with self.lock:
+            slot = self.recorded % self.capacity
+            self.recorded += 1
+            self.times[slot] = now
+            self.serials[slot] = serial
+            self.events[slot] = event
+            self.values[slot] = value
+
+    def records(self):
+        """The records still in the buffer, oldest first."""
+        with self.lock:
+            count = min(self.recorded, self.capacity)
+            start = self.recorded - count
+            slots = [i % self.capacity
+                     for i in xrange(start, self.recorded)]
+            return [(self.times[i], self.serials[i], self.events[i],
+                     self.values[i]) for i in slots]
+
+    def spans(self):
+        """
+        The time of each stage of each rule change, as a dict from serial
+        to a dict from stage to time.  A shared stage is attributed to the
+        rule changes that had reached update_rules but not that stage.
+        """
+        spans = {}
+        waiting = dict((stage, []) for stage in SHARED_STAGES)
+        for (t, serial, event, value) in self.records():
+            if serial is None:
+                if event in waiting:
+                    for s in waiting[event]:
+                        spans[s].setdefault(event, t)
+                    waiting[event] = []
+                continue
+            span = spans.setdefault(serial, {})
+            span.setdefault(event, t)
+            if event == 'update_rules':
+                for stage in SHARED_STAGES:
+                    waiting[stage].append(serial)
+        return spans
+
+    def export_csv(self, path):
+        """Write one row per rule change, one column per stage."""
+        spans = self.spans()
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['serial'] + STAGES)
+            for serial in sorted(spans):
+                span = spans[serial]
+                writer.writerow([serial] + ['' if not stage in span
+                                            else '%.6f' % span[stage]
+                                            for stage in STAGES])
+
+    def export_json(self, path):
+        """Write the spans and the raw records."""
+        with open(path, 'w') as f:
+            json.dump({'spans' : dict((str(serial), span) for (serial, span)
+                                      in self.spans().items()),
+                       'records' : self.records()}, f)
+
+
+tracer = Tracer()
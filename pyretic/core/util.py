@@ -35,7 +35,8 @@ from functools import wraps
 
 from multiprocessing import Lock
 from logging import StreamHandler
-import sys
+from collections import deque, OrderedDict
+import logging, random, sys, threading, time
 from ipaddr import IPv4Network, AddressValueError, IPv4Address
 
 
@@ -53,6 +54,32 @@ def cached(f):
     wrapper.cache = {}
     return wrapper
 
+def lru_cached(size):
+    """
+    Like cached, but keeps only the results for the size most recently
+    used arguments.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args):
+            with wrapper.lock:
+                try:
+                    v = wrapper.cache.pop(args)
+                    wrapper.cache[args] = v
+                    return v
+                except KeyError:
+                    pass
+            v = f(*args)
+            with wrapper.lock:
+                wrapper.cache[args] = v
+                while len(wrapper.cache) > size:
+                    wrapper.cache.popitem(last=False)
+            return v
+        wrapper.cache = OrderedDict()
+        wrapper.lock = threading.Lock()
+        return wrapper
+    return decorator
+
 class frozendict(object):
     __slots__ = ["_dict", "_cached_hash"]
 
@@ -170,6 +197,112 @@ class QueueStreamHandler(StreamHandler):
         '''Acquire the lock before emitting the record.'''
         self.queue.put(record)
 
+class BoundedWorkQueue(object):
+    """
+    A bounded queue whose items are passed to handler by a pool of worker
+    threads.  What happens when an item arrives at a full queue depends on
+    overflow:
+
+    - 'drop-oldest': the oldest queued item is discarded
+    - 'block': the caller waits for room; the caller must not hold locks
+      the handler needs, and there must be workers to make room
+    - 'sample': the queue keeps a uniform sample of the items offered
+      since it filled up
+
+    :param handler: called with each item
+    :type handler: function
+    :param workers: number of worker threads
+    :type workers: int
+    :param max_size: the most items queued at once
+    :type max_size: int
+    :param overflow: one of OVERFLOW_POLICIES
+    :type overflow: string
+    """
+    OVERFLOW_POLICIES = ['drop-oldest', 'block', 'sample']
+
+    def __init__(self, handler, workers=1, max_size=1024, overflow='drop-oldest'):
+        if not overflow in self.OVERFLOW_POLICIES:
+            raise ValueError('unknown overflow policy %s' % overflow)
+        if overflow == 'block' and workers < 1:
+            raise ValueError('block overflow needs at least one worker')
+        self.handler = handler
+        self.max_size = max_size
+        self.overflow = overflow
+        self.log = logging.getLogger('%s.BoundedWorkQueue' % __name__)
+        self.cond = threading.Condition()
+        self.items = deque()
+        self.overflowed = 0
+        self.enqueued = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def put(self, item):
+        with self.cond:
+            self.enqueued += 1
+            entry = (time.time(), item)
+            if len(self.items) < self.max_size:
+                self.overflowed = 0
+            elif self.overflow == 'block':
+                while len(self.items) >= self.max_size:
+                    self.cond.wait()
+            elif self.overflow == 'drop-oldest':
+                self.items.popleft()
+                self.dropped += 1
+            else:
+                self.overflowed += 1
+                self.dropped += 1
+                j = random.randint(0, self.max_size + self.overflowed - 1)
+                if j < self.max_size:
+                    self.items[j] = entry
+                return
+            self.items.append(entry)
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.items:
+                    self.cond.wait()
+                (queued, item) = self.items.popleft()
+                self.cond.notify_all()
+            try:
+                self.handler(item)
+            except Exception:
+                self.log.exception('handler failed')
+            latency = time.time() - queued
+            with self.cond:
+                self.delivered += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+    def stats(self):
+        """
+        Queue depth, item counts, and the time from being queued to being
+        handled (in seconds).
+
+        :rtype: dict
+        """
+        with self.cond:
+            return { 'depth' : len(self.items),
+                     'max_depth' : self.max_depth,
+                     'enqueued' : self.enqueued,
+                     'delivered' : self.delivered,
+                     'dropped' : self.dropped,
+                     'latency_avg' : (self.latency_total / self.delivered
+                                      if self.delivered else 0.0),
+                     'latency_max' : self.latency_max }
+
+
 def string_to_network(ip_str):
     """ Return an IPv4Network object from a dotted quad IP address/subnet. """
     try:
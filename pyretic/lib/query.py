@@ -26,10 +26,12 @@
 # permissions and limitations under the License.                               #
 ################################################################################
 
-from pyretic.core.language import identity, match, union, DerivedPolicy, DynamicFilter, FwdBucket, Query
+from pyretic.core.language import identity, match, union, DerivedPolicy, DynamicFilter, FwdBucket, MirrorBucket, Query
 import time
 import re
-from threading import Thread
+import heapq
+from collections import deque
+from threading import Thread, Lock
 
 class LimitFilter(DynamicFilter):
     """A DynamicFilter that matches the first limit packets in a specified grouping.
@@ -74,46 +76,176 @@ class packets(DerivedPolicy):
     :type limit: int
     :param group_by: the fields by which to group packets.
     :type group_by: list string
+    :param workers: threads delivering packets to callbacks, 0 to deliver
+        synchronously (see FwdBucket)
+    :type workers: int
+    :param queue_size: the most packets awaiting delivery
+    :type queue_size: int
+    :param overflow: drop-oldest, block or sample
+    :type overflow: string
+    :param mirror: receive copies of packets the switches keep forwarding,
+        instead of the packets themselves (see MirrorBucket)
+    :type mirror: bool
+    :param max_len: bytes of each mirrored packet to copy, None for all
+    :type max_len: int
+    :param sample: fraction of mirrored packets to keep
+    :type sample: float
     """
-    def __init__(self,limit=None,group_by=[]):
-        self.fb = FwdBucket()
+    def __init__(self,limit=None,group_by=[],workers=0,queue_size=1024,
+                 overflow='drop-oldest',mirror=False,max_len=None,sample=1.0):
+        if mirror:
+            self.fb = MirrorBucket(max_len,sample,workers,queue_size,overflow)
+        else:
+            self.fb = FwdBucket(workers,queue_size,overflow)
         self.register_callback = self.fb.register_callback
+        self.delivery_stats = self.fb.delivery_stats
         if limit is None:
             super(packets,self).__init__(self.fb)
         else:
             self.limit_filter = LimitFilter(limit,group_by)
-            self.fb.register_callback(self.limit_filter.update_policy)
+            self.fb.register_callback(self.limit_filter.update_policy,sync=True)
             super(packets,self).__init__(self.limit_filter >> self.fb)
         
     def __repr__(self):
         return "packets\n%s" % repr(self.policy)
 
 
+class SpaceSaving(object):
+    """Approximate per-key totals keeping at most capacity keys (the
+    space-saving algorithm).  When a new key arrives with the table full,
+    it replaces the key with the smallest total and inherits that total, so
+    totals of heavy hitters are overestimated by at most error(key).
+
+    :param capacity: the most keys kept
+    :type capacity: int
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []   # (total, key), possibly stale; totals only grow
+
+    def add(self, key, value):
+        try:
+            self.counts[key] += value
+            return
+        except KeyError:
+            pass
+        if len(self.counts) < self.capacity:
+            floor = 0
+        else:
+            while True:
+                (total, victim) = heapq.heappop(self.heap)
+                if self.counts[victim] == total:
+                    break
+                heapq.heappush(self.heap, (self.counts[victim], victim))
+            floor = self.counts.pop(victim)
+            del self.errors[victim]
+        self.counts[key] = floor + value
+        self.errors[key] = floor
+        heapq.heappush(self.heap, (floor + value, key))
+
+    def error(self, key):
+        return self.errors.get(key, 0)
+
+    def items(self):
+        return self.counts.items()
+
+
+class WindowCounter(object):
+    """Per-group totals over a window of the most recent panes.  Each pane
+    pre-aggregates the values added while it is current; rotating starts a
+    new pane and drops the oldest, so one pane makes a tumbling window and
+    several a sliding one.  Groups are tuple keys.  With max_groups, each
+    pane keeps only its heaviest groups (see SpaceSaving) and the window
+    reports the max_groups heaviest.
+
+    :param panes: the number of panes in the window
+    :type panes: int
+    :param max_groups: the most groups counted per pane, None for all
+    :type max_groups: int
+    """
+    def __init__(self, panes=1, max_groups=None):
+        self.max_groups = max_groups
+        self.lock = Lock()
+        self.panes = deque(maxlen=panes)
+        self.panes.append(self.new_pane())
+
+    def new_pane(self):
+        if self.max_groups is None:
+            return {}
+        return SpaceSaving(self.max_groups)
+
+    def add(self, key, value):
+        with self.lock:
+            pane = self.panes[-1]
+            if self.max_groups is None:
+                pane[key] = pane.get(key, 0) + value
+            else:
+                pane.add(key, value)
+
+    def rotate(self):
+        """
+        Close the current pane and return the window's totals as a dict
+        from group to total.
+        """
+        with self.lock:
+            panes = list(self.panes)
+            self.panes.append(self.new_pane())
+        totals = {}
+        for pane in panes:
+            for (key, value) in pane.items():
+                totals[key] = totals.get(key, 0) + value
+        if not self.max_groups is None and len(totals) > self.max_groups:
+            top = heapq.nlargest(self.max_groups, totals.items(),
+                                 key=lambda kv: kv[1])
+            totals = dict(top)
+        return totals
+
+
 class AggregateFwdBucket(FwdBucket):
     """An abstract FwdBucket which calls back all registered routines every interval
     seconds (can take positive fractional values) with an aggregate value/dict.
     If group_by is empty, registered routines are called back with a single aggregate
     value.  Otherwise, group_by defines the set of headers used to group counts which
-    are then returned as a dictionary."""
+    are then returned as a dictionary keyed on tuples of those headers' values
+    (None for headers a packet lacks), in group_by order.
+
+    Each report covers the window seconds before it (the last interval by
+    default) and is a snapshot: packets are counted in a new window as soon as
+    it is taken.  Aggregators must be additive, as each packet adds
+    aggregator(0,pkt) to its group.
+
+    :param window: seconds covered by each report, a multiple of interval
+    :type window: float
+    :param max_groups: the most groups counted, None for all; bounds memory
+        for unbounded group_by at the cost of approximate counts
+    :type max_groups: int
+    """
     ### init : int -> List String
-    def __init__(self, interval, group_by=[]):
+    def __init__(self, interval, group_by=[], window=None, max_groups=None):
         FwdBucket.__init__(self)
         self.interval = interval
-        self.group_by = group_by
-        self.running = True
-        if group_by:
-            self.aggregate = {}
+        self.group_by = tuple(group_by)
+        if window is None:
+            panes = 1
         else:
-            self.aggregate = 0
-        
-        def report_count(callbacks,aggregate,interval):
+            panes = max(1, int(round(float(window) / interval)))
+        self.counter = WindowCounter(panes, max_groups)
+        self.running = True
+
+        def report_count():
             while self.running:
-                for callback in callbacks:
+                time.sleep(self.interval)
+                totals = self.counter.rotate()
+                if self.group_by:
+                    aggregate = totals
+                else:
+                    aggregate = totals.get((), 0)
+                for callback in self.callbacks:
                     callback(aggregate)
-                time.sleep(interval)
 
-        self.query_thread = Thread(target=report_count,args=
-                                   (self.callbacks,self.aggregate,self.interval))
+        self.query_thread = Thread(target=report_count)
         self.query_thread.daemon = True
         self.query_thread.start()
 
@@ -125,16 +257,9 @@ class AggregateFwdBucket(FwdBucket):
 
     ### update : Packet -> unit
     def update_aggregate(self,pkt):
-        if self.group_by:
-            from pyretic.core.language import match
-            groups = set(self.group_by) & set(pkt.available_fields())
-            pred = match([(field,pkt[field]) for field in groups])
-            try:
-                self.aggregate[pred] = self.aggregator(self.aggregate[pred],pkt)
-            except KeyError:
-                self.aggregate[pred] = self.aggregator(0,pkt)
-        else:
-            self.aggregate = self.aggregator(self.aggregate,pkt)
+        header = pkt.header
+        key = tuple(header.get(field) for field in self.group_by)
+        self.counter.add(key, self.aggregator(0,pkt))
 
     def eval(self, pkt):
         self.update_aggregate(pkt)
@@ -94,6 +94,28 @@ class pop_vheaders(DerivedPolicy):
         return "pop_vheaders"
 
 
+################################################################################
+# Fabric helpers                                                               #
+################################################################################
+
+def fabric_policy_from_tables(tables):
+    """
+    A flat fabric policy from per-switch tables mapping (vswitch, vinport,
+    voutport) to the physical port to forward out of.  The rules match
+    distinct packets, so they are combined disjointly.
+    """
+    rules = [Match(dict(vswitch=vswitch,
+                        vinport=vinport,
+                        voutport=voutport,
+                        switch=switch)) >> fwd(outport)
+             for switch in sorted(tables)
+             for ((vswitch, vinport, voutport), outport)
+             in sorted(tables[switch].items())]
+    if not rules:
+        return drop
+    return disjoint(rules)
+
+
 ################################################################################
 # VMAP functions
 ################################################################################
@@ -104,6 +126,8 @@ class vmap(object):
     def __init__(self):
         self.d2u = {}
         self.u2d = {}
+        self.paths = ShortestPathTrees()
+        self.fabric_tables = {}
 
     def ingress_policy(self):
         non_ingress = ~union(union(match(switch=u.switch,
@@ -134,7 +158,7 @@ class vmap(object):
                    union(valid_match_egress) >> pop_vheaders)
 
     def one_to_one_fabric_policy(self):
-        fabric_policy = drop
+        rules = []
         # ITERATE THROUGH ALL PAIRS OF VIRTUAL PORTS
         for (d1,[u1]) in self.d2u.items():
             for (d2,[u2]) in self.d2u.items():
@@ -142,15 +166,18 @@ class vmap(object):
                 if d1.switch != d2.switch:
                     continue
                 # FORWARD OUT THE CORRECT PHYSICAL PORT
-                fabric_policy += (match(vswitch=d1.switch,
+                rules.append(Match(dict(vswitch=d1.switch,
                                         vinport=d1.port_no,
-                                        voutport=d2.port_no) >>
-                                  fwd(u2.port_no))
-        return fabric_policy
+                                        voutport=d2.port_no)) >>
+                             fwd(u2.port_no))
+        if not rules:
+            return drop
+        return disjoint(rules)
 
     def shortest_path_fabric_policy(self,topo):
-        fabric_policy = drop
-        paths = Topology.all_pairs_shortest_path(topo)
+        # SHORTEST PATH TREES ARE KEPT UNTIL A TOPOLOGY CHANGE AFFECTS THEM
+        self.paths.update(topo)
+        tables = {}
         # ITERATE THROUGH ALL PAIRS OF VIRTUAL PORTS
         for (d1,[u1]) in self.d2u.items():
             for (d2,[u2]) in self.d2u.items():
@@ -158,31 +185,20 @@ class vmap(object):
                 if d1.switch != d2.switch:
                     continue
                 # IF IDENTICAL VIRTUAL LOCATIONS, THEN WE KNOW FABRIC POLICY IS JUST TO FORWARD OUT MATCHING PHYSICAL PORT
-                if d1.port_no == d2.port_no:
-                    fabric_policy += (match(vswitch=d1.switch,
-                                            vinport=d1.port_no,
-                                            voutport=d2.port_no,
-                                            switch=u2.switch) >> 
-                                      fwd(u2.port_no))
-                # OTHERWISE, GET THE PATH BETWEEN EACH PHYSICAL PAIR OF SWITCHES CORRESPONDING TO THE VIRTUAL LOCATION PAIR
-                # THE FOR EACH PHYSICAL HOP ON THE PATH, CREATE THE APPROPRIATE FORWARDING RULE FOR THAT SWITCH
+                # OTHERWISE, FOR EACH PHYSICAL HOP ON THE PATH BETWEEN THE PHYSICAL SWITCHES, ADD A RULE TO THAT SWITCH'S TABLE
                 # FINALLY ADD A RULE THAT FORWARDS OUT THE CORRECT PHYSICAL PORT AT THE LAST PHYSICAL SWITCH ON THE PATH
+                if d1.port_no == d2.port_no:
+                    hops = []
                 else:
                     try:
-                        for loc in paths[u1.switch][u2.switch]:
-                            fabric_policy += (match(vswitch=d1.switch,
-                                                    vinport=d1.port_no,
-                                                    voutport=d2.port_no,
-                                                    switch=loc.switch) >>
-                                              fwd(loc.port_no))
-                        fabric_policy += (match(vswitch=d1.switch,
-                                                vinport=d1.port_no,
-                                                voutport=d2.port_no,
-                                                switch=u2.switch) >>
-                                          fwd(u2.port_no))
+                        hops = self.paths.path(topo, u1.switch, u2.switch)
                     except KeyError:
-                        pass
-        return fabric_policy
+                        continue
+                key = (d1.switch, d1.port_no, d2.port_no)
+                for loc in hops + [u2]:
+                    tables.setdefault(loc.switch, {})[key] = loc.port_no
+        self.fabric_tables = tables
+        return fabric_policy_from_tables(tables)
 
 
 ################################################################################
@@ -232,6 +248,7 @@ class vdef(object):
 
     def __init__(self):
         self.vmap = None
+        self.paths = ShortestPathTrees()
         self.underlying = None
         self.derived = None
         self.DEBUG = no_packets
@@ -242,6 +259,8 @@ class vdef(object):
 
     def set_network(self,network):
         self.vmap = self.make_vmap()
+        # KEEP SHORTEST PATHS ACROSS NETWORK UPDATES
+        self.vmap.paths = self.paths
         self.ingress_policy.vmap = self.vmap
         self.fabric_policy.vmap = self.vmap
         self.egress_policy.vmap = self.vmap
@@ -1,5 +1,9 @@
 # Copyright 2014 - Sean Donovan
 
+import time
+from threading import Thread
+
+from pyretic.core.language import CountBucket, DerivedPolicy
 from pyretic.lib.query import AggregateFwdBucket
 
 '''
@@ -11,8 +15,10 @@ Makes it a one shot thing.
 # very similar, so there is tremendous reuse of code. 
 # This is based on match from pyretic.core.langauge
 class AssayCount(AggregateFwdBucket):
-    def __init__(self, policy, interval=30, group_by=[], cb=None):
-        super(AssayCount, self).__init__(interval, group_by)
+    def __init__(self, policy, interval=30, group_by=[], cb=None,
+                 window=None, max_groups=None):
+        super(AssayCount, self).__init__(interval, group_by, window,
+                                         max_groups)
         if cb is not None:
             self.register_callback(cb)
         self.passed_in_policy = policy
@@ -27,3 +33,80 @@ class count_bytes_assay(AssayCount):
     """ Duplicate of count_bytes() from pyretic.core.query """
     def aggregator(self,aggregate,pkt):
         return aggregate + pkt['header_len'] + pkt['payload_len']
+
+
+# The count_XXXX_assay policies above see every packet at the controller.
+# count_assay instead reads the counters of the switch rules that match the
+# policy, so matched traffic stays in the data plane.
+class AssayCountBucket(CountBucket):
+    """
+    A CountBucket polled every interval seconds, whose totals are kept across
+    changes to the rules that feed it.  The last counters seen for each
+    switch rule are remembered, and each poll adds what the rules counted
+    since: rules a NetAssayMatch adds start from zero, and rules it removes
+    keep what they had counted at the previous poll.
+    """
+    def __init__(self, interval=30):
+        super(AssayCountBucket, self).__init__()
+        self.interval = interval
+        self.rule_counts = {}
+        self.running = True
+        self.poll_thread = Thread(target=self.poll)
+        self.poll_thread.daemon = True
+        self.poll_thread.start()
+
+    def poll(self):
+        while self.running:
+            time.sleep(self.interval)
+            self.pull_stats()
+
+    def stop(self):
+        self.running = False
+
+    def handle_flow_stats_reply(self, switch, flow_stats):
+        with self.in_update_cv:
+            while self.in_update:
+                self.in_update_cv.wait()
+            if switch in self.outstanding_switches:
+                seen = {}
+                for f in flow_stats:
+                    key = (switch, f['keys'][0], f['priority'])
+                    (packets, bytes) = self.rule_counts.get(key, (0, 0))
+                    if f['packet_count'] < packets:
+                        # reinstalled since the last poll
+                        (packets, bytes) = (0, 0)
+                    self.packet_count_persistent += f['packet_count'] - packets
+                    self.byte_count_persistent += f['byte_count'] - bytes
+                    seen[key] = (f['packet_count'], f['byte_count'])
+                for key in self.rule_counts.keys():
+                    if key[0] == switch:
+                        del self.rule_counts[key]
+                self.rule_counts.update(seen)
+                self.outstanding_switches.remove(switch)
+            self.packet_count = self.packet_count_persistent
+            self.byte_count = self.byte_count_persistent
+        # If have all necessary data, call user-land registered callbacks
+        if not self.outstanding_switches:
+            for f in self.callbacks:
+                f([self.packet_count, self.byte_count])
+
+    def __repr__(self):
+        return "AssayCountBucket"
+
+
+class count_assay(DerivedPolicy):
+    """
+    Counts packets and bytes matching policy, usually a NetAssayMatch, from
+    switch counters.  Callbacks get [packet_count, byte_count], summed over
+    all the IP rules of the policy's AssayRule, every interval seconds.
+    """
+    def __init__(self, policy, interval=30, cb=None):
+        self.bucket = AssayCountBucket(interval)
+        self.register_callback = self.bucket.register_callback
+        self.stop = self.bucket.stop
+        if cb is not None:
+            self.register_callback(cb)
+        super(count_assay, self).__init__(policy >> self.bucket)
+
+    def __repr__(self):
+        return "count_assay\n%s" % repr(self.policy)
@@ -1,8 +1,7 @@
 # Copyright 2014 - Sean Donovan
 # Defines the Main Control Module (MCM). This is the primary file users import.
 
-import logging
-
+from pyretic.modules.netassay.netassaylog import setup_logging
 from pyretic.modules.netassay.me.dns.dnsme import DNSMetadataEngine
 from pyretic.modules.netassay.me.bgp.bgpme import BGPMetadataEngine
 from pyretic.modules.netassay.rulelimiter import RuleLimiter
@@ -49,21 +48,13 @@ class AssayMainControlModule:
         rl.start_delay()
 
     def setup_logger(self):
-        formatter = logging.Formatter('%(asctime)s %(name)-12s: %(levelname)-8s %(message)s')
-        console = logging.StreamHandler()
-        console.setLevel(logging.WARNING)
-        console.setFormatter(formatter)
-        logfile = logging.FileHandler('netassay.log')
-        logfile.setLevel(logging.DEBUG)
-        logfile.setFormatter(formatter)
-        self.logger = logging.getLogger('netassay')
-        self.logger.setLevel(logging.DEBUG)
-        self.logger.addHandler(console)
-        self.logger.addHandler(logfile)
+        # Verbosity of individual components can be raised afterwards with
+        # netassaylog.set_verbosity(), e.g. set_verbosity('AssayRule', 'DEBUG')
+        self.logger = setup_logging()
 
     def set_update_policy_callback(self, cb):
         self.logger.info("AssayMCM:set_update_policy_callback(): called")
-        self.logger.debug("    callback: " + str(cb))
+        self.logger.debug("    callback: %s", cb)
 
     def get_assay_ruleset(self):
         """
@@ -1,13 +1,14 @@
 # Copyright 2014 - Sean Donovan
 # This defines rules for NetAssay.
 
-import logging
 from ipaddr import IPv4Network, CollapseAddrList
 from pyretic.core.language import Match, basic_headers, tagging_headers
 from pyretic.modules.netassay.rulelimiter import RuleLimiter
+from pyretic.modules.netassay.netassaylog import get_logger
 from pyretic.modules.netassay.lib.py_timer import py_timer as Timer
 
 from pyretic.modules.netassay.eval.serial_logging import serial_logging
+from pyretic.core.tracing import tracer
 
 
 TIMEOUT = 0.1
@@ -23,15 +24,15 @@ class AssayRule:
     global SERIAL
 
     def __init__(self, ruletype, value):
-        logging.getLogger('netassay.AssayRule').info("AssayRule.__init__(): called")
-        self.logger = logging.getLogger('netassay.AssayRule')
+        self.logger = get_logger('AssayRule')
+        self.logger.info("AssayRule.__init__(): called")
         self.type = ruletype
         self.value = value
         self.update_callbacks = []
         self.rule_limiter = RuleLimiter.get_instance()
 
-        self.logger.debug("   self.type  = " + str(ruletype))
-        self.logger.debug("   self.value = " + str(value))
+        self.logger.debug("   self.type  = %s", ruletype)
+        self.logger.debug("   self.value = %s", value)
 
         # Rules should be proper pyretic rules
         # _raw_xxx_rules is the naive set of rules that are manipulated. When 
@@ -49,11 +50,19 @@ class AssayRule:
         self._raw_other_rules = []
         self._rule_list = []
 
+        # version counts changes to the raw rules; _rule_list is regenerated
+        # only when it was generated from an older version
+        self.version = 0
+        self._rule_list_version = 0
+
         # Timer and timer related - one timer for both add and remove
         self._timer = None
         self._rules_to_add = []
         self._rules_to_remove = []
 
+        # serials of the rule changes the next _update_rules() covers
+        self._traced_serials = []
+
     def number_of_rules(self):
         return (len(self._raw_srcmac_rules) +
                 len(self._raw_dstmac_rules) +
@@ -70,8 +79,8 @@ class AssayRule:
         self.update_callbacks.append(cb)
 
     def _rule_timer(self):
-        self.logger.debug("_rule_timer() called, addsize: " + str(len(self._rules_to_add)))
-        self.logger.debug("                  lremovesize: " + str(len(self._rules_to_remove)))
+        self.logger.debug("_rule_timer() called, addsize: %d", len(self._rules_to_add))
+        self.logger.debug("                  lremovesize: %d", len(self._rules_to_remove))
 #        self.logger.debug("    _rules_to_add:    " + str(self._rules_to_add))
 #        self.logger.debug("    _rules_to_remove: " + str(self._rules_to_remove))
 
@@ -84,10 +93,10 @@ class AssayRule:
             self._timer = None
 
         for rule in self._rules_to_add:
-            self.logger.debug("  Adding   " + str(rule))
+            self.logger.debug("  Adding   %s", rule)
             self._install_rule(rule)
         for rule in self._rules_to_remove:
-            self.logger.debug("  Removing " + str(rule))
+            self.logger.debug("  Removing %s", rule)
             self._uninstall_rule(rule)
         self._rules_to_add = []
         self._rules_to_remove = []
@@ -97,8 +106,7 @@ class AssayRule:
 
         #FOR EVAL
         serial = serial_logging.get_number()
-        logging.getLogger("netassay.evaluation2").info("ADD_RULE " + str(serial))
-        logging.getLogger("netassay.evaluation2").info("NO_DELAY " + str(serial))
+        tracer.record('add', serial, 'no_delay')
 
         self._rules_to_add.append({'rule':newrule, 'serial':serial})
 
@@ -108,26 +116,21 @@ class AssayRule:
     
 
     def add_rule(self, newrule):
-        self.logger.debug("add_rule: timer - " + str(self._timer))
+        self.logger.debug("add_rule: timer - %s", self._timer)
 
         #FOR EVAL
         serial = serial_logging.get_number()
-        logging.getLogger("netassay.evaluation2").info("ADD_RULE " + str(serial))
-
-
 
         delay = self.rule_limiter.get_delay()
         if (delay == 0):
 #            self._install_rule(newrule)
-            logging.getLogger("netassay.evaluation2").info("NO_DELAY " + 
-                                                           str(serial))
+            tracer.record('add', serial, 'no_delay')
             self._install_rule({'rule':newrule, 'serial':serial})
             self._update_rules()
             self.logger.debug("    nodelay == True")
 
         else:
-            logging.getLogger("netassay.evaluation2").info("WITH_DELAY " + 
-                                                           str(serial))
+            tracer.record('add', serial, 'delay')
 #            self._rules_to_add.append(newrule)
             self._rules_to_add.append({'rule':newrule, 'serial':serial})
 #            self.logger.debug("    new rule: " + str(newrule))
@@ -135,14 +138,15 @@ class AssayRule:
             if self._timer is None:
                 self._timer = Timer(TIMEOUT, self._rule_timer)
                 self._timer.start()
-                self.logger.debug("    new timer   - " + str(self._timer))
+                self.logger.debug("    new timer   - %s", self._timer)
 
     def _install_rule(self, newrule):
         # Does not check to see if it's a duplicate rule, as this allows the 
         # same rule to be installed for different reasons, and they can be 
         # removed individually.
-        logging.getLogger("netassay.evaluation2").info("INSTALL_RULE " + 
-                                                       str(newrule['serial']))
+        if tracer.enabled:
+            tracer.record('install', newrule['serial'])
+            self._traced_serials.append(newrule['serial'])
         if isinstance(newrule['rule'], Match):
             #FIXME: Can this optimize over multiple items?
             if len(newrule['rule'].map.keys()) == 1:
@@ -167,6 +171,7 @@ class AssayRule:
                 self._raw_other_rules.append(newrule)
         else:
             self._raw_other_rules.append(newrule)
+        self.version += 1
 
 
 #    def has_rule(self, newrule):
@@ -180,25 +185,21 @@ class AssayRule:
 #                (newrule in self._raw_other_rules))
 
     def remove_rule(self, newrule):
-        self.logger.debug("remove_rule: timer - " + str(self._timer))
+        self.logger.debug("remove_rule: timer - %s", self._timer)
 
         #FOR EVAL
         serial = serial_logging.get_number()
-        logging.getLogger("netassay.evaluation2").info("REMOVE_RULE " + 
-                                                       str(serial))
 
         delay = self.rule_limiter.get_delay()
         if (0 == delay):
 #            self._uninstall_rule(newrule)
-            logging.getLogger("netassay.evaluation2").info("NO_DELAY " + 
-                                                           str(serial))
+            tracer.record('remove', serial, 'no_delay')
             self._uninstall_rule({'rule':newrule, 'serial':serial})
             self._update_rules()
             self.logger.debug("    nodelay == True")
 
         else:
-            logging.getLogger("netassay.evaluation2").info("WITH_DELAY" + 
-                                                           str(serial))
+            tracer.record('remove', serial, 'delay')
 #            self._rules_to_remove.append(newrule)
             self._rules_to_remove.append({'rule':newrule, 'serial':serial})
 #            self.logger.debug("    new rule: " + str(newrule))
@@ -206,14 +207,15 @@ class AssayRule:
             if self._timer is None:
                 self._timer = Timer(TIMEOUT, self._rule_timer)
                 self._timer.start()
-                self.logger.debug("    new timer   - " + str(self._timer))
+                self.logger.debug("    new timer   - %s", self._timer)
 
     def _uninstall_rule(self, newrule):
         # In expected order of being true. Please rearrange as appropriate.
         
         # Thanks to: https://stackoverflow.com/questions/8653516/python-list-of-dictionaries-search
-        logging.getLogger("netassay.evaluation2").info("UNINSTALL_RULE" + 
-                                                       str(newrule['serial']))
+        if tracer.enabled:
+            tracer.record('uninstall', newrule['serial'])
+            self._traced_serials.append(newrule['serial'])
         if filter(lambda rule: rule['rule'] == newrule, 
                   self._raw_srcip_rules) != []:
             self._raw_srcip_rules.remove(
@@ -254,6 +256,7 @@ class AssayRule:
             self._raw_other_rules.remove(
                 filter(lambda rule: rule['rule'] == newrule, 
                        self._raw_other_rules))
+        self.version += 1
 
 #        if newrule in self._raw_srcip_rules:
 #            self._raw_srcip_rules.remove(newrule)
@@ -275,27 +278,29 @@ class AssayRule:
 
     def _update_rules(self):
         self.logger.debug("_update_rules() called")
-        logging.getLogger("netassay.evaluation2").info("UPDATE_RULES")
 
         # check if rules have changed
-        temp_rule_list = self._generate_list_of_rules()
+        old_rule_list = self._rule_list
+        temp_rule_list = self.get_list_of_rules()
+        changed = set(temp_rule_list) != set(old_rule_list)
+
+        # recorded before the callbacks, which may recompile the policy
+        if tracer.enabled:
+            counts = (changed, len(temp_rule_list), self.number_of_rules())
+            for serial in self._traced_serials:
+                tracer.record('update_rules', serial, counts)
+            self._traced_serials = []
+
         # If they're the same, do nothing
-        if set(temp_rule_list) == set(self._rule_list):
+        if not changed:
             self.logger.debug("_update_rules: No changes in rule list")
-            logging.getLogger("netassay.evaluation2").info("NO_RULES_TO_ADD " + 
-                                                           str(len(self._rule_list)) + " " +
-                                                           str(self.number_of_rules()))
         else:
             # if they're different, call the callbacks
             self._rule_list = temp_rule_list
-            logging.getLogger("netassay.evaluation2").info("RULES_TO_ADD " + 
-                                                           str(len(self._rule_list)) + " " +
-                                                           str(self.number_of_rules()))
 
             for cb in self.update_callbacks:
-                self.logger.debug("_update_rules: calling " + str(cb))
+                self.logger.debug("_update_rules: calling %s", cb)
                 cb()
-        logging.getLogger("netassay.evaluation2").info("UPDATE_RULES_FINISHED")
 
 
     def _generate_list_of_rules(self):
@@ -365,7 +370,7 @@ class AssayRule:
                         'ethtype','protocol','tos']
             ips = ['srcip','dstip']
 
-            temp_other_rules = list(other_rule_list)
+            temp_other_rules = [ruledict['rule'] for ruledict in other_rule_list]
 
             # Separate out the IP related rules
             temp_srcip_rules = []
@@ -516,7 +521,9 @@ class AssayRule:
         return temp_rule_list
 
     def get_list_of_rules(self):
-        self._rule_list = self._generate_list_of_rules()
+        if self._rule_list_version != self.version:
+            self._rule_list = self._generate_list_of_rules()
+            self._rule_list_version = self.version
         return self._rule_list
 
 
@@ -1,3 +1,5 @@
+# Parses netassay.log files written before rule changes were traced. Newer
+# runs can enable pyretic.core.tracing and use tracer.export_csv() instead.
 import sys
 import re
 import time
@@ -1,7 +1,7 @@
 # Copyright 2014 - Sean Donovan
 # BGP Metadata Engine - Based on the DNS Metadata Engine
 
-import logging
+from pyretic.modules.netassay.netassaylog import get_logger
 
 
 from bgpoversocket import BGPQueryHandler as BGPHandler
@@ -24,7 +24,7 @@ class BGPMetadataEngine:
             raise ValueError("Instance already exists!")
         self.bgp_source = BGPHandler()
         self.entries = []
-        self.logger = logging.getLogger('netassay.BGPME')
+        self.logger = get_logger('BGPME')
 
         # Register the different actions this ME can handle
         RegisteredMatchActions.register('AS', matchAS)
@@ -35,7 +35,7 @@ class BGPMetadataEngine:
     @classmethod
     def get_instance(cls):
         if cls.INSTANCE is None:
-            logging.getLogger('netassay.BGPME').info("BGPMetadataEngine.get_instance(): Initializing BGPMetadataEngine")
+            get_logger('BGPME').info("BGPMetadataEngine.get_instance(): Initializing BGPMetadataEngine")
             cls.INSTANCE = BGPMetadataEngine()
         return cls.INSTANCE
     
@@ -55,11 +55,11 @@ class BGPMetadataEngine:
 
 class BGPMetadataEntry:
     def __init__(self, bgp_source, engine, rule ):
-        logging.getLogger('netassay.BGPMetadataEntry').info("BGPMetadataEntry.__init__(): called")
+        get_logger('BGPMetadataEntry').info("BGPMetadataEntry.__init__(): called")
         self.bgp_source = bgp_source
         self.engine = engine
         self.rule = rule
-        self.logger = logging.getLogger('netassay.BGPMetadataEntry')
+        self.logger = get_logger('BGPMetadataEntry')
         
         #register for all the callbacks necessary
         if self.rule.type == AssayRule.AS:
@@ -94,12 +94,12 @@ class BGPMetadataEntry:
             self.rule.finish_rule_group()
 
     def handle_update_AS_callback(self, prefix):
-        self.logger.info("BGPMetatdataEntry.handle_update_AS_callback(): called with prefix " + prefix)
+        self.logger.info("BGPMetatdataEntry.handle_update_AS_callback(): called with prefix %s", prefix)
         self.rule.add_rule(Match(dict(srcip=IPPrefix(prefix))))
         self.rule.add_rule(Match(dict(dstip=IPPrefix(prefix))))
 
     def handle_remove_AS_callback(self, prefix):
-        self.logger.info("BGPMetatdataEntry.handle_remove_AS_callback(): called with prefix " + prefix)
+        self.logger.info("BGPMetatdataEntry.handle_remove_AS_callback(): called with prefix %s", prefix)
         self.rule.remove_rule(Match(dict(srcip=IPPrefix(prefix))))
         self.rule.remove_rule(Match(dict(dstip=IPPrefix(prefix))))
 
@@ -113,7 +113,7 @@ class matchAS(NetAssayMatch):
     matches IP prefixes related to the specified AS.
     """
     def __init__(self, asnum, matchaction):
-        logging.getLogger('netassay.matchAS').info("matchAS.__init__(): called")
+        get_logger('matchAS').info("matchAS.__init__(): called")
         metadata_engine = BGPMetadataEngine.get_instance()
         ruletype = AssayRule.AS
         rulevalue = asnum
@@ -124,7 +124,7 @@ class matchASPath(NetAssayMatch):
     matches IP prefixes related to the specified AS.
     """
     def __init__(self, asnum, matchaction):
-        logging.getLogger('netassay.matchASPath').info("matchASPath.__init__(): called")
+        get_logger('matchASPath').info("matchASPath.__init__(): called")
         metadata_engine = BGPMetadataEngine.get_instance()
         ruletype = AssayRule.AS_IN_PATH
         rulevalue = asnum
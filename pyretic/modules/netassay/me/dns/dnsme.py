@@ -3,7 +3,17 @@
 
 ACTIVE_MAPPING = True
 
-import logging
+# Copy DNS responses to the controller while the switches forward them,
+# rather than sending DNS traffic in both directions through the controller.
+MIRROR_RESPONSES = True
+MIRROR_MAX_LEN = None   # bytes of each response copied, None for all of it
+MIRROR_SAMPLE = 1.0     # fraction of copied responses that are parsed
+LIMIT_PER_FLOW = None   # responses parsed per flow, None for all of them
+DNS_FLOW = ['srcip', 'dstip', 'srcport', 'dstport']
+DELIVERY_WORKERS = 0    # threads parsing responses, 0 to parse them as they
+                        # arrive; with workers, a backlog drops the oldest
+
+from pyretic.modules.netassay.netassaylog import get_logger
 
 from dnsclassifier.dnsclassify import *
 from dnsentry import DNSClassifierEntry as DNSEntry
@@ -42,7 +52,7 @@ class DNSMetadataEngine(MetadataEngine):
     @classmethod
     def get_instance(cls):
         if cls.INSTANCE is None:
-            logging.getLogger('netassay.DNSME').info("DNSMetadataEngine.get_instance(): Initializing DNSMetadataEngine")
+            get_logger('DNSME').info("DNSMetadataEngine.get_instance(): Initializing DNSMetadataEngine")
             cls.INSTANCE = DNSMetadataEngine()
         return cls.INSTANCE
     
@@ -51,8 +61,16 @@ class DNSMetadataEngine(MetadataEngine):
         This gets the forwarding rules that the DNS Classifier needs to work.
         """
         self.logger.info("DNSMetadataEngine.get_forwarding_rules(): called")
-        dnspkts = packets(None, ['srcmac'])
         self.offset = 42 #FIXME! THIS ONLY WORKS WITH IPv4
+        if MIRROR_RESPONSES:
+            # only responses carry mappings; queries never leave the switches
+            dnspkts = packets(LIMIT_PER_FLOW, DNS_FLOW,
+                              workers=DELIVERY_WORKERS, mirror=True,
+                              max_len=MIRROR_MAX_LEN, sample=MIRROR_SAMPLE)
+            dnspkts.register_callback(self._dns_parse_cb)
+            return Match(dict(srcport = 53)) >> dnspkts
+
+        dnspkts = packets(LIMIT_PER_FLOW, DNS_FLOW, workers=DELIVERY_WORKERS)
         dnspkts.register_callback(self._dns_parse_cb)
 
         dns_inbound = Match(dict(srcport = 53)) >> dnspkts
@@ -88,13 +106,13 @@ class DNSMetadataEntry(MetadataEntry):
                 
 
     def handle_expiration_callback(self, addr, entry):
-        self.logger.info("DNSMetadataEntry.handle_expiration_callback(): called with " + addr)
+        self.logger.info("DNSMetadataEntry.handle_expiration_callback(): called with %s", addr)
         #need to remove the rules that was generated by the particular DNSEntry
         self.rule.remove_rule(Match(dict(srcip=IPAddr(addr))))
         self.rule.remove_rule(Match(dict(dstip=IPAddr(addr))))
 
     def handle_new_entry_callback(self, addr, entry):
-        self.logger.info("DNSMetadataEntry.handle_new_entry_callback(): called with " + addr)
+        self.logger.info("DNSMetadataEntry.handle_new_entry_callback(): called with %s", addr)
         if self.rule.type == AssayRule.CLASSIFICATION:
             if entry.classification == self.rule.value:
                 self.logger.debug("    Rule type: CLASSIFICATION")
@@ -112,13 +130,13 @@ class DNSMetadataEntry(MetadataEntry):
                 if name == self.rule.value:
                     self.rule.add_rule(Match(dict(srcip=IPAddr(addr))))
                     self.rule.add_rule(Match(dict(dstip=IPAddr(addr))))
-                    self.logger.debug("    New rule for " + name)
+                    self.logger.debug("    New rule for %s", name)
                     entry.register_timeout_callback(self.handle_expiration_callback)
 
     def handle_classification_callback(self, addr, entry):
         # This should only be registered for if you care about a particular 
         # class, so it's blindly adding a rule for the particular entry.
-        self.logger.info("DNSMetadataEntry.handle_classification_callback(): called with " + addr)
+        self.logger.info("DNSMetadataEntry.handle_classification_callback(): called with %s", addr)
         self.rule.add_rule(Match(dict(srcip=IPAddr(addr))))
         self.rule.add_rule(Match(dict(dstip=IPAddr(addr))))
         entry.register_timeout_callback(self.handle_expiration_callback)
@@ -159,7 +177,7 @@ class DNSMetadataEntry(MetadataEntry):
 
             self._active_results = new_active_results
         except (resolver.NoAnswer, exception.Timeout, resolver.NXDOMAIN):
-            self.logger.info("Could not query for " + self.rule.value + ". Trying again in 30 seconds.")
+            self.logger.info("Could not query for %s. Trying again in 30 seconds.", self.rule.value)
             self._active_timer = Timer(30, self._active_get_mapping_expired)
             self._active_timer.start()
             self._active_results = []
@@ -174,7 +192,7 @@ class matchURL(NetAssayMatch):
     matches IPs related to the specified URL.
     """
     def __init__(self, url, matchaction):
-        logging.getLogger('netassay.matchURL').info("matchURL.__init__(): called")
+        get_logger('matchURL').info("matchURL.__init__(): called")
         metadata_engine = DNSMetadataEngine.get_instance()
         ruletype = AssayRule.DNS_NAME
         rulevalue = url
@@ -185,7 +203,7 @@ class matchClass(NetAssayMatch):
     matches IPs related to the specified class of URLs.
     """
     def __init__(self, classification, matchaction):
-        logging.getLogger('netassay.matchClass').info("matchURL.__init__(): called")
+        get_logger('matchClass').info("matchURL.__init__(): called")
         metadata_engine = DNSMetadataEngine.get_instance()
         ruletype = AssayRule.CLASSIFICATION
         rulevalue = classification
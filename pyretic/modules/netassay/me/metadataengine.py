@@ -2,7 +2,7 @@
 # Copyright 2014 - Sean Donovan
 # MetadataEngine parent class, MetadataEntries parent class
 
-import logging
+from pyretic.modules.netassay.netassaylog import get_logger
 
 from pyretic.modules.netassay.assayrule import *
 from pyretic.lib.corelib import *
@@ -34,9 +34,8 @@ class MetadataEngine(object):
             raise ValueError("Instance already exists")
 
         # Setup logging
-        loggername = "netassay." + self.__class__.__name__
-        logging.getLogger(loggername).info("__init__(): called")
-        self.logger = logging.getLogger(loggername)
+        self.logger = get_logger(self.__class__.__name__)
+        self.logger.info("__init__(): called")
 
         # Initialize the list of MetadataEntrys
         self.entries = []
@@ -86,9 +85,8 @@ class MetadataEntry(object):
           - Set up any initial rules that are needed, say from a configuration
             file.
         """
-        loggername = "netassay." + self.__class__.__name__
-        logging.getLogger(loggername).info("__init__(): called")
-        self.logger = logging.getLogger(loggername)
+        self.logger = get_logger(self.__class__.__name__)
+        self.logger.info("__init__(): called")
         self.data_source = data_source
         self.engine = engine
         self.rule = rule
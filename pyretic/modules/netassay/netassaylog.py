@@ -0,0 +1,157 @@
+# Copyright 2014 - Sean Donovan
+# Logging for the NetAssay components. Loggers are looked up once and cached,
+# file output goes through a queue to a writer thread so that the hot paths
+# never wait on disk, and the verbosity of each component can be changed
+# while the controller is running.
+
+import logging
+import threading
+import Queue
+
+ROOT = 'netassay'
+LOG_FILE = 'netassay.log'
+LOG_FORMAT = '%(asctime)s %(name)-12s: %(levelname)-8s %(message)s'
+
+# Default verbosity of the netassay logger. DEBUG output is only produced for
+# the components that ask for it through set_verbosity().
+DEFAULT_LEVEL = logging.INFO
+CONSOLE_LEVEL = logging.WARNING
+
+# Records waiting for the writer thread. When full, new records are dropped
+# (and counted) rather than blocking the caller.
+QUEUE_SIZE = 65536
+
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+
+def get_logger(component=None):
+    """
+    The logger for a NetAssay component, e.g. get_logger('AssayRule') for
+    'netassay.AssayRule'. Loggers are cached, so this is cheap enough to call
+    from a constructor, but hot paths should keep the result around.
+    """
+    try:
+        return _loggers[component]
+    except KeyError:
+        pass
+    with _loggers_lock:
+        if not component in _loggers:
+            name = ROOT if component is None else ROOT + '.' + component
+            _loggers[component] = logging.getLogger(name)
+        return _loggers[component]
+
+
+def set_verbosity(component, level):
+    """
+    Set the level of a component's logger, e.g. set_verbosity('AssayRule',
+    'DEBUG'). A component of None sets the level of all of NetAssay.
+    Levels may be given as names or numbers.
+    """
+    if isinstance(level, basestring):
+        name = level
+        level = logging.getLevelName(name.upper())
+        if not isinstance(level, int):
+            raise ValueError("unknown logging level %s" % name)
+    get_logger(component).setLevel(level)
+
+
+def verbosity():
+    """The effective level of each component logged so far, by name."""
+    return dict((component, logging.getLevelName(logger.getEffectiveLevel()))
+                for (component, logger) in _loggers.items())
+
+
+class AsyncFileHandler(logging.Handler):
+    """
+    A handler that puts records on a queue; a daemon thread formats them and
+    writes them to a file. The message is merged with its arguments before
+    the record is queued, so later changes to the arguments are not logged,
+    and the rest of the formatting happens on the writer thread.
+
+    :param filename: the file to append to
+    :type filename: str
+    :param queue_size: the number of records that may be waiting
+    :type queue_size: int
+    """
+    def __init__(self, filename, queue_size=QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.target = logging.FileHandler(filename)
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.writer = threading.Thread(target=self._write,
+                                       name='netassay-log-writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        """
+        Merge the message with its arguments and render any traceback, as
+        logging.handlers.QueueHandler does, so the record no longer refers
+        to objects the caller may change or that may not outlive the call.
+        """
+        if record.exc_info:
+            self.format(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    return
+                self.target.handle(record)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait for the queued records to be written."""
+        if self.writer.is_alive():
+            self.queue.join()
+        self.target.flush()
+
+    def close(self):
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+def setup_logging(filename=LOG_FILE, level=DEFAULT_LEVEL,
+                  console_level=CONSOLE_LEVEL, asynchronous=True):
+    """
+    Attach the console and file handlers to the netassay logger, once.
+    Returns the netassay logger. With asynchronous=False the file is written
+    from the logging thread, as before.
+    """
+    logger = get_logger()
+    if getattr(logger, '_netassay_handlers', None) is not None:
+        return logger
+    formatter = logging.Formatter(LOG_FORMAT)
+    console = logging.StreamHandler()
+    console.setLevel(console_level)
+    console.setFormatter(formatter)
+    if asynchronous:
+        logfile = AsyncFileHandler(filename)
+    else:
+        logfile = logging.FileHandler(filename)
+    logfile.setFormatter(formatter)
+    logger.setLevel(level)
+    logger.addHandler(console)
+    logger.addHandler(logfile)
+    logger._netassay_handlers = (console, logfile)
+    return logger
@@ -1,9 +1,9 @@
 # Copyright 2014 - Sean Donovan
 # Defines the NetAssayMatch class
 
-import logging
+from pyretic.modules.netassay.netassaylog import get_logger
 
-from pyretic.core.language import DynamicFilter, drop, union
+from pyretic.core.language import DynamicFilter, Match, identity, drop, union
 #from pyretic.core.language import DynamicFilter, drop, parallel
 from pyretic.modules.netassay.assayrule import *
 
@@ -15,15 +15,15 @@ from pyretic.modules.netassay.assayrule import *
 class NetAssayMatch(DynamicFilter):
     def __init__(self, metadata_engine, ruletype, rulevalue, matchaction):
         super(NetAssayMatch,self).__init__()
-        loggername = "netassay." + self.__class__.__name__
-        logging.getLogger(loggername).info("__init__(): called")
-        self.logger = logging.getLogger(loggername)
+        self.logger = get_logger(self.__class__.__name__)
+        self.logger.info("__init__(): called")
         # probably should verify that the URL is vaid...
         self.me = metadata_engine 
         self.matchaction = matchaction
         self.assayrule = AssayRule(ruletype, rulevalue)
         self.assayrule.set_update_callback(self.update_policy)
         self.me.new_rule(self.assayrule)
+        self._compiled = None
         self._classifier = self.generate_classifier()
 
     def update_policy(self):
@@ -65,6 +65,43 @@ class NetAssayMatch(DynamicFilter):
                 self.assayrule.type == other.assayrule.type and
                 self.assayrule.value == other.assayrule.value)
 
+    def compiled(self):
+        """
+        The rules of the assay rule compiled to a dict from each field to
+        the set of patterns the rules give it, with the number of rules.
+        Cached until the assay rule's version changes.
+        """
+        version = self.assayrule.version
+        if self._compiled is None or self._compiled[0] != version:
+            rules = self.assayrule.get_list_of_rules()
+            fields = {}
+            for rule in rules:
+                for (field, pattern) in rule.map.items():
+                    fields.setdefault(field, set()).add(pattern)
+            self._compiled = (version, len(rules), fields)
+        return self._compiled[1:]
+
+    @staticmethod
+    def _conjunction(fields):
+        """
+        The Match requiring every pattern in fields, or drop if no packet
+        can: other fields must be given a single value, and IP prefixes
+        must nest, leaving the most specific.
+        """
+        result = {}
+        for (field, patterns) in fields.items():
+            if field in ['srcip', 'dstip']:
+                prefixes = sorted(patterns, key=lambda p: p.prefixlen)
+                for (wider, narrower) in zip(prefixes, prefixes[1:]):
+                    if not narrower in wider:
+                        return drop
+                result[field] = prefixes[-1]
+            elif len(patterns) > 1:
+                return drop
+            else:
+                result[field] = iter(patterns).next()
+        return Match(result)
+
     def intersect(self, pol):
         self.logger.debug("Intersect called")
         
@@ -72,30 +109,26 @@ class NetAssayMatch(DynamicFilter):
             return self
         elif pol == drop:
             return drop
-        elif 0 == len(self.assayrule.get_list_of_rules()):
+        (count, fields) = self.compiled()
+        if 0 == count:
             return drop                          
         elif not (isinstance(pol, NetAssayMatch) or
                   isinstance(pol, Match)):
             raise TypeError(str(pol.__class__.__name__) + ":" + str(pol))
 
-        current_min = identity
         if isinstance(pol, NetAssayMatch):
-            if 0 == len(pol.assayrule.get_list_of_rules()):
+            (pol_count, pol_fields) = pol.compiled()
+            if 0 == pol_count:
                 return drop
-            
-            for rule in pol.assayrule.get_list_of_rules():
-                if current_min == None:
-                    current_min = rule
-                    continue
-                current_min = current_min.intersect(rule)
         else:
-            current_min = pol
+            pol_fields = dict((f, set([v])) for (f, v) in pol.map.items())
 
-        
-        for rule in self.assayrule.get_list_of_rules():
-            current_min = current_min.intersect(rule)
+        combined = dict((f, set(patterns)) for (f, patterns) in fields.items())
+        for (field, patterns) in pol_fields.items():
+            combined.setdefault(field, set()).update(patterns)
+        current_min = self._conjunction(combined)
 
-        self.logger.debug("current_min = " + str(current_min))
+        self.logger.debug("current_min = %s", current_min)
         return current_min
 
 
@@ -6,14 +6,20 @@
 # get copies of connections opened to cnn.com. NetAssayWindow would keep track
 # of this.
 
-import logging
+from pyretic.modules.netassay.netassaylog import get_logger
+import time
+from collections import deque
+from threading import Lock
 
-from pyretic.core.language import DynamicPolicy, match, Match, drop, disjoint
+from pyretic.core.language import DynamicPolicy, DynamicFilter, Classifier, Rule
+from pyretic.core.language import match, Match, identity, drop, disjoint
 from pyretic.modules.netassay.netassaymatch import NetAssayMatch
 from pyretic.lib.query import *
 from pyretic.modules.netassay.lib.py_timer import py_timer as Timer
-from ryu.lib import addrconv
-from datetime import datetime, timedelta
+
+# Visitors due to expire within this many seconds of each other are expired
+# together, with a single policy update.
+EXPIRY_SLACK = 1.0
 
 class NetAssayWindow: 
     INSTANCE = None
@@ -40,6 +46,126 @@ class NetAssayWindow:
         self.list_of_forwarding_rules.remove(rule)
         
 
+class TimeWindow(object):
+    """
+    The keys visited within the last window seconds.  A dict maps each key
+    to the time it expires, and a deque holds an (expiry, key) entry per
+    visit in expiry order.  Visiting a key again only updates the dict and
+    appends an entry, leaving the old entry stale to be skipped when it
+    reaches the front of the deque, so visits are O(1) and expiring pops
+    only the entries that are due.
+
+    :param window: seconds a key stays after its last visit
+    :type window: float
+    :param slack: also expire keys due within slack seconds
+    :type slack: float
+    """
+    def __init__(self, window, slack=0):
+        self.window = window
+        self.slack = slack
+        self.expires = {}
+        self.queue = deque()
+
+    def __len__(self):
+        return len(self.expires)
+
+    def __contains__(self, key):
+        return key in self.expires
+
+    def keys(self):
+        return self.expires.keys()
+
+    def visit(self, key, now=None):
+        """
+        Record a visit by key.  Returns whether key is new to the window.
+        """
+        if now is None:
+            now = time.time()
+        expiry = now + self.window
+        new = not key in self.expires
+        self.expires[key] = expiry
+        self.queue.append((expiry, key))
+        return new
+
+    def expire(self, now=None):
+        """
+        Remove the keys whose last visit is more than window seconds old
+        (give or take slack), and return them.
+        """
+        if now is None:
+            now = time.time()
+        deadline = now + self.slack
+        expired = []
+        while self.queue and self.queue[0][0] <= deadline:
+            (expiry, key) = self.queue.popleft()
+            if self.expires.get(key) == expiry:
+                del self.expires[key]
+                expired.append(key)
+        return expired
+
+    def next_expiry(self):
+        """
+        When expire() next has something to do, or None if never.
+        """
+        if not self.queue:
+            return None
+        return self.queue[0][0]
+
+
+class _visitors(DynamicFilter):
+    """
+    Keeps packets from or to any visitor.  Visitors are added and removed
+    one at a time, each with the two rules built when it arrived, so a
+    change only touches that visitor's rules; the classifier is assembled
+    from the rules rather than compiled from a union of every visitor's
+    matches.  Since every rule keeps the packet, their order doesn't
+    matter.  With no visitors, it drops everything.
+
+    :param lock: held while visitors are added, removed or compiled
+    :type lock: Lock
+    """
+    def __init__(self, lock):
+        self.lock = lock
+        self.rules = {}
+        super(_visitors,self).__init__()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def add(self, ipaddr):
+        """Add a visitor.  Called with self.lock held."""
+        self.rules[ipaddr] = (Rule(Match({'srcip' : ipaddr}), {identity}),
+                              Rule(Match({'dstip' : ipaddr}), {identity}))
+        self._classifier = None
+
+    def remove(self, ipaddr):
+        """Remove a visitor.  Called with self.lock held."""
+        del self.rules[ipaddr]
+        self._classifier = None
+
+    def eval(self, pkt):
+        for field in ['srcip', 'dstip']:
+            if field in pkt.header and pkt[field] in self.rules:
+                return {pkt}
+        return set()
+
+    def compile(self):
+        with self.lock:
+            if self._classifier is None:
+                self._classifier = self.generate_classifier()
+            return self._classifier
+
+    def generate_classifier(self):
+        rules = [rule for pair in self.rules.itervalues() for rule in pair]
+        return Classifier(rules + [Rule(identity, set())])
+
+    def __repr__(self):
+        return "visitors: %d" % len(self.rules)
+
+    def __eq__(self, other):
+        return self is other
+
+
 class visited(DynamicFilter):
     '''
     Returns match statments for all the IP addresses that have visited whatever
@@ -47,15 +173,17 @@ class visited(DynamicFilter):
     '''
     def __init__(self, time_window, **kwargs):
         super(visited,self).__init__()
-        loggername = "netassay." + self.__class__.__name__
-        logging.getLogger(loggername).info("__init__(): called")
-        self.logger = logging.getLogger(loggername)
+        self.logger = get_logger(self.__class__.__name__)
+        self.logger.info("__init__(): called")
         self.naw = NetAssayWindow.get_instance()
 
         self.time_window = time_window
         self.kwargs_filter = match(**kwargs)
         
-        self.visit_list = []
+        self.window = TimeWindow(time_window, EXPIRY_SLACK)
+        self.window_lock = Lock()
+        self.visitors = _visitors(self.window_lock)
+        self.policy = self.visitors
         self.timer = None
 
         self.important_pkts = packets(1, ['srcmac', 'dstmac', 'srcip', 'dstip', 'srcport', 'dstport', 'protocol'])
@@ -67,137 +195,83 @@ class visited(DynamicFilter):
     def __del__(self):
         if self.timer != None:
             self.timer.cancel()
-        self.naw.deregister_forwaring_rule(self.registered_rule)
+        self.naw.deregister_forwarding_rule(self.registered_rule)
 
+    def _visitor(self, pkt):
+        '''
+        The IP address in pkt that visited the filter: the endpoint whose
+        address the filter doesn't need in order to match pkt.
+        '''
+        for field in ['srcip', 'dstip']:
+            if not field in pkt.header:
+                continue
+            probe = pkt.modify(**{field : '0.0.0.0'})
+            if self.kwargs_filter.eval(probe):
+                return pkt[field]
+        return None
 
     def _pkt_callback(self, pkt):
         ''' 
         If IP already is in the visit list, update the time. 
-        If IP not in the visit list, add to visit list with new timestamp and
-        call update_policy().
+        If IP not in the visit list, add to visit list with new timestamp,
+        add its rules to the policy and call update_policy().
         '''
-
-        # Figure out which IP is in the registered filter right now
-        # FIXME: THIS IS VERY DIRTY. It's looking through the match() action,
-        # then through the Match() and NetAssayMatch() actions, extract their
-        # IP address that are involved... Possible problems.
-        def list_of_ips(match_action):
-            ip_list = []
-            if match_action._traditional_match is not None:
-                if ('srcip' in match_action._traditional_match.map.keys()):
-                    ip_list.append(match_action._traditional_match.map['srcip'])
-                if ('dstip' in match_action._traditional_match.map.keys()):
-                    ip_list.append(match_action._traditional_match.map['dstip'])
-            if match_action._netassay_match is not None:
-                ip_list.append(
-                    match_action._netassay_match.assayrule._raw_srcip_rules)
-                ip_list.append(
-                    match_action._netassay_match.assayrule._raw_dstip_rules)
-
-        ips = list_of_ips(self.kwargs_filter)
-        ipaddr = None
-        if pkt['dstip'] in ips:
-            ipaddr = pkt['dstip']
-        elif pkt['srcip'] in ips:
-            ipaddr = pkt['srcip']
-        # END OF FIXME
-
-        # Build up the dict to lookup the pkt, include timestamp
-        new_pkt = {}
-        new_pkt['ip'] = ipaddr
-        new_pkt['timestamp'] = datetime.now() + timedelta(seconds=self.timewindow)
-
-        # Policy is updated whenever a new entry is added to the list
-        # Timer is updated whenever the first entry in the visit_list is changed
-        need_to_update_policy = False 
-        need_to_update_timer  = False
-        if self._in_visit_list(new_pkt):
-            need_to_update_timer = self._remove_from_visit_list(new_pkt)
-        else:
-            need_to_update_policy = True
-        self.visit_list.append(new_pkt)
-
-        if need_to_update_timer:
-            self._restart_timer
-        if need_to_update_policy:
+        ipaddr = self._visitor(pkt)
+        if ipaddr is None:
+            return
+
+        with self.window_lock:
+            new = self.window.visit(ipaddr)
+            if new:
+                self.visitors.add(ipaddr)
+            if self.timer is None:
+                self._restart_timer()
+        if new:
             self.update_policy()
 
     def _age_out(self):
         '''
-        Once something hits the timelime in self.time_window, remove it from
-        the visit list and call _restart_timer() and update_policy().
+        Remove everything that has been in the visit list for longer than
+        self.time_window, and its rules from the policy, then call
+        _restart_timer() and update_policy().
         '''
-        if self.timer != None:
-            self.timer.cancel()
-
-        if (len(self.visit_list) > 1):
-            self.visit_list = self.visit_list[1:]
+        with self.window_lock:
+            expired = self.window.expire()
+            for ipaddr in expired:
+                self.visitors.remove(ipaddr)
             self._restart_timer()
-        else:
-            self.visit_list = []
-        self.update_policy()
-
+        if expired:
+            self.update_policy()
 
     def _restart_timer(self):
         '''
-        Restarts the timer. This is likely due to an update to the visit_list.
-        Look at the first entry to the visit_list, get a timedelta, and send it 
-        to the timer.
+        Restarts the timer for the next expiry in the visit list, if any.
+        Called with self.window_lock held.
         '''
-        if self.timer != None:
-            self.timer.cancel()
-
-        delta = self.visit_list[0]['timestamp'] - datetime.now()
-
-        self.timer = Timer(delta.total_seconds(), self._age_out)
+        expiry = self.window.next_expiry()
+        if expiry is None:
+            self.timer = None
+            return
+        self.timer = Timer(max(0, expiry - time.time()), self._age_out)
         self.timer.start()
 
     def update_policy(self):
         '''
         When there is a change in the visit list (addition or subtraction),
-        update the policy that's being returned.
+        tell the runtime.  The visitors' rules have already been added to or
+        removed from the policy in place.
         '''
-        list_of_rules = []
-
-        for entry in self.visit_list:
-            list_of_rules.append(Match({'srcip' : entry['ip']}))
-            list_of_rules.append(Match({'dstip' : entry['ip']}))
-
-        count = len(list_of_rules)
-        if count == 0:
-            self.policy = drop
-        else:
-            new_policy = union(list_of_rules)
-            self.policy = new_policy
+        self.visitors.changed()
 
     def __repr__(self):
         retval = self.__class__.__name__ + ":"
         retval = retval + "\n    Window: " + str(self.time_window)
         retval = retval + "\n    " + str(self.kwargs_filter)
-
-    def _in_visit_list(self, new_pkt):
-        for entry in self.visit_list:
-            if (entry['ip'] == new_pkt['ip']):
-                return True
-        # If it's not in the visit list, return False)
-        return False        
-
-    def _remove_from_visit_list(self, new_pkt):
-        '''
-        Returns whether or not an update to the timer is needed.
-        This occurs when the first item in the list is removed, as it was what 
-        the timer was based on.
-        '''
-        update_needed = True
-        for entry in self.visit_list:
-            if (entry['ip'] == new_pkt['ip']):
-                self.visit_list.remove(entry)
-                return update_needed
-            update_needed = False
+        return retval
 
     def generate_classifier(self):
         self.logger.debug("generate_classifier called")
-        self.policy.compile()    
+        return self.policy.compile()    
 
     def __eq__(self, other):
         return (isinstance(other, type(self)) and
@@ -211,17 +285,14 @@ class visited(DynamicFilter):
             return self
         elif pol == drop:
             return drop
-        elif 0 == len(self.visit_list):
+        elif 0 == len(self.window):
             return drop
         #FIXME - netassaymatch.py line 78
         
-        return pol.intersect(self.policy())
+        return pol.intersect(self.policy)
 
     def covers(self, other):
         # FIXME: Stolen from NetAssayMatch. May need to update.
         if (other == self):
             return True
         return False
-                          
-    
-    
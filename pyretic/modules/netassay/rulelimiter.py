@@ -2,7 +2,7 @@
 # This is a global tracking mechanism that tracks all changes by AssayRules and
 # tells them when to install rules.
 
-import logging
+from pyretic.modules.netassay.netassaylog import get_logger
 from pyretic.modules.netassay.lib.py_timer import py_timer as Timer
 
 class RuleLimiter:
@@ -19,8 +19,8 @@ class RuleLimiter:
     def __init__(self):
         if self.INSTANCE is not None:
             raise ValueError("Instance already exists")
-        logging.getLogger('netassay.RuleLimiter').info("RuleLimiter.__init__(): called")
-        self.logger = logging.getLogger('netassay.RuleLimiter')
+        self.logger = get_logger('RuleLimiter')
+        self.logger.info("RuleLimiter.__init__(): called")
 
         self._logged_counts = [0] * self.COUNTS
         self._current_count = 0
@@ -51,7 +51,8 @@ class RuleLimiter:
             return 0.01
         delay = sum(self._logged_counts) + self._current_count
         self._current_count = self._current_count + 1
-        self.logger.debug("DELAY -------- " + str(delay * self.DELAY_MULTIPLIER) + "   " + str(self._logged_counts))
+        self.logger.debug("DELAY -------- %s   %s",
+                          delay * self.DELAY_MULTIPLIER, self._logged_counts)
         return min(0.1, delay * self.DELAY_MULTIPLIER)
             
     def _reset_timer(self):
@@ -0,0 +1,278 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Joshua Reich (jreich@cs.princeton.edu)                               #
+# author: Christopher Monsanto (chris@monsan.to)                               #
+# author: Cole Schlesinger (cschlesi@cs.princeton.edu)                         #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+from pyretic.backend.comm import *
+from pyretic.backend import backend
+from pyretic.backend.backend import Backend
+
+import threading
+import pytest
+
+class LoopbackChannel(FramedChannel):
+    """
+    A FramedChannel without a socket.  What it pushes goes to its peer's
+    incoming buffer, and deliver() feeds that buffer through asynchat's
+    reader, which calls found_terminator, the way the asyncore loop would.
+    """
+    def __init__(self):
+        FramedChannel.__init__(self, threading.Lock())
+        self.peer = None
+        self.incoming = ''
+        self.handled = []
+
+    def push(self, data):
+        self.peer.incoming += data
+
+    def recv(self, buffer_size):
+        (data, self.incoming) = (self.incoming[:buffer_size],
+                                 self.incoming[buffer_size:])
+        return data
+
+    def deliver(self):
+        while self.incoming:
+            self.handle_read()
+
+    def handle_msg(self, msg):
+        self.handled.append(msg)
+
+def channel_pair():
+    a = LoopbackChannel()
+    b = LoopbackChannel()
+    a.peer = b
+    b.peer = a
+    return (a, b)
+
+def handshake(a, b):
+    a.send_hello()
+    b.send_hello()
+    b.deliver()
+    a.deliver()
+    # each end's 'binary_framing' reply
+    b.deliver()
+    a.deliver()
+
+### Binary framing
+
+def test_frame_round_trip_json():
+    msg = ['install', {'switch' : 1, 'srcmac' : '\x00\x01\x02\xff\xfe\x80',
+                       'srcip' : '\x0a\x00\x00\x01'},
+           60000, [{'outport' : 2}]]
+    data = pack_frame(msg)
+    (kind, length) = FRAME_HEADER.unpack_from(data)
+    assert kind == FRAME_JSON
+    assert length == len(data) - FRAME_HEADER.size
+    assert unpack_frame(kind, data[FRAME_HEADER.size:]) == msg
+
+def test_frame_round_trip_packet():
+    for raw in ['\x00\xff' * 757, '']:
+        msg = ['packet', {'switch' : 3, 'inport' : 1, 'raw' : raw}]
+        data = pack_frame(msg)
+        (kind, length) = FRAME_HEADER.unpack_from(data)
+        assert kind == FRAME_PACKET
+        assert length == PACKET_HEADER.size + len(raw)
+        assert unpack_frame(kind, data[FRAME_HEADER.size:]) == msg
+
+def test_frame_round_trip_packet_header_limits():
+    for (switch, inport, outport) in [(2**64 - 1, 2**31 - 1, -2**31),
+                                      (0, 0, 0)]:
+        msg = ['packet', {'switch' : switch, 'inport' : inport,
+                          'outport' : outport, 'raw' : 'x'}]
+        data = pack_frame(msg)
+        assert unpack_frame(FRAME_PACKET, data[FRAME_HEADER.size:]) == msg
+    # absent ports are carried as -1 and stay absent
+    msg = ['packet', {'switch' : 2**64 - 1, 'raw' : 'x'}]
+    data = pack_frame(msg)
+    assert unpack_frame(FRAME_PACKET, data[FRAME_HEADER.size:]) == msg
+
+def test_framed_channel_json_before_hello():
+    (a, b) = channel_pair()
+    msg = ['switch', 'join', 1, 'BEGIN']
+    a.push_msg(msg)
+    b.deliver()
+    assert b.handled == [msg]
+    assert not a.binary_out and not b.binary_in
+
+def test_framed_channel_hello_switches_both_directions():
+    (a, b) = channel_pair()
+    handshake(a, b)
+    assert a.binary_out and a.binary_in
+    assert b.binary_out and b.binary_in
+    assert a.handled == [] and b.handled == []
+
+    packet = ['packet', {'switch' : 2**64 - 1, 'inport' : 2**31 - 1,
+                         'raw' : '\n' * 100}]
+    install = ['install', {'switch' : 1, 'dstmac' : '\n\x00\n\x00\n\x00'},
+               10, [{'outport' : 1}]]
+    a.push_msgs([packet, install])
+    b.push_msg(install)
+    b.push_msg(packet)
+    b.deliver()
+    a.deliver()
+    assert b.handled == [packet, install]
+    assert a.handled == [install, packet]
+
+def test_framed_channel_hello_one_direction():
+    (a, b) = channel_pair()
+    a.send_hello()
+    b.push_msg(['hello', {'binary_framing' : False}])
+    b.deliver()
+    a.deliver()
+    b.deliver()
+    # b frames what it sends to a; a keeps sending JSON lines to b
+    assert b.binary_out and a.binary_in
+    assert not a.binary_out and not b.binary_in
+
+    packet = ['packet', {'switch' : 1, 'outport' : 2, 'raw' : 'abc'}]
+    a.push_msg(packet)
+    b.push_msg(packet)
+    b.deliver()
+    a.deliver()
+    assert a.handled == [packet]
+    assert b.handled == [packet]
+
+def test_framed_channel_zero_length_frames():
+    (a, b) = channel_pair()
+    handshake(a, b)
+    # an empty frame is consumed on its header alone; the next frame
+    # still lines up
+    packet = ['packet', {'switch' : 1, 'inport' : 1, 'raw' : ''}]
+    b.incoming += FRAME_HEADER.pack(FRAME_JSON, 0)
+    a.push_msg(packet)
+    b.deliver()
+    assert b.handled == [packet]
+    assert b.get_terminator() == FRAME_HEADER.size
+
+### Bulk updates
+
+def test_serialize_compact_round_trip():
+    msg = ['install', {'switch' : 1, 'srcmac' : '\x00\x01\x02\xff\xfe\x80',
+                       'dstmac' : '\n' * 6, 'srcip' : '\x0a\x00\x00\x01',
+                       'dstip' : '\xff' * 4, 'raw' : ''.join(map(chr, range(256))),
+                       'inport' : 3},
+           60000, [{'outport' : 2, 'dstip' : '\x0a\x00\x00\x02'}]]
+    line = serialize(msg, compact=True)
+    assert line.endswith(TERM_CHAR) and line.count(TERM_CHAR) == 1
+    assert len(line) < len(serialize(msg))
+    assert deserialize([line]) == msg
+    assert deserialize([serialize(msg)]) == msg
+
+class RecordingChannel(object):
+    def __init__(self):
+        self.sent = []
+
+    def push_msg(self, msg, compact=False):
+        self.sent.append((msg, compact))
+
+    def push_msgs(self, msgs, compact=False):
+        self.sent.append((msgs, compact))
+
+def recording_backend():
+    b = Backend.__new__(Backend)
+    b.backend_channel = RecordingChannel()
+    b.runtime = None
+    b.channel_lock = threading.Lock()
+    b.bulk_state = threading.local()
+    return b
+
+def test_backend_bulk_nested():
+    b = recording_backend()
+    with b.bulk():
+        b.send_install({'switch' : 1}, 10, [])
+        with b.bulk():
+            b.send_delete({'switch' : 1}, 20)
+            b.send_packet({'switch' : 1, 'raw' : 'abc'})
+        assert b.backend_channel.sent == []
+        b.send_barrier(1)
+    assert b.backend_channel.sent == [
+        (['bulk', [['install', {'switch' : 1}, 10, []],
+                   ['delete', {'switch' : 1}, 20],
+                   ['barrier', 1]]], True),
+        ([['packet', {'switch' : 1, 'raw' : 'abc'}]], False)]
+    # outside a bulk context each update goes out on its own
+    b.send_clear(1)
+    assert b.backend_channel.sent[-1] == (['clear', 1], False)
+
+def test_backend_bulk_per_thread():
+    b = recording_backend()
+    with b.bulk():
+        t = threading.Thread(target=b.send_clear, args=(2,))
+        t.start()
+        t.join()
+        assert b.backend_channel.sent == [(['clear', 2], False)]
+        b.send_clear(1)
+    assert b.backend_channel.sent[-1] == (['bulk', [['clear', 1]]], True)
+
+def test_backend_bulk_split(monkeypatch):
+    monkeypatch.setattr(backend, 'BULK_MAX_OPS', 3)
+    b = recording_backend()
+    with b.bulk():
+        for switch in range(7):
+            b.send_clear(switch)
+    sent = [msg for (msg, compact) in b.backend_channel.sent]
+    assert [len(msg[1]) for msg in sent] == [3, 3, 1]
+    assert [op for msg in sent for op in msg[1]] == \
+        [['clear', switch] for switch in range(7)]
+    # an empty context sends nothing
+    with b.bulk():
+        pass
+    assert len(b.backend_channel.sent) == 3
+
+class FakeOFMessage(object):
+    def __init__(self, data):
+        self.data = data
+
+    def pack(self):
+        return self.data
+
+class FakeConnection(object):
+    def __init__(self):
+        self.writes = []
+
+    def send(self, data):
+        self.writes.append(data)
+
+def test_pox_client_batch():
+    pox_client = pytest.importorskip('of_client.pox_client')
+    client = pox_client.POXClient.__new__(pox_client.POXClient)
+    client.switches = {1 : {'connection' : FakeConnection()},
+                       2 : {'connection' : FakeConnection()}}
+    client.batch = None
+    client.send_to_connection(1, 'a')
+    assert client.switches[1]['connection'].writes == ['a']
+    client.begin_batch()
+    for (switch, data) in [(1, 'b'), (2, 'c'), (1, 'd'), (3, 'e')]:
+        client.send_to_connection(switch, FakeOFMessage(data))
+    assert client.switches[1]['connection'].writes == ['a']
+    client.flush_batch()
+    # one write per switch; a missing switch is only reported
+    assert client.switches[1]['connection'].writes == ['a', 'bd']
+    assert client.switches[2]['connection'].writes == ['c']
+    assert client.batch is None
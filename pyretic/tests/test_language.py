@@ -490,3 +490,251 @@ def test_optimize_bug_1():
     print 'classifier.optimize():'
     print classifier.optimize()
     assert classifier == classifier.optimize()
+
+
+# Compiled classifiers
+
+def _compiled_classifier_env():
+    c = Classifier([
+        Rule(Match(dict(srcip='10.0.0.1', dstport=53)), [modify(outport=3)]),
+        Rule(Match(dict(srcip='10.0.0.0/24')), [modify(outport=2)]),
+        Rule(Match(dict(inport=1)), [modify(outport=1), modify(outport=4)]),
+        Rule(Match(dict(dstip='10.1.0.0/16', inport=2)), [identity]),
+        Rule(identity, set()) ])
+    pkts = [
+        Packet({'inport':1, 'srcip':IPAddr('10.0.0.1'), 'dstport':53}),
+        Packet({'inport':1, 'srcip':IPAddr('10.0.0.1'), 'dstport':80}),
+        Packet({'inport':1, 'srcip':IPAddr('10.0.1.1')}),
+        Packet({'inport':2, 'dstip':IPAddr('10.1.200.3')}),
+        Packet({'inport':2, 'dstip':IPAddr('10.2.0.3')}),
+        Packet({'inport':2}) ]
+    return c, pkts
+
+def test_compiled_classifier_eval():
+    c, pkts = _compiled_classifier_env()
+    cc = CompiledClassifier(c)
+    for pkt in pkts:
+        assert cc.eval(pkt) == c.eval(pkt)
+
+def test_compiled_classifier_lookup():
+    c, pkts = _compiled_classifier_env()
+    cc = CompiledClassifier(c)
+    assert cc.lookup(pkts[0]) is c.rules[0]
+    assert cc.lookup(pkts[1]) is c.rules[1]
+    assert cc.lookup(pkts[3]) is c.rules[3]
+    assert cc.lookup(pkts[5]) is c.rules[4]
+
+def test_compiled_classifier_not_total():
+    cc = CompiledClassifier(Classifier([Rule(Match(dict(inport=1)), [identity])]))
+    assert cc.lookup(Packet({'inport':2})) is None
+    with pytest.raises(TypeError):
+        cc.eval(Packet({'inport':2}))
+
+
+### Single-pass evaluation with queries
+
+def test_track_eval():
+    q1 = FwdBucket()
+    q2 = FwdBucket()
+    policy = ((Match(dict(srcport=53)) >> q1) +
+              (Match(dict(inport=1)) >> (fwd(2) + q2)) +
+              if_(Match(dict(inport=2)), fwd(1), drop))
+    for (pkt, queries) in [(Packet({'inport': 1, 'srcport': 53}), {q1, q2}),
+                           (Packet({'inport': 1, 'srcport': 80}), {q2}),
+                           (Packet({'inport': 2, 'srcport': 53}), {q1}),
+                           (Packet({'inport': 3, 'srcport': 80}), set())]:
+        assert policy.track_eval(pkt) == (policy.eval(pkt), queries)
+    assert policy.has_queries()
+    assert not (Match(dict(inport=1)) >> fwd(2)).has_queries()
+
+
+### Asynchronous bucket delivery
+
+def test_fwd_bucket_async_delivery():
+    import threading
+    delivered = []
+    done = threading.Event()
+    def cb(pkt):
+        delivered.append(pkt)
+        if len(delivered) == 3:
+            done.set()
+    sync_delivered = []
+    fb = FwdBucket(workers=1)
+    fb.register_callback(cb)
+    fb.register_callback(sync_delivered.append, sync=True)
+    pkts = [Packet({'inport': i}) for i in range(3)]
+    for pkt in pkts:
+        fb.eval(pkt)
+    fb.apply()
+    assert set(sync_delivered) == set(pkts)
+    assert delivered == [] and fb.delivery_stats()['enqueued'] == 0
+    fb.dispatch()
+    assert done.wait(5)
+    assert set(delivered) == set(pkts)
+    stats = fb.delivery_stats()
+    assert stats['enqueued'] == 3 and stats['dropped'] == 0
+
+def test_bounded_work_queue_overflow():
+    for (overflow, kept) in [('drop-oldest', [1, 2]), ('sample', None)]:
+        handled = []
+        q = util.BoundedWorkQueue(handled.append, workers=0, max_size=2,
+                                  overflow=overflow)
+        for i in range(3):
+            q.put(i)
+        assert q.stats()['depth'] == 2 and q.stats()['dropped'] == 1
+        if kept:
+            assert [item for (t, item) in q.items] == kept
+    with pytest.raises(ValueError):
+        util.BoundedWorkQueue(None, overflow='bogus')
+    with pytest.raises(ValueError):
+        util.BoundedWorkQueue(None, workers=0, overflow='block')
+
+### Mirrored queries
+
+def test_mirror_bucket_compilation():
+    mb = MirrorBucket(max_len=128)
+    pol = (match(srcport=53) >> mb) + fwd(2)
+    classifier = pol.compile()
+    assert classifier.rules[0].match == Match(dict(srcport=53))
+    actions = list(classifier.rules[0].actions)
+    assert len(actions) == 2 and mb in actions and modify(outport=2) in actions
+    assert list(classifier.rules[1].actions) == [modify(outport=2)]
+    pol = modify(srcip='10.0.0.1') >> mb
+    assert list(pol.compile().rules[0].actions) == [mb]
+
+def test_mirror_bucket_sample():
+    mb = MirrorBucket(sample=0.0)
+    assert mb.eval(Packet({'inport': 1})) == set()
+    assert not mb.bucket
+
+### Windowed aggregate counts
+
+def test_window_counter():
+    from pyretic.lib.query import WindowCounter
+    wc = WindowCounter(panes=2)
+    wc.add(('a',), 1)
+    wc.add(('b',), 2)
+    assert wc.rotate() == {('a',): 1, ('b',): 2}
+    wc.add(('a',), 3)
+    assert wc.rotate() == {('a',): 4, ('b',): 2}
+    assert wc.rotate() == {('a',): 3}
+    assert wc.rotate() == {}
+
+def test_space_saving():
+    from pyretic.lib.query import SpaceSaving
+    ss = SpaceSaving(2)
+    for key in ['a'] * 5 + ['b'] * 3 + ['c']:
+        ss.add(key, 1)
+    assert dict(ss.items()) == {'a': 5, 'c': 4}
+    assert ss.error('c') == 3
+
+### Topology change detection
+
+def test_topology_fingerprint():
+    import copy
+    t = Topology()
+    for s in [1, 2]:
+        t.add_switch(s)
+        t.add_port(s, 1, True, True)
+    old = copy.deepcopy(t)
+    assert old == t and old.version == t.version
+    t.update_port(2, 1, False, True)
+    assert old != t
+    delta = t.delta_from(old)
+    assert delta.ports_changed == set([(2, 1)])
+    assert not delta.switches_added and not delta.links_added
+    t.update_port(2, 1, True, True)
+    assert old == t and not t.delta_from(old)
+
+def test_spanning_forest_updates():
+    def link(s1, p1, s2, p2):
+        return frozenset([(s1, p1), (s2, p2)])
+    l12, l23, l13 = link(1, 2, 2, 1), link(2, 3, 3, 2), link(1, 3, 3, 1)
+    empty = (frozenset(), {}, frozenset())
+    triangle = (frozenset([1, 2, 3]), {}, frozenset([l12, l23, l13]))
+    forest = SpanningForest()
+    forest.update(TopologyDelta(empty, triangle))
+    assert len(forest.tree_links) == 2 and len(forest.members) == 1
+    # removing a tree link brings in the remaining link as a replacement
+    cut = iter(forest.tree_links).next()
+    forest.update(TopologyDelta(triangle,
+        (triangle[0], {}, triangle[2] - frozenset([cut]))))
+    assert forest.tree_links == set([l12, l23, l13]) - set([cut])
+    assert len(forest.members) == 1
+    for s in [1, 2, 3]:
+        assert forest.non_tree_ports(s) == set()
+    # removing a switch splits off the rest
+    forest.update(TopologyDelta((triangle[0], {}, triangle[2] - frozenset([cut])),
+                                (frozenset([1, 3]), {}, frozenset([l13]))))
+    assert forest.tree_links == set([l13]) and len(forest.members) == 1
+
+def test_shortest_path_trees_invalidation():
+    def link(s1, p1, s2, p2):
+        t.add_port(s1, p1, True, True)
+        t.add_port(s2, p2, True, True)
+        t.add_link(Location(s1, p1), Location(s2, p2))
+    t = Topology()
+    for s in [1, 2, 3, 4, 5, 6]:
+        t.add_switch(s)
+    for (s1, p1, s2, p2) in [(1, 2, 2, 1), (2, 3, 3, 2), (1, 4, 4, 1),
+                             (5, 6, 6, 5)]:
+        link(s1, p1, s2, p2)
+    trees = ShortestPathTrees()
+    trees.update(t)
+    def cached(change):
+        trees.path(t, 1, 2)
+        assert 1 in trees.trees
+        change()
+        trees.update(t)
+        return 1 in trees.trees
+    assert trees.path(t, 1, 3) == [Location(1, 2), Location(2, 3)]
+    # deltas the tree from 1 cannot see keep it
+    assert cached(lambda: t.add_switch(7))
+    assert cached(lambda: t.remove_edge(5, 6))
+    assert cached(lambda: link(2, 4, 4, 2))
+    # removing a tree link, adding a link extending it or skipping a level
+    assert not cached(lambda: t.remove_edge(2, 3))
+    assert not cached(lambda: link(4, 5, 5, 4))
+    assert not cached(lambda: link(1, 3, 3, 1))
+    assert trees.path(t, 1, 3) == [Location(1, 3)]
+
+def test_edge_network_updates():
+    t = Topology()
+    t.add_switch(1)
+    t.add_port(1, 1, True, True)
+    t.add_port(1, 2, True, True)
+    pol = egress_network()
+    pol.set_network(FakeNetwork(t))
+    assert pol.egresses == set([Location(1, 1), Location(1, 2)])
+    before = pol.switch_policies[1]
+    t.add_switch(2)
+    t.add_port(2, 1, True, True)
+    pol.set_network(FakeNetwork(t))
+    assert pol.switch_policies[1] is before
+    assert pol.egresses == set([Location(1, 1), Location(1, 2), Location(2, 1)])
+    t.update_port(1, 2, False, False)
+    pol.set_network(FakeNetwork(t))
+    assert pol.egresses == set([Location(1, 1), Location(2, 1)])
+
+def test_int_backed_addresses():
+    import copy
+    ip = IPAddr('10.0.0.1')
+    assert ip is IPAddr('10.0.0.1') and ip == IP('10.0.0.1')
+    assert int(ip) == 0x0a000001 and IPAddr(ip.to_bytes()) == ip
+    assert ip in IPv4Network('10.0.0.0/8') and ip in IPPrefix('10.0.0.0/8')
+    assert not ip in IPPrefix('10.1.0.0/16')
+    assert copy.deepcopy(ip) is ip and ip != MAC(0x0a000001)
+    mac = MAC('00:00:00:00:00:0A')
+    assert repr(mac) == '00:00:00:00:00:0a' and EthAddr(mac.to_bytes()) == mac
+    assert Match(dict(srcip=ip)) == Match(dict(srcip='10.0.0.1'))
+
+def test_match_hash_consing():
+    import copy
+    m = Match(dict(srcip='10.0.0.1', dstport=53))
+    assert Match(dict(dstport=53, srcip='10.0.0.1')) is m
+    assert Match(dict(srcip=IPAddr('10.0.0.1'), dstport=53)) is m
+    assert m._classifier is None and len(m.compile().rules) == 2
+    assert copy.deepcopy(m) is m and hash(m) == hash(m.key)
+    wider = Match(dict(dstport=53))
+    assert wider.covers(m) and not m.covers(wider)
+    assert m.intersect(wider) is m and wider.intersect(m) is m
@@ -0,0 +1,210 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Joshua Reich (jreich@cs.princeton.edu)                               #
+# author: Christopher Monsanto (chris@monsan.to)                               #
+# author: Cole Schlesinger (cschlesi@cs.princeton.edu)                         #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+from pyretic.core.language import *
+from pyretic.core.packet import *
+from pyretic.lib.std import *
+from pyretic.modules.netassay.assayrule import AssayRule
+
+import pytest
+
+### Switch-counter assay counts
+
+def test_assay_count_bucket_accounting():
+    from pyretic.modules.netassay.assaycount import AssayCountBucket
+    b = AssayCountBucket(interval=3600)
+    counts = []
+    b.register_callback(counts.append)
+    def stat(ip, packets):
+        return {'keys': (frozenset([('srcip', ip)]),), 'priority': 5,
+                'packet_count': packets, 'byte_count': 100 * packets}
+    for stats in [[stat('10.0.0.1', 5)],
+                  [stat('10.0.0.1', 7), stat('10.0.0.2', 1)],
+                  [stat('10.0.0.2', 3)]]:
+        b.outstanding_switches = [1]
+        b.handle_flow_stats_reply(1, stats)
+    assert counts == [[5, 500], [8, 800], [10, 1000]]
+    b.stop()
+
+### NetAssay matches
+
+def test_netassay_match_compiled_intersect():
+    from pyretic.modules.netassay.netassaymatch import NetAssayMatch
+    class Engine(object):
+        def new_rule(self, rule):
+            pass
+    class Action(object):
+        def children_update(self):
+            pass
+    nam = NetAssayMatch(Engine(), AssayRule.DNS_NAME, 'example.com', Action())
+    assert nam.intersect(Match(dict(dstport=80))) == drop
+    nam.assayrule.add_rule_group(Match(dict(srcip='10.0.0.0/8')))
+    nam.assayrule.add_rule_group(Match(dict(dstport=80, protocol=6)))
+    nam.assayrule.finish_rule_group()
+    version = nam.assayrule.version
+    assert nam.intersect(Match(dict(srcip='10.1.0.0/16'))) == \
+        Match(dict(srcip='10.1.0.0/16', dstport=80, protocol=6))
+    assert nam.intersect(Match(dict(dstport=53))) == drop
+    assert nam.intersect(Match(dict(srcip='11.0.0.0/8'))) == drop
+    assert nam.assayrule.version == version
+    assert nam.assayrule.get_list_of_rules() is nam.assayrule.get_list_of_rules()
+
+### Logging
+
+def test_netassay_lazy_logging():
+    import logging, os, tempfile
+    from pyretic.modules.netassay import netassaylog
+    logger = netassaylog.get_logger('TestComponent')
+    assert logger is netassaylog.get_logger('TestComponent')
+    assert logger.name == 'netassay.TestComponent'
+    netassaylog.set_verbosity('TestComponent', 'debug')
+    assert netassaylog.verbosity()['TestComponent'] == 'DEBUG'
+    with pytest.raises(ValueError):
+        netassaylog.set_verbosity('TestComponent', 'loud')
+
+    class Unformatted(object):
+        formatted = 0
+        def __str__(self):
+            Unformatted.formatted += 1
+            return 'unformatted'
+
+    (fd, path) = tempfile.mkstemp()
+    os.close(fd)
+    handler = netassaylog.AsyncFileHandler(path)
+    handler.setFormatter(logging.Formatter('%(name)s %(message)s'))
+    logger.addHandler(handler)
+    try:
+        netassaylog.set_verbosity('TestComponent', logging.INFO)
+        logger.debug("skipped %s", Unformatted())
+        assert Unformatted.formatted == 0
+        logger.info("written %s", Unformatted())
+        handler.flush()
+        assert open(path).read() == 'netassay.TestComponent written unformatted\n'
+        # arguments are logged as they were at the call, even if they
+        # change before the writer gets to the record
+        rules = ['r1']
+        handler.target.acquire()
+        try:
+            logger.info("rules %s", rules)
+            rules.append('r2')
+            try:
+                raise KeyError('r3')
+            except KeyError:
+                logger.exception("failed")
+        finally:
+            handler.target.release()
+        handler.flush()
+        lines = open(path).read().splitlines()
+        assert lines[1] == "netassay.TestComponent rules ['r1']"
+        assert lines[2] == 'netassay.TestComponent failed'
+        assert lines[-1] == "KeyError: 'r3'"
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+        os.remove(path)
+
+### Time-windowed visitors
+
+def test_time_window_expiry_order():
+    from pyretic.modules.netassay.netassaywindow import TimeWindow
+    w = TimeWindow(10)
+    assert w.visit('a', now=0) and w.visit('b', now=1) and w.visit('c', now=2)
+    assert w.next_expiry() == 10
+    assert w.expire(now=10.5) == ['a']
+    # a repeat visit refreshes the key, leaving its old entry stale
+    assert not w.visit('b', now=5)
+    assert w.expire(now=11.5) == [] and 'b' in w
+    assert w.expire(now=12) == ['c']
+    assert w.next_expiry() == 15 and len(w) == 1
+    assert w.expire(now=15) == ['b'] and w.next_expiry() is None
+    # keys due within slack of each other expire together
+    w = TimeWindow(10, slack=1)
+    w.visit('a', now=0)
+    w.visit('b', now=0.5)
+    w.visit('c', now=3)
+    assert sorted(w.expire(now=10)) == ['a', 'b'] and w.keys() == ['c']
+
+def test_visited_pkt_callback(monkeypatch):
+    from pyretic.core.language_tools import (ast_fold, add_dynamic_sub_pols,
+                                             on_recompile_path)
+    from pyretic.modules.netassay import netassaywindow
+    now = [100.0]
+    class clock(object):
+        @staticmethod
+        def time():
+            return now[0]
+    timers = []
+    class timer(object):
+        def __init__(self, delay, f):
+            self.delay = delay
+            timers.append(self)
+        def start(self):
+            pass
+        def cancel(self):
+            pass
+    monkeypatch.setattr(netassaywindow, 'time', clock)
+    monkeypatch.setattr(netassaywindow, 'Timer', timer)
+    server = IPAddr('10.0.0.100')
+    client1, client2 = IPAddr('10.0.0.1'), IPAddr('10.0.0.2')
+    v = netassaywindow.visited(60, dstip=server)
+    changes = []
+    v.visitors.attach(changes.append)
+    # the runtime attaches to the visitors and recompiles through visited
+    assert v.visitors in ast_fold(add_dynamic_sub_pols, set(), v)
+    assert on_recompile_path(set(), id(v.visitors), v) == set([v, v.visitors])
+    def request(client):
+        return Packet({'srcip': client, 'dstip': server, 'protocol': 6})
+    # the visitor is the endpoint the filter doesn't name
+    assert v._visitor(request(client1)) == client1
+    assert v._visitor(Packet({'srcport': 80})) is None
+    v._pkt_callback(request(client1))
+    assert len(changes) == 1 and len(timers) == 1 and timers[0].delay == 60
+    assert v.eval(Packet({'srcip': server, 'dstip': client1})) != set()
+    assert v.eval(Packet({'srcip': server, 'dstip': client2})) == set()
+    assert len(v.visitors.compile().rules) == 3
+    # a repeat visit only refreshes the visitor
+    now[0] = 130.0
+    v._pkt_callback(request(client1))
+    now[0] = 140.0
+    v._pkt_callback(request(client2))
+    assert len(changes) == 2 and len(v.visitors.compile().rules) == 5
+    now[0] = 161.0
+    v._age_out()
+    assert len(changes) == 2 and timers[-1].delay == 29
+    now[0] = 190.0
+    v._age_out()
+    assert len(changes) == 3 and len(v.visitors.compile().rules) == 3
+    assert v.eval(request(client1)) == set() and v.eval(request(client2))
+    now[0] = 200.0
+    v._age_out()
+    assert v.visitors.compile().rules[0].actions == set()
+    assert v.eval(request(client2)) == set()
+    assert len(changes) == 4 and v.timer is None
@@ -157,3 +157,28 @@ def test_processor_unpacking():
     assert not vlan.vlan in pkt
     assert res == udp_payload
 
+
+def test_lazy_header():
+    pro = Processor().compile()
+    for payload in [udp_payload, vlan_payload, arp_payload, udp_payload[:40]]:
+        decoded = []
+        def decode():
+            decoded.append(True)
+            header = { h : v for (h,v) in pro.unpack(payload).items()
+                       if not v is None }
+            header.update({'switch': 1, 'inport': 2, 'raw': payload})
+            return header
+        eager = Packet(decode())
+        lazy = Packet(LazyHeader({'switch': 1, 'inport': 2, 'raw': payload}, decode))
+        del decoded[:]
+
+        assert lazy['switch'] == 1 and lazy['raw'] == payload
+        if payload in [udp_payload, vlan_payload]:
+            assert (lazy['srcport'], lazy['dstport']) == (67, 68)
+            assert not decoded
+        for field in ['srcport', 'dstport', 'srcip', 'ethtype']:
+            assert (field in lazy.header) == (field in eager.header)
+            assert lazy.header.get(field) == eager.header.get(field)
+        assert decoded
+        assert lazy == eager and hash(lazy) == hash(eager)
+        assert lazy.modify(outport=3) == eager.modify(outport=3)
@@ -0,0 +1,424 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Joshua Reich (jreich@cs.princeton.edu)                               #
+# author: Christopher Monsanto (chris@monsan.to)                               #
+# author: Cole Schlesinger (cschlesi@cs.princeton.edu)                         #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+from pyretic.core.language import *
+from pyretic.core.packet import *
+from pyretic.lib.std import *
+from pyretic.core.runtime import *
+
+import contextlib
+import logging
+import threading
+import pytest
+
+class FakeBackend(object):
+    """Records the packets sent, checking they are sent in bulk."""
+    def __init__(self):
+        self.sent = []
+        self.in_bulk = False
+
+    @contextlib.contextmanager
+    def bulk(self):
+        self.in_bulk = True
+        yield
+        self.in_bulk = False
+
+    def send_packet(self, pkt):
+        assert self.in_bulk
+        self.sent.append(pkt)
+
+@pytest.fixture
+def runtime():
+    """
+    A Runtime with the state its packet and query handling uses, without
+    a network, an install thread or a program.  Packets pass between the
+    concrete and pyretic forms unchanged.
+    """
+    rt = Runtime.__new__(Runtime)
+    rt.log = logging.getLogger('test')
+    rt.backend = FakeBackend()
+    rt.mode = 'interpreted'
+    rt.policy = drop
+    rt.policy_lock = threading.RLock()
+    rt.compiled_eval = None
+    rt.compiled_eval_failed = False
+    rt.mirror_eval = None
+    rt.in_bucket_apply = False
+    rt.bucket_triggered_policy_update = False
+    rt.flow_match_cache = {}
+    rt.global_outstanding_queries_lock = threading.Lock()
+    rt.global_outstanding_queries = {}
+    rt.bucket_index = {}
+    rt.concrete2pyretic = lambda pkt: pkt
+    rt.pyretic2concrete = lambda pkt: pkt
+    return rt
+
+### Query application
+
+def test_fwd_bucket_dispatch_outside_policy_lock(runtime):
+    # a callback that takes the policy lock must not deadlock a bucket
+    # whose queue blocks when full
+    delivered = []
+    done = threading.Event()
+    def cb(pkt):
+        with runtime.policy_lock:
+            delivered.append(pkt)
+        if len(delivered) == 4:
+            done.set()
+    fb = FwdBucket(workers=1, queue_size=1, overflow='block')
+    fb.register_callback(cb)
+    for i in range(4):
+        fb.eval(Packet({'inport': i}))
+    with runtime.policy_lock:
+        runtime.apply_queries([fb])
+    runtime.dispatch_queries([fb])
+    assert done.wait(5)
+    assert len(delivered) == 4
+
+### Packet-in batching
+
+def test_packet_in_batcher_batches():
+    # fills up before the window passes
+    b = PacketInBatcher(None, window=60, max_size=2, start=False)
+    for i in range(5):
+        b.put(i)
+    assert b.next_batch() == [0, 1]
+    assert b.next_batch() == [2, 3]
+    # takes what arrived when the window passes
+    b.window = 0.01
+    assert b.next_batch() == [4]
+    assert b.stats() == {'received': 5, 'pending': 0, 'dropped': 0,
+                         'batches': 3}
+
+def test_packet_in_batcher_overflow():
+    b = PacketInBatcher(None, window=0, max_size=2, max_pending=3,
+                        start=False)
+    for i in range(5):
+        b.put(i)
+    assert list(b.pending) == [2, 3, 4] and b.stats()['dropped'] == 2
+    b = PacketInBatcher(None, window=0, max_size=2, max_pending=2,
+                        overflow='block', start=False)
+    b.put(0)
+    b.put(1)
+    t = threading.Thread(target=b.put, args=(2,))
+    t.start()
+    assert b.next_batch() == [0, 1]
+    t.join(5)
+    assert not t.is_alive() and list(b.pending) == [2]
+    assert b.stats()['dropped'] == 0
+    with pytest.raises(ValueError):
+        PacketInBatcher(None, window=0, overflow='sample', start=False)
+
+def test_handle_packet_in_batch(runtime):
+    fb = FwdBucket()
+    bucketed = []
+    fb.register_callback(bucketed.append)
+    runtime.policy = ((Match(dict(inport=1)) >> fwd(2)) +
+                      (Match(dict(inport=2)) >> fb))
+    pkts = [Packet({'switch': 1, 'inport': 1, 'srcport': i}) for i in range(3)]
+    to_bucket = Packet({'switch': 1, 'inport': 2, 'srcport': 9})
+    runtime.handle_packet_in_batch(pkts[:2] + [to_bucket] + pkts[2:])
+    sent = runtime.backend.sent
+    assert sorted(p['srcport'] for p in sent) == [0, 1, 2]
+    assert all(p['outport'] == 2 for p in sent)
+    assert bucketed == [to_bucket]
+
+### Flow stats
+
+def test_flow_stats_dispatch(runtime):
+    b1, b2 = CountBucket(), CountBucket()
+    runtime.global_outstanding_queries = {1: [b1, b2]}
+    runtime.bucket_index = index_buckets([
+        Rule(Match(dict(srcip='10.0.0.1')), [b1]),
+        Rule(Match(dict(inport=2, dstport=80)), [b2])])
+    got = {}
+    b1.handle_flow_stats_reply = lambda s, stats: got.setdefault(1, stats)
+    b2.handle_flow_stats_reply = lambda s, stats: got.setdefault(2, stats)
+    def stat(match, packets):
+        return {'match': repr(match), 'actions': '[]', 'priority': 1,
+                'packet_count': packets, 'byte_count': packets}
+    runtime.handle_flow_stats_reply(1, [stat({'srcip': '\x0a\x00\x00\x01',
+                                              'inport': 3}, 4),
+                                        stat({'inport': 2, 'dstport': 80}, 5),
+                                        stat({'dstport': 80}, 6)])
+    assert [f['packet_count'] for f in got[1]] == [4]
+    assert [f['packet_count'] for f in got[2]] == [5]
+    assert runtime.global_outstanding_queries == {}
+
+def test_flow_stats_dispatch_per_switch(runtime):
+    b1, b2 = CountBucket(), CountBucket()
+    runtime.bucket_index = index_buckets([
+        Rule(Match(dict(switch=1, dstport=80)), [b1]),
+        Rule(Match(dict(switch=2, dstport=80)), [b2])])
+    got = {}
+    b1.handle_flow_stats_reply = lambda s, stats: got.setdefault((s, 1), stats)
+    b2.handle_flow_stats_reply = lambda s, stats: got.setdefault((s, 2), stats)
+    def stat(packets):
+        return {'match': repr({'dstport': 80}), 'actions': '[]',
+                'priority': 1, 'packet_count': packets, 'byte_count': packets}
+    for (switch, packets) in [(1, 4), (2, 7)]:
+        runtime.global_outstanding_queries = {switch: [b1, b2]}
+        runtime.handle_flow_stats_reply(switch, [stat(packets)])
+    assert [f['packet_count'] for f in got[(1, 1)]] == [4]
+    assert got[(1, 2)] == []
+    assert got[(2, 1)] == []
+    assert [f['packet_count'] for f in got[(2, 2)]] == [7]
+
+### Topology updates
+
+def test_topology_update_coalescing():
+    now = [0]
+    changes = [True, False, True, True]
+    applied = []
+    def update():
+        applied.append(now[0])
+        return changes[len(applied) - 1]
+    worker = TopologyUpdateWorker(update, debounce=5, max_latency=100,
+                                  clock=lambda: now[0], start=False)
+    assert not worker.poll() and not worker.flush()
+    for i in range(48):
+        worker.event()
+    now[0] = 4
+    assert not worker.poll()
+    # a burst is applied once the debounce window passes without events
+    now[0] = 5
+    assert worker.poll() and not worker.poll()
+    assert applied == [5]
+    assert worker.stats() == {'events' : 48, 'updates' : 1, 'unchanged' : 0}
+    # a steady trickle of events is still applied within max_latency
+    worker.max_latency = 10
+    for t in range(100, 130, 3):
+        now[0] = t
+        worker.event()
+        worker.poll()
+    assert applied == [5, 112, 127]
+    assert worker.stats() == {'events' : 58, 'updates' : 2, 'unchanged' : 1}
+    now[0] = 200
+    assert not worker.poll()
+
+### Virtual header tags
+
+def test_vlan_tag_allocator_reclaims():
+    tags = VlanTagAllocator()
+    tags.size = 2
+    a, b, c = [util.frozendict(vtag=i) for i in range(3)]
+    tag_a = tags.acquire(a, 0)
+    assert tags.acquire(a, 1) == tag_a and tags.decode(*tag_a) == a
+    tags.acquire(b, 1)
+    with pytest.raises(TagSpaceExhausted):
+        tags.acquire(c, 1)
+    tags.release(0)
+    assert tags.stats()['reclaimable'] == 0
+    tags.release(1)
+    # released tags still decode until they are reused, oldest first
+    assert tags.decode(*tag_a) == a
+    assert tags.acquire(c, 2) == tag_a and tags.decode(*tag_a) == c
+    stats = tags.stats()
+    assert (stats['in_use'], stats['reclaimable'], stats['reclaims']) == (1, 1, 1)
+
+### Mirrored queries
+
+def test_concretize_mirror_rule():
+    mb = MirrorBucket(max_len=128)
+    def controller_outputs(rule):
+        return [a for a in concretize_rule(rule).actions
+                if a['outport'] == OFPP_CONTROLLER]
+    mirrored = Rule(Match(dict(srcport=53)), [mb, modify(outport=2)])
+    outputs = controller_outputs(mirrored)
+    assert outputs == [{'outport': OFPP_CONTROLLER, 'max_len': 128}]
+    assert isinstance(outputs[0], MirrorOutput)
+    # a rule sending packets to the controller needs no mirrored copy
+    to_controller = Rule(Match(dict(srcport=53)), [mb, Controller])
+    outputs = controller_outputs(to_controller)
+    assert outputs == [{'outport': OFPP_CONTROLLER}]
+    assert not isinstance(outputs[0], MirrorOutput)
+
+def test_check_compilable_action_list():
+    mb = MirrorBucket()
+    check = check_OF_rule_has_compilable_action_list
+    check(concretize_rule(Rule(identity, [mb, modify(srcip='10.0.0.1',
+                                                     outport=2)])))
+    check(concretize_rule(Rule(identity, [modify(outport=1),
+                                          modify(outport=2)])))
+    # only the mirrored copy is left out of the check
+    with pytest.raises(TypeError):
+        check(concretize_rule(Rule(identity, [Controller,
+                                              modify(srcip='10.0.0.1',
+                                                     outport=2)])))
+    with pytest.raises(TypeError):
+        check(concretize_rule(Rule(identity, [mb, modify(outport=1),
+                                              modify(srcip='10.0.0.1',
+                                                     outport=2)])))
+
+def test_mirrored_copy(runtime):
+    mb = MirrorBucket()
+    runtime.mirror_eval = CompiledClassifier(Classifier([
+        Rule(Match(dict(srcport=53)), [mb, modify(outport=2)]),
+        Rule(Match(dict(srcport=80)), [modify(outport=1)]),
+        Rule(Match(dict(srcport=22)), [mb, Controller]),
+        Rule(identity, set())]))
+    def pkt(srcport):
+        return Packet({'switch': 1, 'inport': 1, 'srcport': srcport})
+    assert runtime.mirrored_copy(pkt(53))
+    assert not runtime.mirrored_copy(pkt(80))
+    assert not runtime.mirrored_copy(pkt(22))
+    runtime.mirror_eval = None
+    assert not runtime.mirrored_copy(pkt(53))
+
+### Switch table updates
+
+class BlockingInstall(object):
+    """
+    An install callable that records its argument, holding the worker
+    until released when asked to.
+    """
+    def __init__(self):
+        self.installed = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, update, block=False):
+        if block:
+            self.started.set()
+            assert self.release.wait(5)
+        self.installed.append(update)
+
+def test_install_worker_coalesces_pending():
+    install = BlockingInstall()
+    worker = InstallWorker()
+    worker.submit('classifier', install, 'c1', True)
+    assert install.started.wait(5)
+    # the worker is busy with c1; only the newest pending classifier runs
+    worker.submit('classifier', install, 'c2')
+    worker.submit('classifier', install, 'c3')
+    last = worker.submit('classifier', install, 'c4')
+    install.release.set()
+    assert worker.wait(last, timeout=5)
+    assert install.installed == ['c1', 'c4']
+    assert worker.installs == 2
+    assert worker.coalesced == 2
+
+def test_install_worker_order():
+    install = BlockingInstall()
+    worker = InstallWorker()
+    worker.submit('clear', install, 'clear', True)
+    assert install.started.wait(5)
+    worker.submit('classifier', install, 'c1')
+    worker.submit('barrier', install, 'b1')
+    # replaces c1, taking its place at the back of the queue
+    worker.submit('classifier', install, 'c2')
+    last = worker.submit('flow_stats', install, 's1')
+    install.release.set()
+    assert worker.wait(last, timeout=5)
+    assert install.installed == ['clear', 'b1', 'c2', 's1']
+    assert worker.installed_version == last
+
+def test_install_worker_wait():
+    install = BlockingInstall()
+    worker = InstallWorker()
+    first = worker.submit('classifier', install, 'c1', True)
+    assert install.started.wait(5)
+    assert not worker.wait(first, timeout=0.01)
+    assert install.installed == []
+    install.release.set()
+    assert worker.wait(first, timeout=5)
+    assert install.installed == ['c1']
+    # an install that fails still counts as done
+    def fail():
+        raise RuntimeError('no switch')
+    second = worker.submit('classifier', fail)
+    assert worker.wait(second, timeout=5)
+    assert worker.wait(first, timeout=0)
+
+### Rule priorities
+
+def concrete_rules(ports, switch=1):
+    return Classifier([Rule({'switch': switch, 'dstport': p}, [{'outport': 1}])
+                       for p in ports])
+
+def priorities(prioritized):
+    return dict((m['dstport'], p) for (m, p, a) in prioritized)
+
+def installed(prioritized):
+    return set((frozenset(m.items()), p) for (m, p, a) in prioritized)
+
+def assert_ordered(ports, prioritized):
+    prios = priorities(prioritized)
+    ordered = [prios[p] for p in ports]
+    assert ordered == sorted(ordered, reverse=True)
+    assert len(set(ordered)) == len(ordered)
+    assert TABLE_MISS_PRIORITY < min(ordered) and max(ordered) <= PRIORITY_MAX
+
+def test_prioritize_keeps_unchanged_rules():
+    first = prioritize(concrete_rules([1, 2, 3]))
+    assert_ordered([1, 2, 3], first)
+    assert prioritize(concrete_rules([1, 2, 3]), first) == first
+    # each switch is allocated separately
+    both = prioritize(Classifier(list(concrete_rules([1, 2]).rules) +
+                                 list(concrete_rules([1, 2], switch=2).rules)))
+    assert sorted(p for (m, p, a) in both if m['switch'] == 1) == \
+        sorted(p for (m, p, a) in both if m['switch'] == 2)
+
+def test_prioritize_insert_changes_one_rule():
+    first = prioritize(concrete_rules([1, 2, 3]))
+    second = prioritize(concrete_rules([1, 4, 2, 3]), first)
+    assert_ordered([1, 4, 2, 3], second)
+    changed = installed(second) - installed(first)
+    assert len(changed) == 1 and dict(changed.pop()[0])['dstport'] == 4
+
+def test_prioritize_renumbers_when_gap_is_used_up():
+    order = [1, 2]
+    prev = prioritize(concrete_rules(order))
+    gap = priorities(prev)[1] - priorities(prev)[2]
+    assert gap == PRIORITY_GAP
+    # each insertion right after rule 1 halves the room left there
+    for port in range(100, 100 + PRIORITY_GAP):
+        order.insert(1, port)
+        new = prioritize(concrete_rules(order), prev)
+        assert_ordered(order, new)
+        kept = [p for p in [1, 2] if priorities(new)[p] == priorities(prev)[p]]
+        if kept != [1, 2]:
+            break
+        assert len(installed(new) - installed(prev)) == 1
+        prev = new
+    else:
+        assert False, 'priorities were never reallocated'
+    assert len(order) == 7
+    prios = [priorities(new)[p] for p in order]
+    assert all(a - b == PRIORITY_GAP for (a, b) in zip(prios, prios[1:]))
+
+def test_prioritize_stays_within_priority_max():
+    ports = range(10000)
+    first = prioritize(concrete_rules(ports))
+    assert_ordered(ports, first)
+    second = prioritize(concrete_rules(ports[:5000] + [-1] + ports[5000:]),
+                        first)
+    assert_ordered(ports[:5000] + [-1] + ports[5000:], second)
@@ -0,0 +1,74 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Joshua Reich (jreich@cs.princeton.edu)                               #
+# author: Christopher Monsanto (chris@monsan.to)                               #
+# author: Cole Schlesinger (cschlesi@cs.princeton.edu)                         #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+from pyretic.core import tracing
+from pyretic.core.tracing import Tracer
+
+import sys
+import time
+
+def test_tracing_spans():
+    import json, os, tempfile
+    t = Tracer(capacity=8)
+    t.record('add', 1)
+    assert t.records() == []
+    t.enable()
+    t.record('add', 1)
+    t.record('install', 1)
+    t.record('update_rules', 1)
+    t.record('compile', value=3)
+    t.record('add', 2)
+    t.record('flow_mods_sent', value='classifier')
+    spans = t.spans()
+    assert sorted(spans[1]) == ['add', 'compile', 'flow_mods_sent',
+                                'install', 'update_rules']
+    assert spans[1]['add'] <= spans[1]['flow_mods_sent']
+    assert sorted(spans[2]) == ['add']
+    for i in range(10):
+        t.record('add', 10 + i)
+    assert len(t.records()) == 8 and t.records()[0][1] == 12
+    (fd, path) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        t.export_csv(path)
+        assert open(path).readline().startswith('serial,add,remove')
+        t.export_json(path)
+        assert len(json.load(open(path))['records']) == 8
+    finally:
+        os.remove(path)
+
+def test_monotonic_clock_fallback(monkeypatch):
+    clock = tracing._monotonic_clock()
+    (a, b) = (clock(), clock())
+    assert 0 <= a <= b
+    if not hasattr(time, 'monotonic'):
+        monkeypatch.setattr(sys, 'platform', 'darwin')
+        assert tracing._monotonic_clock() is time.time